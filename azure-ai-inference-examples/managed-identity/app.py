@@ -58,7 +58,7 @@ def main():
         endpoint=os.getenv('FOUNDRY_PROJECT_ENDPOINT'),
         credential=credential
     )
-    models = project_client.get_openai_client(os.getenv('OEPNAI_API_VERSION'))
+    models = project_client.get_openai_client(os.getenv('OPENAI_API_VERSION'))
 
     ## Perform a chat completion Foundry API
     ##
@@ -66,7 +66,7 @@ def main():
 
         client = ChatCompletionsClient(
             endpoint=f"{os.getenv('FOUNDRY_ENDPOINT')}/openai/deployments/{os.getenv('DEPLOYMENT_NAME')}",
-            credential=DefaultAzureCredential(),
+            credential=credential,
             credential_scopes=["https://cognitiveservices.azure.com/.default"]
     
         )
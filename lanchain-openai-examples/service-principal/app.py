@@ -3,7 +3,7 @@ import sys
 import os
 from langchain_openai import AzureChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
-from msal import ConfidentialClientApplication
+from msal import ConfidentialClientApplication, SerializableTokenCache
 from dotenv import load_dotenv
 
 ## This function sets up logging
@@ -27,28 +27,59 @@ def configure_logging(level="ERROR"):
         print(f"Failed to set up logging: {e}", file=sys.stderr)
         sys.exit(1)
 
-## This function obtains an access token from Entra ID using a service principal with a client id and client secret
+## This function loads the MSAL token cache from disk so tokens are reused across runs
+##
+def load_token_cache(cache_path):
+    cache = SerializableTokenCache()
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache.deserialize(f.read())
+    return cache
+
+## This function writes the MSAL token cache to disk if it changed
+##
+def save_token_cache(cache, cache_path):
+    if cache_path and cache.has_state_changed:
+        ## The cache holds bearer tokens so only the current user should be able to read it
+        fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(cache.serialize())
+
+## This function builds a token provider that obtains access tokens from Entra ID using a service principal with a client id and client secret.
+## LangChain calls the provider before each request, so a long-running job gets a new token once the first one expires
 ##
 def authenticate_with_service_principal(client_id, client_credential, tenant_name, scopes):
     try: 
         logging.info('Attempting to obtain an access token...')
-        
+
+        ## MSAL checks the token cache before calling Entra ID so a token saved by a previous
+        ## run is reused until it is close to expiring
+        cache_path = os.getenv('TOKEN_CACHE_PATH')
+        cache = load_token_cache(cache_path)
         app = ConfidentialClientApplication(
             client_id=client_id,
             client_credential=client_credential,
-            authority=f"https://login.microsoftonline.com/{tenant_name}"
+            authority=f"https://login.microsoftonline.com/{tenant_name}",
+            token_cache=cache
         )
-        result = app.acquire_token_for_client(scopes=scopes)
 
-        if "access_token" in result:
-            logging.info('Access token successfully acquired')
-            return result['access_token']
-        else:
-            logging.error('Unable to obtain access token')
-            logging.error(f"Error was: {result['error']}")
-            logging.error(f"Error description was: {result['error_description']}")
-            logging.error(f"Error correlation_id was: {result['correlation_id']}")
-            raise Exception('Failed to obtain access token')
+        def token_provider():
+            result = app.acquire_token_for_client(scopes=scopes)
+            save_token_cache(cache, cache_path)
+
+            if "access_token" in result:
+                return result['access_token']
+            else:
+                logging.error('Unable to obtain access token')
+                logging.error(f"Error was: {result['error']}")
+                logging.error(f"Error description was: {result['error_description']}")
+                logging.error(f"Error correlation_id was: {result['correlation_id']}")
+                raise Exception('Failed to obtain access token')
+
+        ## Obtain the first token now so a configuration problem is reported before any request is sent
+        token_provider()
+        logging.info('Access token successfully acquired')
+        return token_provider
     except:
         logging.error('Failed to obtain access token: ', exc_info=True)
         sys.exit(1)
@@ -60,16 +91,16 @@ def main():
     
     ## Use dotenv library to load environmental variables from .env file.
     ## The variables loaded include AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID
-    ## DEPLOYMENT_NAME, OPENAI_API_VERSION, and AZURE_OPENAI_ENDPOINT
+    ## DEPLOYMENT_NAME, OPENAI_API_VERSION, AZURE_OPENAI_ENDPOINT, and optionally TOKEN_CACHE_PATH
     try:
         load_dotenv('.env')
     except Exception as e:
         logging.error('Failed to load environmental variables: ', exc_info=True)
         sys.exit(1)
     
-    ## Obtain an access token
+    ## Obtain a token provider
     ##
-    token = authenticate_with_service_principal(
+    token_provider = authenticate_with_service_principal(
         client_id = os.getenv('AZURE_CLIENT_ID'),
         client_credential = os.getenv('AZURE_CLIENT_SECRET'),
         tenant_name = os.getenv('AZURE_TENANT_ID'),
@@ -83,7 +114,7 @@ def main():
             azure_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
             azure_deployment= os.getenv('DEPLOYMENT_NAME'),
             api_version = os.getenv('OPENAI_API_VERSION'),
-            azure_ad_token=token
+            azure_ad_token_provider=token_provider
         )
         
         messages = [
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import sys
+import time
+
+from messages import request_body, system, to_dicts, to_inference, to_langchain, user
+from settings import ConfigurationError, get_settings, mock_settings
+from utils import configure_logging, percentile
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant that provides interesting facts."
+
+## These classes put the async clients of each SDK behind one interface so the same
+## engine can drive any of them and their throughput can be compared
+##
+class ChatBackend:
+    """This class is the interface shared by the async chat completion backends"""
+    name = 'base'
+    ## Objects with an aclose() the backend closes along with its client, such as the token provider
+    ## create_backend built for it
+    owned = ()
+
+    async def complete(self, messages, max_tokens=100):
+        """This function performs a single chat completion
+            Args:
+                messages (list): The chat messages as Message objects or dicts with role and content
+                max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+            Returns:
+                str: The content of the assistant message
+        """
+        raise NotImplementedError
+
+    async def aclose(self):
+        """This function closes the connections held by the backend"""
+        for resource in self.owned:
+            await resource.aclose()
+
+class OpenAIBackend(ChatBackend):
+    """This class performs chat completions with AsyncOpenAI or AsyncAzureOpenAI
+        Args:
+            client (AsyncOpenAI): An AsyncOpenAI or AsyncAzureOpenAI client
+            model (str): The deployment name
+            name (str, optional): The name reported for the backend. Defaults to openai.
+    """
+    def __init__(self, client, model, name='openai'):
+        self.client = client
+        self.model = model
+        self.name = name
+
+    async def complete(self, messages, max_tokens=100):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=to_dicts(messages),
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+    async def aclose(self):
+        await self.client.close()
+        await super().aclose()
+
+class InferenceBackend(ChatBackend):
+    """This class performs chat completions with the async Azure AI Inference ChatCompletionsClient
+        Args:
+            client (azure.ai.inference.aio.ChatCompletionsClient): The async chat completions client
+            model (str): The deployment name
+    """
+    name = 'inference'
+
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+
+    async def complete(self, messages, max_tokens=100):
+        response = await self.client.complete(
+            messages=to_inference(messages),
+            max_tokens=max_tokens,
+            model=self.model
+        )
+        return response.choices[0].message.content
+
+    async def aclose(self):
+        await self.client.close()
+        await super().aclose()
+
+class LangChainBackend(ChatBackend):
+    """This class performs chat completions with AzureChatOpenAI.ainvoke
+        Args:
+            llm (AzureChatOpenAI): The LangChain chat model
+    """
+    name = 'langchain'
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    async def complete(self, messages, max_tokens=100):
+        response = await self.llm.ainvoke(
+            to_langchain(messages),
+            max_tokens=max_tokens
+        )
+        return response.content
+
+class RestBackend(ChatBackend):
+    """This class performs chat completions against the v1 REST API with an httpx AsyncClient
+        Args:
+            endpoint (str): The Foundry endpoint
+            model (str): The deployment name
+            api_key (str, optional): The Foundry API key. Either api_key or token_provider must be provided.
+            token_provider (callable, optional): A sync or async function that returns an Entra ID access token.
+            max_connections (int, optional): The maximum number of open connections. Defaults to 100.
+    """
+    name = 'rest'
+
+    def __init__(self, endpoint, model, api_key=None, token_provider=None, max_connections=100):
+        import httpx
+
+        if not api_key and not token_provider:
+            raise ValueError('Either api_key or token_provider must be provided')
+        self.url = f"{endpoint.rstrip('/')}/openai/v1/chat/completions"
+        self.model = model
+        self._api_key = api_key
+        self._token_provider = token_provider
+        self.client = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def _headers(self):
+        if self._api_key:
+            return {'api-key': self._api_key}
+        token = self._token_provider()
+        if inspect.isawaitable(token):
+            token = await token
+        return {'Authorization': 'Bearer ' + token}
+
+    async def complete(self, messages, max_tokens=100):
+        response = await self.client.post(
+            self.url,
+            headers={'Content-Type': 'application/json', **await self._headers()},
+            content=request_body(messages, model=self.model, max_tokens=max_tokens)
+        )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
+    async def post_raw(self, body):
+        """This function sends a request body that is already serialized and returns the response without decoding it
+            so the JSON work can be done outside the event loop
+            Args:
+                body (bytes): The JSON request body
+            Returns:
+                tuple: The HTTP status code and the raw response body
+        """
+        headers = await self._headers()
+        headers['Content-Type'] = 'application/json'
+        response = await self.client.post(self.url, headers=headers, content=body)
+        return response.status_code, response.content
+
+    async def aclose(self):
+        await self.client.aclose()
+        await super().aclose()
+
+## This function builds a backend for one of the SDKs using an API key or an async Entra ID credential
+##
+def create_backend(sdk, endpoint, deployment, api_version=None, api_key=None, credential=None, max_connections=100):
+    """This function builds a backend for one of the SDKs
+        Args:
+            sdk (str): One of openai, openai-legacy, inference, langchain or rest
+            endpoint (str): The Foundry or Azure OpenAI endpoint
+            deployment (str): The deployment name
+            api_version (str, optional): The API version used by the legacy API, Azure AI Inference and LangChain
+            api_key (str, optional): The API key. Either api_key or credential must be provided.
+            credential (AsyncTokenCredential, optional): An azure.identity.aio credential
+            max_connections (int, optional): The maximum number of open connections used by the REST backend. Defaults to 100.
+        Returns:
+            ChatBackend: The backend
+    """
+    token_provider = None
+    if credential is not None:
+        from async_token_provider import get_cached_bearer_token_provider
+        token_provider = get_cached_bearer_token_provider(credential, SCOPE)
+    backend = _build_backend(sdk, endpoint, deployment, api_version, api_key, credential, token_provider, max_connections)
+    if token_provider is not None:
+        ## The backend stops the token refreshes when it is closed
+        backend.owned = (token_provider,)
+    return backend
+
+def _build_backend(sdk, endpoint, deployment, api_version, api_key, credential, token_provider, max_connections):
+    if sdk == 'openai':
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            base_url=f"{endpoint.rstrip('/')}/openai/v1",
+            api_key=api_key or token_provider
+        )
+        return OpenAIBackend(client, deployment)
+    if sdk == 'openai-legacy':
+        from openai import AsyncAzureOpenAI
+        if api_key:
+            client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key)
+        else:
+            client = AsyncAzureOpenAI(api_version=api_version, azure_endpoint=endpoint, azure_ad_token_provider=token_provider)
+        return OpenAIBackend(client, deployment, name='openai-legacy')
+    if sdk == 'inference':
+        from azure.ai.inference.aio import ChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        client = ChatCompletionsClient(
+            endpoint=f"{endpoint.rstrip('/')}/openai/deployments/{deployment}",
+            credential=AzureKeyCredential(api_key) if api_key else credential,
+            credential_scopes=[SCOPE],
+            api_version=api_version
+        )
+        return InferenceBackend(client, deployment)
+    if sdk == 'langchain':
+        from langchain_openai import AzureChatOpenAI
+        if api_key:
+            llm = AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, api_key=api_key)
+        else:
+            llm = AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, azure_ad_async_token_provider=token_provider)
+        return LangChainBackend(llm)
+    if sdk == 'rest':
+        return RestBackend(endpoint, deployment, api_key=api_key, token_provider=token_provider, max_connections=max_connections)
+    raise ValueError(f'Unknown SDK: {sdk}')
+
+async def _aiter(prompts):
+    if hasattr(prompts, '__aiter__'):
+        async for prompt in prompts:
+            yield prompt
+    else:
+        for prompt in prompts:
+            yield prompt
+
+async def _complete_one(backend, index, prompt, system_prompt, max_tokens):
+    ## The system prompt is one shared Message, so it is encoded or converted once for every prompt
+    messages = [system(system_prompt), user(prompt)] if system_prompt else [user(prompt)]
+    start = time.perf_counter()
+    try:
+        content = await backend.complete(messages, max_tokens=max_tokens)
+        error = None
+    except Exception as e:
+        logging.error(f"Failed chat completion for prompt {index}: {e!r}")
+        content = None
+        error = str(e)
+    return {
+        "index": index,
+        "prompt": prompt,
+        "content": content,
+        "error": error,
+        "latency": time.perf_counter() - start
+    }
+
+## This function runs a stream of prompts through a backend with a bounded number of requests in flight
+##
+async def run_prompts(backend, prompts, concurrency=8, system_prompt=DEFAULT_SYSTEM_PROMPT, max_tokens=100):
+    """This function runs a stream of prompts through a backend with a bounded number of requests in flight
+        Args:
+            backend (ChatBackend): The backend to send the prompts to
+            prompts (iterable): A sync or async iterable of prompt strings. It is consumed lazily.
+            concurrency (int, optional): The maximum number of requests in flight. Defaults to 8.
+            system_prompt (str, optional): The system message sent before each prompt.
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+        Yields:
+            dict: The index, prompt, content, error and latency of each request in completion order
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = set()
+
+    index = 0
+    try:
+        async for prompt in _aiter(prompts):
+            ## Waiting on the semaphore before reading the next prompt keeps the number of
+            ## prompts held in memory bounded by the concurrency limit
+            await semaphore.acquire()
+            task = asyncio.create_task(_complete_one(backend, index, prompt, system_prompt, max_tokens))
+            task.add_done_callback(lambda _: semaphore.release())
+            pending.add(task)
+            index += 1
+
+            for task in [t for t in pending if t.done()]:
+                pending.discard(task)
+                yield task.result()
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        ## A consumer that stops early leaves requests in flight, which are cancelled rather than left running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+## This function measures the throughput and latency of a backend
+##
+async def measure(backend, prompts, concurrency=8, max_tokens=100):
+    """This function measures the throughput and latency of a backend
+        Args:
+            backend (ChatBackend): The backend to measure
+            prompts (iterable): A sync or async iterable of prompt strings
+            concurrency (int, optional): The maximum number of requests in flight. Defaults to 8.
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+        Returns:
+            dict: The throughput and latency summary
+    """
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    async for result in run_prompts(backend, prompts, concurrency=concurrency, max_tokens=max_tokens):
+        latencies.append(result['latency'])
+        errors += result['error'] is not None
+    elapsed = time.perf_counter() - start
+    return {
+        "sdk": backend.name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+    }
+
+async def run(args, settings=None):
+    server = None
+    credential = None
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process(chat_latency=args.chat_latency)
+        settings = mock_settings(server.url)
+    profile = settings.profile()
+    if profile.auth_mode != 'api-key':
+        from azure.identity.aio import DefaultAzureCredential
+        credential = DefaultAzureCredential(managed_identity_client_id=settings.identity.managed_identity_client_id)
+
+    try:
+        for sdk in args.sdk:
+            backend = create_backend(
+                sdk, profile.endpoint, profile.deployment,
+                api_version=profile.api_version,
+                api_key=profile.api_key,
+                credential=credential,
+                max_connections=settings.pool_size
+            )
+            try:
+                prompts = (f"Tell me an interesting fact about the number {i}" for i in range(args.requests))
+                print(json.dumps(await measure(backend, prompts, concurrency=args.concurrency or settings.concurrency)))
+            finally:
+                await backend.aclose()
+    finally:
+        if credential is not None:
+            await credential.close()
+        if server is not None:
+            server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare async chat completion throughput across SDKs')
+    parser.add_argument('--sdk', nargs='+', default=['openai', 'openai-legacy', 'inference', 'langchain', 'rest'],
+                        choices=['openai', 'openai-legacy', 'inference', 'langchain', 'rest'])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, help='Defaults to CONCURRENCY or 16')
+    parser.add_argument('--mock', action='store_true', help='Run against the local mock server')
+    parser.add_argument('--chat-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME, OPENAI_API_VERSION and
+    ## optionally FOUNDRY_API_KEY. Without an API key DefaultAzureCredential is used.
+    settings = None
+    if not args.mock:
+        try:
+            settings = get_settings()
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+
+    asyncio.run(run(args, settings))
+
+if __name__ == "__main__":
+    main()
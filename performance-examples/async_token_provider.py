@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from utils import configure_logging, percentile
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+## This class is an async replacement for get_bearer_token_provider. Tokens are cached per scope and
+## refreshed by a background task once a fraction of their lifetime has passed, so callers are only
+## made to wait for a token when there is no valid one. Concurrent callers share one in-flight request.
+##
+class AsyncTokenProvider:
+    """This class caches access tokens from an azure.identity.aio credential and refreshes them in the background
+        Args:
+            credential (AsyncTokenCredential): An azure.identity.aio credential
+            refresh_fraction (float, optional): The share of the remaining lifetime after which a token is refreshed. Defaults to 0.5.
+            retry_delay (float, optional): Seconds to wait before retrying a failed background refresh. Defaults to 5.
+            min_refresh_interval (float, optional): The shortest time between background refreshes. Defaults to 1.
+            expiry_margin (float, optional): Seconds before expiry at which a token is no longer handed out. Defaults to 30.
+    """
+    def __init__(self, credential, refresh_fraction=0.5, retry_delay=5.0, min_refresh_interval=1.0, expiry_margin=30.0):
+        if not 0 < refresh_fraction < 1:
+            raise ValueError('refresh_fraction must be between 0 and 1')
+        self.credential = credential
+        self.refresh_fraction = refresh_fraction
+        self.retry_delay = retry_delay
+        self.min_refresh_interval = min_refresh_interval
+        self.expiry_margin = expiry_margin
+        self._tokens = {}
+        self._inflight = {}
+        self._refresh_tasks = {}
+        self._refresh_latencies = []
+        self._counts = {"hits": 0, "waits": 0, "refreshes": 0, "background_refreshes": 0, "failures": 0}
+        self._closed = False
+
+    def _valid(self, token):
+        return token is not None and token.expires_on - self.expiry_margin > time.time()
+
+    async def _fetch(self, scope):
+        start = time.perf_counter()
+        try:
+            token = await self.credential.get_token(scope)
+        except Exception:
+            self._counts['failures'] += 1
+            raise
+        finally:
+            self._refresh_latencies.append(time.perf_counter() - start)
+            ## Keep a bounded window of samples for the percentiles
+            if len(self._refresh_latencies) > 1000:
+                del self._refresh_latencies[:500]
+        self._counts['refreshes'] += 1
+        self._tokens[scope] = token
+        self._schedule_refresh(scope, token)
+        return token
+
+    def _refresh(self, scope):
+        ## All callers that need a token while a request is in flight await the same task
+        task = self._inflight.get(scope)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(scope))
+            self._inflight[scope] = task
+            task.add_done_callback(lambda _: self._inflight.pop(scope, None))
+        return task
+
+    def _schedule_refresh(self, scope, token):
+        if self._closed:
+            return
+        delay = max(self.min_refresh_interval, (token.expires_on - time.time()) * self.refresh_fraction)
+        previous = self._refresh_tasks.get(scope)
+        if previous is not None and previous is not asyncio.current_task():
+            previous.cancel()
+        self._refresh_tasks[scope] = asyncio.ensure_future(self._background_refresh(scope, delay))
+
+    async def _background_refresh(self, scope, delay):
+        while not self._closed:
+            await asyncio.sleep(delay)
+            try:
+                self._counts['background_refreshes'] += 1
+                await asyncio.shield(self._refresh(scope))
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                ## The cached token stays in use until it expires so keep retrying in the background
+                logging.warning(f'Background token refresh for {scope} failed. Retrying in {self.retry_delay}s', exc_info=True)
+                delay = self.retry_delay
+
+    async def get_token(self, scope=SCOPE):
+        """This function returns an access token for a scope
+            Args:
+                scope (str, optional): The scope of the token. Defaults to the Cognitive Services scope.
+            Returns:
+                str: The access token
+        """
+        token = self._tokens.get(scope)
+        if self._valid(token):
+            self._counts['hits'] += 1
+            return token.token
+        self._counts['waits'] += 1
+        token = await asyncio.shield(self._refresh(scope))
+        return token.token
+
+    def provider(self, scope=SCOPE):
+        """This function returns a bearer token provider for a scope that can be passed to AsyncOpenAI,
+            AsyncAzureOpenAI and AzureChatOpenAI in place of the one from get_bearer_token_provider
+            Args:
+                scope (str, optional): The scope of the token. Defaults to the Cognitive Services scope.
+            Returns:
+                token_provider: A coroutine function that returns an access token
+        """
+        async def token_provider():
+            return await self.get_token(scope)
+        return token_provider
+
+    def metrics(self):
+        """This function returns the cache and refresh counters and the refresh latency
+            Returns:
+                dict: The counters and the refresh latency percentiles in milliseconds
+        """
+        latencies = self._refresh_latencies
+        return {
+            **self._counts,
+            "refresh_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "refresh_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            "refresh_last_ms": round(latencies[-1] * 1000, 3) if latencies else None
+        }
+
+    async def close(self):
+        """This function stops the background refreshes. The credential is left open for its owner to close."""
+        self._closed = True
+        tasks = list(self._refresh_tasks.values()) + list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._refresh_tasks.clear()
+
+## This class is a bearer token provider that owns its AsyncTokenProvider, so whoever builds it can
+## stop the background refreshes with aclose() when the client it was given to is closed
+##
+class CachedBearerTokenProvider:
+    """This class is a cached async bearer token provider for one scope
+        Args:
+            token_provider (AsyncTokenProvider): The provider that caches and refreshes the tokens
+            scope (str): The scope of the token
+    """
+    def __init__(self, token_provider, scope):
+        self.token_provider = token_provider
+        self.scope = scope
+
+    async def __call__(self):
+        return await self.token_provider.get_token(self.scope)
+
+    async def aclose(self):
+        """This function stops the background refreshes. The credential is left open for its owner to close."""
+        await self.token_provider.close()
+
+## This function builds a bearer token provider backed by an AsyncTokenProvider
+##
+def get_cached_bearer_token_provider(credential, scope, refresh_fraction=0.5):
+    """This function builds a cached async bearer token provider
+        Args:
+            credential (AsyncTokenCredential): An azure.identity.aio credential
+            scope (str): The scope of the token
+            refresh_fraction (float, optional): The share of the remaining lifetime after which a token is refreshed. Defaults to 0.5.
+        Returns:
+            CachedBearerTokenProvider: A callable that returns an access token when awaited, with aclose() to stop its background refreshes
+    """
+    return CachedBearerTokenProvider(AsyncTokenProvider(credential, refresh_fraction=refresh_fraction), scope)
+
+## The demo compares the sync provider, the azure.identity.aio provider and the cached provider under
+## a steady stream of callers. A heartbeat task measures how long the event loop is blocked.
+##
+async def heartbeat(stalls, interval=0.005):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stalls.append(time.perf_counter() - start - interval)
+
+async def run_mode(mode, callers, duration, refresh_fraction):
+    from azure.identity import ManagedIdentityCredential as SyncManagedIdentityCredential
+    from azure.identity import get_bearer_token_provider as sync_provider
+    from azure.identity.aio import ManagedIdentityCredential, get_bearer_token_provider
+
+    cached = None
+    if mode == 'sync get_bearer_token_provider':
+        credential = SyncManagedIdentityCredential()
+        provider = sync_provider(credential, SCOPE)
+        get_token = lambda: asyncio.sleep(0, provider())
+    elif mode == 'aio get_bearer_token_provider':
+        credential = ManagedIdentityCredential()
+        get_token = get_bearer_token_provider(credential, SCOPE)
+    else:
+        credential = ManagedIdentityCredential()
+        cached = AsyncTokenProvider(credential, refresh_fraction=refresh_fraction)
+        get_token = cached.provider(SCOPE)
+
+    stalls = []
+    waits = []
+    monitor = asyncio.ensure_future(heartbeat(stalls))
+    deadline = time.perf_counter() + duration
+
+    async def caller():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await get_token()
+            waits.append(time.perf_counter() - start)
+            ## Emulates the time spent on the request the token is used for
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[caller() for _ in range(callers)])
+    monitor.cancel()
+    result = {
+        "mode": mode,
+        "token_requests": len(waits),
+        "caller_wait_p50_ms": round(percentile(waits, 50) * 1000, 3),
+        "caller_wait_p99_ms": round(percentile(waits, 99) * 1000, 3),
+        "caller_wait_max_ms": round(max(waits) * 1000, 3),
+        "loop_stall_max_ms": round(max(stalls) * 1000, 3)
+    }
+    if cached is not None:
+        result['provider'] = cached.metrics()
+        await cached.close()
+    close = credential.close()
+    if asyncio.iscoroutine(close):
+        await close
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare token providers under concurrent async callers')
+    parser.add_argument('--callers', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=6.0)
+    parser.add_argument('--token-latency', type=float, default=0.2, help='Seconds the mock identity endpoint takes to answer')
+    parser.add_argument('--token-lifetime', type=int, default=310, help='Lifetime of mock tokens. azure-identity refreshes tokens within 300 seconds of expiry.')
+    parser.add_argument('--refresh-fraction', type=float, default=0.01, help='Kept small so a background refresh happens during the demo')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+    server = start_mock_server_process(token_latency=args.token_latency, token_lifetime=args.token_lifetime)
+    os.environ['IDENTITY_ENDPOINT'] = f"{server.url}/msi/token"
+    os.environ['IDENTITY_HEADER'] = 'mock-identity-header'
+    try:
+        for mode in ('sync get_bearer_token_provider', 'aio get_bearer_token_provider', 'AsyncTokenProvider'):
+            print(json.dumps(asyncio.run(run_mode(mode, args.callers, args.duration, args.refresh_fraction))))
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
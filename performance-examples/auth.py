@@ -0,0 +1,118 @@
+import logging
+import sys
+
+## These are the authentication functions used by the OpenAI v1 samples collected in one place
+## so the performance examples can reuse them. The credential libraries are imported inside each
+## function so importing this module doesn't load msal and azure-identity for modes that don't use them.
+##
+
+## This function obtains an access token from Entra ID using a managed identity and optionally accepts a client id if a user-assigned managed identity is used
+##
+def authenticate_with_managed_identity(scope,mi_client_id=None):
+    """This function obtains an access token from Entra ID using a managed identity and optionally accepts a client id if a user-assigned managed identity is used
+        Args:
+            scope (str): The scope for which the access token is requested
+            mi_client_id (str, optional): The client id of the user-assigned managed identity. If not provided, the function will attempt to authenticate using the system-assigned managed identity. Defaults to None.
+        Returns:
+            token_provider: A token provider that can be used to obtain access tokens for the specified scope
+    """
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+
+    try:
+        token_provider = get_bearer_token_provider(
+            DefaultAzureCredential(
+                managed_identity_client_id=mi_client_id),
+            scope
+        ) 
+        return token_provider
+    except:
+        logging.error('Failed to obtain access token: ', exc_info=True)
+        sys.exit(1)
+
+## This function obtains an access token from Entra ID using a service principal with a client id and client secret
+##
+def authenticate_with_service_principal(scope):
+    """This function obtains an access token from Entra ID using a service principal with a client id and client secret
+        Args:
+            scope (str): The scope for which the access token is requested
+        Returns:
+            token_provider: A token provider that can be used to obtain access tokens for the specified scope
+    """
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+
+    try:
+        token_provider = get_bearer_token_provider(
+            DefaultAzureCredential(),
+            scope
+        ) 
+        return token_provider
+    except:
+        logging.error('Failed to obtain access token: ', exc_info=True)
+        sys.exit(1)
+
+
+def acquire_user_assertion(client_id, tenant_id, initial_scope):
+    """Acquire a user token via the device code flow to use as the user assertion in the OBO flow.
+        This prompts the user to sign in via browser.
+        Args:
+            client_id (str): The client ID of the middle-tier app registration
+            tenant_id (str): The Entra ID tenant ID
+            initial_scope (str): The scope for the initial token (the middle-tier app's scope)
+        Returns:
+            str: The access token to use as the user assertion in the OBO flow
+    """
+    import msal
+
+    try:
+        ## Create a public client app for the device code flow
+        ## Service principal's app registration must suppport public client flow
+        app = msal.PublicClientApplication(
+            client_id,
+            authority=f"https://login.microsoftonline.com/{tenant_id}",
+        )
+
+        ## Initiate the device code flow
+        flow = app.initiate_device_flow(scopes=[initial_scope])
+        if "user_code" not in flow:
+            logging.error(f"Failed to initiate device code flow: {flow.get('error_description')}")
+            sys.exit(1)
+
+        ## Display the message to the user so they can authenticate
+        print(flow["message"])
+
+        ## Wait for the user to complete the authentication
+        result = app.acquire_token_by_device_flow(flow)
+        if "access_token" in result:
+            return result["access_token"]
+        else:
+            logging.error(f"Failed to acquire user token: {result.get('error_description')}")
+            sys.exit(1)
+    except Exception:
+        logging.error('Failed to acquire user assertion: ', exc_info=True)
+        sys.exit(1)
+
+def authenticate_obo(tenant_id, client_id, client_secret, user_assertion, scope):
+    """Exchange a user assertion for an access token using the On-Behalf-Of flow via azure.identity.
+        Args:
+            tenant_id (str): The Entra ID tenant ID
+            client_id (str): The service principal client ID
+            client_secret (str): The service principal client secret
+            user_assertion (str): The incoming access token to exchange
+            scope (str): The scope for the downstream resource (e.g., Azure OpenAI)
+        Returns:
+            token_provider: A token provider that can be used to obtain access tokens for the specified scope
+    """
+    from azure.identity import OnBehalfOfCredential, get_bearer_token_provider
+
+    try:
+        credential = OnBehalfOfCredential(
+            tenant_id=tenant_id,
+            client_id=client_id,
+            client_secret=client_secret,
+            user_assertion=user_assertion
+        )
+        token_provider = get_bearer_token_provider(credential, scope)
+        return token_provider
+    except Exception:
+        logging.error('Failed to acquire OBO token: ', exc_info=True)
+        sys.exit(1)
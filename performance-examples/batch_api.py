@@ -0,0 +1,420 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+
+from batch_runner import InvalidRecord, build_messages, get_credential, read_prompts
+from settings import AUTH_MODES, ConfigurationError, get_settings, mock_settings
+from utils import configure_logging
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+## This class tracks a batch run in SQLite. Every prompt, the job it was packed into and its result are
+## recorded as the run progresses so a crashed run picks up where it stopped instead of resubmitting.
+##
+class BatchState:
+    """This class stores the prompts, jobs and results of a batch run in SQLite
+        Args:
+            path (str): The path of the SQLite database
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS requests (
+                line INTEGER PRIMARY KEY,
+                record_id TEXT,
+                body TEXT,
+                job INTEGER,
+                status TEXT NOT NULL,
+                content TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS requests_pending ON requests (status, line);
+            CREATE TABLE IF NOT EXISTS jobs (
+                job INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL,
+                input_file_id TEXT,
+                batch_id TEXT,
+                output_file_id TEXT,
+                error_file_id TEXT,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS run (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        ## The run id names the uploaded files and tags the batch jobs so a resumed run can find what a
+        ## crashed run created after its last commit
+        self.db.execute("INSERT OR IGNORE INTO run (key, value) VALUES ('run_id', ?)", (uuid.uuid4().hex,))
+        self.db.commit()
+        self.run_id = self.db.execute("SELECT value FROM run WHERE key = 'run_id'").fetchone()[0]
+
+    def next_line(self):
+        row = self.db.execute('SELECT MAX(line) FROM requests').fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def update_job(self, job, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f'UPDATE jobs SET {assignments} WHERE job = ?', (*fields.values(), job))
+        self.db.commit()
+
+    def jobs(self, statuses):
+        placeholders = ', '.join('?' for _ in statuses)
+        return self.db.execute(
+            f'SELECT job, status, input_file_id, batch_id, output_file_id, error_file_id FROM jobs WHERE status IN ({placeholders}) ORDER BY job',
+            tuple(statuses)
+        ).fetchall()
+
+    def counts(self):
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM requests GROUP BY status').fetchall())
+
+    def close(self):
+        self.db.close()
+
+def custom_id(line):
+    return f"line-{line}"
+
+def line_of(custom_id):
+    return int(custom_id.rsplit('-', 1)[1])
+
+## This function records the prompts of the input in the state database. Lines recorded by a previous
+## run are skipped so the input can be read again after a crash. Lines that can't be turned into a
+## request are recorded as failed so they get an error result instead of stopping the run.
+##
+def ingest(state, input_stream, model, max_tokens=100, commit_every=1000):
+    """This function records the prompts of the input in the state database
+        Args:
+            state (BatchState): The state of the run
+            input_stream (file): A text stream with one JSON object per line
+            model (str): The global batch deployment name
+            max_tokens (int, optional): The default maximum number of tokens to generate. Defaults to 100.
+            commit_every (int, optional): The number of lines per transaction. Defaults to 1000.
+        Returns:
+            int: The number of lines recorded by this call
+    """
+    rows = []
+    added = 0
+    for line, record in read_prompts(input_stream, skip=state.next_line()):
+        if record is None:
+            rows.append((line, None, None, 'skipped', None))
+        elif isinstance(record, InvalidRecord):
+            rows.append((line, None, None, 'failed', record.error))
+        else:
+            ## The id is stored as JSON so the output keeps its type
+            record_id = json.dumps(record['id']) if 'id' in record else None
+            try:
+                body = {"model": model, "messages": build_messages(record), "max_tokens": record.get('max_tokens', max_tokens)}
+                rows.append((line, record_id, json.dumps(body), 'pending', None))
+            except (KeyError, TypeError) as e:
+                rows.append((line, record_id, None, 'failed', f'Line {line} has no prompt or messages: {e!r}'))
+        if len(rows) >= commit_every:
+            state.db.executemany('INSERT INTO requests (line, record_id, body, status, error) VALUES (?, ?, ?, ?, ?)', rows)
+            state.db.commit()
+            added += len(rows)
+            rows = []
+    if rows:
+        state.db.executemany('INSERT INTO requests (line, record_id, body, status, error) VALUES (?, ?, ?, ?, ?)', rows)
+        state.db.commit()
+        added += len(rows)
+    return added
+
+def _job_file(state, job):
+    ## The file is rebuilt from the database so nothing but the state needs to survive a crash
+    lines = []
+    for line, body in state.db.execute('SELECT line, body FROM requests WHERE job = ? ORDER BY line', (job,)):
+        lines.append(json.dumps({"custom_id": custom_id(line), "method": "POST", "url": "/chat/completions", "body": json.loads(body)}))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def _job_filename(state, job):
+    return f"{state.run_id}-job-{job}.jsonl"
+
+## These functions look for the file or batch job a crashed run created but didn't get to record.
+## Jobs are tagged with the run id and job number, so a match can only come from this run.
+##
+def _find_uploaded_file(client, state, job):
+    filename = _job_filename(state, job)
+    for file in client.files.list(purpose="batch"):
+        if file.filename == filename:
+            return file.id
+    return None
+
+def _find_batch(client, state, job):
+    for batch in client.batches.list():
+        metadata = batch.metadata or {}
+        if metadata.get('run') == state.run_id and metadata.get('job') == str(job):
+            return batch
+    return None
+
+## This function packs pending prompts into batch input files, uploads them and creates the batch jobs.
+## Each step is recorded before the next one starts. A job a crashed run left packed or uploaded may
+## have reached the service after the last commit, so it is looked up by file name and batch metadata
+## before it is uploaded or submitted again.
+##
+def submit(client, state, max_requests_per_job=10000, max_bytes_per_job=100 * 1024 * 1024):
+    """This function packs pending prompts into batch jobs and submits them
+        Args:
+            client (OpenAI): The OpenAI v1 client
+            state (BatchState): The state of the run
+            max_requests_per_job (int, optional): The most prompts in one job. Defaults to 10000.
+            max_bytes_per_job (int, optional): The largest input file. Defaults to 100 MB, half the service limit.
+        Returns:
+            int: The number of jobs submitted
+    """
+    submitted = 0
+    resumed = {job for job, _, _, _, _, _ in state.jobs(('packed', 'uploaded'))}
+    while True:
+        ## Finish jobs a previous run packed but did not upload or submit
+        for job, status, input_file_id, _, _, _ in state.jobs(('packed', 'uploaded')):
+            if status == 'packed':
+                input_file_id = _find_uploaded_file(client, state, job) if job in resumed else None
+                if input_file_id is None:
+                    content = _job_file(state, job)
+                    input_file_id = client.files.create(file=(_job_filename(state, job), content), purpose="batch").id
+                state.update_job(job, status='uploaded', input_file_id=input_file_id)
+            batch = _find_batch(client, state, job) if job in resumed else None
+            if batch is None:
+                batch = client.batches.create(
+                    input_file_id=input_file_id,
+                    endpoint="/chat/completions",
+                    completion_window="24h",
+                    metadata={"run": state.run_id, "job": str(job)}
+                )
+            state.update_job(job, status=batch.status, batch_id=batch.id)
+            logging.warning(f'Submitted job {job} as {batch.id}')
+            submitted += 1
+
+        rows = state.db.execute(
+            "SELECT line, LENGTH(body) FROM requests WHERE status = 'pending' ORDER BY line LIMIT ?",
+            (max_requests_per_job,)
+        ).fetchall()
+        if not rows:
+            return submitted
+
+        ## Stop the job at the byte limit. The JSONL wrapper adds about 100 bytes per line.
+        total, last_line = 0, rows[0][0]
+        for line, size in rows:
+            if total + size + 100 > max_bytes_per_job and total:
+                break
+            total += size + 100
+            last_line = line
+        cursor = state.db.execute("INSERT INTO jobs (status, updated_at) VALUES ('packed', ?)", (time.time(),))
+        state.db.execute(
+            "UPDATE requests SET job = ?, status = 'submitted' WHERE status = 'pending' AND line <= ?",
+            (cursor.lastrowid, last_line)
+        )
+        state.db.commit()
+
+## This function records the results in an output or error file of a finished job. The file is read as a
+## stream so large result files don't have to fit in memory.
+##
+def collect(client, state, file_id, commit_every=1000):
+    """This function records the results of a batch output or error file
+        Args:
+            client (OpenAI): The OpenAI v1 client
+            state (BatchState): The state of the run
+            file_id (str): The output or error file
+            commit_every (int, optional): The number of results per transaction. Defaults to 1000.
+        Returns:
+            int: The number of results recorded
+    """
+    rows = []
+    recorded = 0
+    with client.files.with_streaming_response.content(file_id) as response:
+        for raw in response.iter_lines():
+            if not raw.strip():
+                continue
+            result = json.loads(raw)
+            response_body = (result.get('response') or {}).get('body') or {}
+            status_code = (result.get('response') or {}).get('status_code')
+            if status_code == 200:
+                rows.append(('done', response_body['choices'][0]['message']['content'], None, line_of(result['custom_id'])))
+            else:
+                error = result.get('error') or response_body.get('error') or {"message": f"status {status_code}"}
+                rows.append(('failed', None, error.get('message') or json.dumps(error), line_of(result['custom_id'])))
+            if len(rows) >= commit_every:
+                state.db.executemany('UPDATE requests SET status = ?, content = ?, error = ? WHERE line = ?', rows)
+                state.db.commit()
+                recorded += len(rows)
+                rows = []
+    state.db.executemany('UPDATE requests SET status = ?, content = ?, error = ? WHERE line = ?', rows)
+    state.db.commit()
+    return recorded + len(rows)
+
+## This function polls the submitted jobs with exponential backoff and collects the results of each job
+## as soon as it finishes
+##
+def poll(client, state, poll_interval=5.0, max_poll_interval=300.0):
+    """This function waits for the submitted jobs and records their results
+        Args:
+            client (OpenAI): The OpenAI v1 client
+            state (BatchState): The state of the run
+            poll_interval (float, optional): The first wait between polls in seconds. Defaults to 5.
+            max_poll_interval (float, optional): The longest wait between polls in seconds. Defaults to 300.
+    """
+    delay = poll_interval
+    while True:
+        active = state.jobs(('validating', 'in_progress', 'finalizing', 'cancelling') + TERMINAL_STATUSES)
+        if not active:
+            return
+        changed = False
+        for job, status, _, batch_id, output_file_id, error_file_id in active:
+            if status not in TERMINAL_STATUSES:
+                batch = client.batches.retrieve(batch_id)
+                if batch.status != status:
+                    changed = True
+                    logging.warning(f'Job {job} ({batch_id}) is {batch.status}')
+                status, output_file_id, error_file_id = batch.status, batch.output_file_id, batch.error_file_id
+                state.update_job(job, status=status, output_file_id=output_file_id, error_file_id=error_file_id)
+            if status in TERMINAL_STATUSES:
+                ## Expired and cancelled jobs can still have partial results
+                for file_id in (output_file_id, error_file_id):
+                    if file_id:
+                        collect(client, state, file_id)
+                state.db.execute(
+                    "UPDATE requests SET status = 'failed', error = ? WHERE job = ? AND status = 'submitted'",
+                    (f"Batch job {status} without a result", job)
+                )
+                state.update_job(job, status='collected')
+                changed = True
+        if not state.jobs(('validating', 'in_progress', 'finalizing', 'cancelling')):
+            return
+
+        ## Poll quickly while jobs are moving and back off while they are not
+        delay = poll_interval if changed else min(max_poll_interval, delay * 2)
+        time.sleep(delay * random.uniform(0.8, 1.2))
+
+## This function writes the results in input order in the same format as batch_runner. The Batch API
+## doesn't report the latency of each request so latency_ms is null for the requests sent to it.
+##
+def write_results(state, output_path):
+    """This function writes the results of the run in input order
+        Args:
+            state (BatchState): The state of the run
+            output_path (str): The path of the JSONL output file
+        Returns:
+            int: The number of results written
+    """
+    written = 0
+    temp_path = f"{output_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as output:
+        for line, record_id, body, status, content, error in state.db.execute(
+            "SELECT line, record_id, body, status, content, error FROM requests WHERE status IN ('done', 'failed') ORDER BY line"
+        ):
+            result = {"line": line}
+            if record_id is not None:
+                result["id"] = json.loads(record_id)
+            result["content"] = content
+            result["error"] = error
+            ## Lines that failed before they were sent took no time, as in batch_runner
+            result["latency_ms"] = None if body is not None else 0.0
+            output.write(json.dumps(result) + '\n')
+            written += 1
+    os.replace(temp_path, output_path)
+    return written
+
+def run(client, model, input_stream, output_path, state_path, max_requests_per_job=10000, max_tokens=100, poll_interval=5.0, max_poll_interval=300.0):
+    """This function runs the prompts of the input through the Batch API, resuming a previous run that used the same state file
+        Args:
+            client (OpenAI): The OpenAI v1 client
+            model (str): The global batch deployment name
+            input_stream (file): A text stream with one JSON object per line
+            output_path (str): The path of the JSONL output file
+            state_path (str): The path of the SQLite state database
+            max_requests_per_job (int, optional): The most prompts in one job. Defaults to 10000.
+            max_tokens (int, optional): The default maximum number of tokens to generate. Defaults to 100.
+            poll_interval (float, optional): The first wait between polls in seconds. Defaults to 5.
+            max_poll_interval (float, optional): The longest wait between polls in seconds. Defaults to 300.
+        Returns:
+            dict: The number of prompts in each status
+    """
+    state = BatchState(state_path)
+    try:
+        ingested = ingest(state, input_stream, model, max_tokens=max_tokens)
+        if ingested:
+            logging.info(f'Recorded {ingested} input lines')
+        jobs = submit(client, state, max_requests_per_job=max_requests_per_job)
+        logging.info(f'Submitted {jobs} jobs')
+        poll(client, state, poll_interval=poll_interval, max_poll_interval=max_poll_interval)
+        write_results(state, output_path)
+        return state.counts()
+    finally:
+        state.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run prompts from a JSONL file through the Batch API and write JSONL results')
+    parser.add_argument('--input', default='-', help='The JSONL input file or - for stdin')
+    parser.add_argument('--output', required=True, help='The JSONL output file')
+    parser.add_argument('--state', help='The SQLite state database. Defaults to the output file with a .state.db suffix')
+    parser.add_argument('--auth', choices=AUTH_MODES, help='Overrides AUTH_MODE')
+    parser.add_argument('--max-requests-per-job', type=int, default=10000)
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    parser.add_argument('--max-poll-interval', type=float, default=300.0)
+    parser.add_argument('--mock', action='store_true', help='Run against the local mock server')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("WARNING")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, BATCH_DEPLOYMENT_NAME and the variables used by the
+    ## selected authentication mode
+    server = None
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process(batch_latency=3.0)
+        settings = mock_settings(server.url)
+        args.poll_interval = min(args.poll_interval, 0.5)
+    else:
+        try:
+            settings = get_settings()
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+    profile = settings.profile()
+    if profile.batch_deployment is None:
+        logging.error('BATCH_DEPLOYMENT_NAME is not set')
+        sys.exit(1)
+
+    from openai import OpenAI
+
+    model, api_key = profile.batch_deployment, get_credential(args.auth or profile.auth_mode, settings)
+
+    try:
+        client = OpenAI(base_url=profile.base_url, api_key=api_key, max_retries=settings.max_retries, timeout=settings.request_timeout)
+        input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+        try:
+            counts = run(
+                client, model, input_stream, args.output,
+                args.state or f"{args.output}.state.db",
+                max_requests_per_job=args.max_requests_per_job,
+                max_tokens=args.max_tokens,
+                poll_interval=args.poll_interval,
+                max_poll_interval=args.max_poll_interval
+            )
+        finally:
+            if input_stream is not sys.stdin:
+                input_stream.close()
+        logging.warning(f'Finished: {json.dumps(counts)}')
+    except KeyboardInterrupt:
+        logging.warning('Interrupted. Run the same command again to resume from the state database')
+        sys.exit(130)
+    except Exception:
+        logging.error('Failed to run the batch: ', exc_info=True)
+        sys.exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
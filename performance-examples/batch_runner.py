@@ -0,0 +1,322 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import AUTH_MODES, ConfigurationError, get_settings, mock_settings
+from utils import configure_logging
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant that provides interesting facts."
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+## This class stands in for an input line that isn't a JSON object, so the line gets an error result
+## instead of one bad line stopping the whole run
+##
+class InvalidRecord:
+    """This class is the record of an input line that can't be decoded
+        Args:
+            error (str): Why the line can't be used
+    """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+## This function reads prompts one line at a time so memory stays flat regardless of input size
+##
+def read_prompts(stream, skip=0):
+    """This function lazily reads prompts from a JSONL stream
+        Args:
+            stream (file): A text stream with one JSON object per line. Each object has a prompt or messages field.
+            skip (int, optional): The number of lines to skip because they were processed by a previous run. Defaults to 0.
+        Yields:
+            tuple: The line number and the decoded JSON object, None for a blank line or an InvalidRecord for a line that isn't a JSON object
+    """
+    for line_number, line in enumerate(stream):
+        if line_number < skip:
+            continue
+        line = line.strip()
+        if not line:
+            yield line_number, None
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, InvalidRecord(f'Line {line_number} is not valid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield line_number, InvalidRecord(f'Line {line_number} is not a JSON object')
+            continue
+        yield line_number, record
+
+## This function builds the messages of a chat completion from an input record
+##
+def build_messages(record, system_prompt=DEFAULT_SYSTEM_PROMPT):
+    """This function builds the messages of a chat completion from an input record
+        Args:
+            record (dict): An input record with a prompt string or a list of messages
+            system_prompt (str, optional): The system message used when the record only has a prompt
+        Returns:
+            list: The chat messages
+    """
+    if 'messages' in record:
+        return record['messages']
+    return [
+        {"role": "system", "content": record.get('system', system_prompt)},
+        {"role": "user", "content": record['prompt']}
+    ]
+
+## This class records how far a run got so an interrupted run can resume where it stopped
+##
+class Checkpoint:
+    """This class records the number of input lines processed and the size of the output written for them
+        Args:
+            path (str): The path of the checkpoint file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """This function loads the checkpoint
+            Returns:
+                tuple: The number of input lines processed and the number of output bytes written for them
+        """
+        if not os.path.exists(self.path):
+            return 0, 0
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        return state['lines_done'], state['output_bytes']
+
+    def save(self, lines_done, output_bytes):
+        """This function atomically writes the checkpoint
+            Args:
+                lines_done (int): The number of input lines processed
+                output_bytes (int): The number of output bytes written for those lines
+        """
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({"lines_done": lines_done, "output_bytes": output_bytes}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+## This class reports throughput while a run is in progress
+##
+class ThroughputReporter:
+    """This class reports throughput while a run is in progress
+        Args:
+            interval (float, optional): Seconds between reports. Defaults to 5.
+    """
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.completed = 0
+        self.errors = 0
+        self._last_report = self.start
+        self._last_completed = 0
+
+    def record(self, error):
+        self.completed += 1
+        self.errors += error is not None
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval:
+            current = (self.completed - self._last_completed) / (now - self._last_report)
+            logging.warning(f'Processed {self.completed} prompts ({self.errors} errors) at {current:.1f}/s, {self.rate():.1f}/s overall')
+            self._last_report = now
+            self._last_completed = self.completed
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.completed / elapsed if elapsed else 0.0
+
+## This function builds the token provider or API key for the selected authentication mode
+## using the same authentication functions as the samples
+##
+def get_credential(auth_mode, settings):
+    """This function returns the api_key value to pass to the OpenAI client for an authentication mode
+        Args:
+            auth_mode (str): One of api-key, managed-identity, service-principal, obo or default
+            settings (Settings): The settings with the API key and Entra ID values
+        Returns:
+            str or callable: An API key or a token provider
+    """
+    identity = settings.identity
+    if auth_mode == 'api-key':
+        return settings.profile().api_key
+    if auth_mode == 'default':
+        from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+        return get_bearer_token_provider(DefaultAzureCredential(managed_identity_client_id=identity.managed_identity_client_id), SCOPE)
+
+    from auth import acquire_user_assertion, authenticate_obo, authenticate_with_managed_identity, authenticate_with_service_principal
+
+    if auth_mode == 'managed-identity':
+        return authenticate_with_managed_identity(scope=SCOPE, mi_client_id=identity.managed_identity_client_id)
+    if auth_mode == 'service-principal':
+        return authenticate_with_service_principal(scope=SCOPE)
+    if auth_mode == 'obo':
+        user_assertion = acquire_user_assertion(identity.client_id, identity.tenant_id, identity.initial_scope or f'{identity.client_id}/.default')
+        return authenticate_obo(identity.tenant_id, identity.client_id, identity.client_secret, user_assertion, scope=SCOPE)
+    raise ValueError(f'Unknown authentication mode: {auth_mode}')
+
+def _complete(client, model, line_number, record, max_tokens):
+    start = time.perf_counter()
+    result = {"line": line_number}
+    if isinstance(record, InvalidRecord):
+        logging.error(record.error)
+        result["content"] = None
+        result["error"] = record.error
+        result["latency_ms"] = 0.0
+        return result
+    if 'id' in record:
+        result["id"] = record['id']
+    try:
+        messages = build_messages(record)
+    except (KeyError, TypeError) as e:
+        logging.error(f'Line {line_number} has no prompt or messages: {e!r}')
+        result["content"] = None
+        result["error"] = f'Line {line_number} has no prompt or messages: {e!r}'
+        result["latency_ms"] = 0.0
+        return result
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=record.get('max_tokens', max_tokens)
+        )
+        result["content"] = response.choices[0].message.content
+        result["error"] = None
+    except Exception as e:
+        logging.error(f'Failed chat completion for line {line_number}: {e}')
+        result["content"] = None
+        result["error"] = str(e)
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+## This function runs every prompt of the input through the client and writes results in input order
+##
+def run_batch(client, model, input_stream, output_path, checkpoint, concurrency=8, max_tokens=100, checkpoint_every=100, report_interval=5.0):
+    """This function runs every prompt of the input through the client and writes results in input order
+        Args:
+            client (OpenAI): The OpenAI client
+            model (str): The deployment name
+            input_stream (file): A text stream with one JSON object per line
+            output_path (str): The path of the JSONL output file
+            checkpoint (Checkpoint): The checkpoint used to resume an interrupted run
+            concurrency (int, optional): The maximum number of requests in flight. Defaults to 8.
+            max_tokens (int, optional): The default maximum number of tokens to generate. Defaults to 100.
+            checkpoint_every (int, optional): The number of results between checkpoints. Defaults to 100.
+            report_interval (float, optional): Seconds between throughput reports. Defaults to 5.
+        Returns:
+            ThroughputReporter: The throughput of the run
+    """
+    lines_done, output_bytes = checkpoint.load()
+    if lines_done and not os.path.exists(output_path):
+        ## The results of the checkpointed lines are gone, so they are run again
+        logging.warning(f'{output_path} is missing, ignoring the checkpoint after {lines_done} lines')
+        lines_done, output_bytes = 0, 0
+    if lines_done:
+        logging.warning(f'Resuming after {lines_done} lines')
+
+    ## Drop any output written after the last checkpoint so resumed results are not duplicated
+    mode = 'r+' if os.path.exists(output_path) else 'w'
+    reporter = ThroughputReporter(report_interval)
+    with open(output_path, mode, encoding='utf-8') as output, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        output.seek(output_bytes)
+        output.truncate()
+
+        ## Futures are kept in input order and at most concurrency of them are in flight, so the
+        ## reorder buffer and the number of prompts held in memory are both bounded
+        in_flight = deque()
+
+        def drain_one():
+            nonlocal lines_done
+            line_number, future = in_flight.popleft()
+            if future is not None:
+                result = future.result()
+                output.write(json.dumps(result) + '\n')
+                reporter.record(result['error'])
+            lines_done = line_number + 1
+            if lines_done % checkpoint_every == 0:
+                output.flush()
+                checkpoint.save(lines_done, output.tell())
+
+        for line_number, record in read_prompts(input_stream, skip=lines_done):
+            if len(in_flight) >= concurrency:
+                drain_one()
+            future = pool.submit(_complete, client, model, line_number, record, max_tokens) if record is not None else None
+            in_flight.append((line_number, future))
+
+        while in_flight:
+            drain_one()
+
+        output.flush()
+        checkpoint.save(lines_done, output.tell())
+    return reporter
+
+def main():
+    parser = argparse.ArgumentParser(description='Run prompts from a JSONL file through chat completions and write JSONL results')
+    parser.add_argument('--input', default='-', help='The JSONL input file or - for stdin')
+    parser.add_argument('--output', required=True, help='The JSONL output file')
+    parser.add_argument('--checkpoint', help='The checkpoint file. Defaults to the output file with a .checkpoint suffix')
+    parser.add_argument('--auth', choices=AUTH_MODES, help='Overrides AUTH_MODE')
+    parser.add_argument('--concurrency', type=int, help='Defaults to CONCURRENCY or 16')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--checkpoint-every', type=int, default=100)
+    parser.add_argument('--mock', action='store_true', help='Run against the local mock server')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("WARNING")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME and the variables used by the
+    ## selected authentication mode
+    server = None
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process()
+        settings = mock_settings(server.url)
+    else:
+        try:
+            settings = get_settings()
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+    profile = settings.profile()
+    if profile.deployment is None:
+        logging.error('DEPLOYMENT_NAME is not set')
+        sys.exit(1)
+
+    from openai import OpenAI
+
+    model, api_key = profile.deployment, get_credential(args.auth or profile.auth_mode, settings)
+
+    try:
+        client = OpenAI(base_url=profile.base_url, api_key=api_key, max_retries=settings.max_retries, timeout=settings.request_timeout)
+        input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+        try:
+            reporter = run_batch(
+                client, model, input_stream, args.output,
+                Checkpoint(args.checkpoint or f"{args.output}.checkpoint"),
+                concurrency=args.concurrency or settings.concurrency,
+                max_tokens=args.max_tokens,
+                checkpoint_every=args.checkpoint_every
+            )
+        finally:
+            if input_stream is not sys.stdin:
+                input_stream.close()
+        logging.warning(f'Completed {reporter.completed} prompts ({reporter.errors} errors) at {reporter.rate():.1f}/s')
+    except KeyboardInterrupt:
+        logging.warning('Interrupted. Run the same command again to resume from the last checkpoint')
+        sys.exit(130)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import json
+import time
+import requests
+
+from http_client import FoundryHttpClient
+from mock_server import start_mock_server
+from utils import configure_logging, percentile
+
+## This benchmark compares the per-call requests.post used by the REST samples with the
+## pooled FoundryHttpClient over requests and over httpx against the local mock server
+##
+MESSAGES = [
+    {
+        "role": "user",
+        "content": "Tell me an interesting fact"
+    }
+]
+
+def run_per_call(url, requests_count):
+    latencies = []
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        response = requests.post(
+            url=f"{url}/openai/v1/chat/completions",
+            headers={'Content-Type': 'application/json', 'api-key': 'mock-key'},
+            json={"model": "gpt-4.1", "messages": MESSAGES, "max_tokens": 100}
+        )
+        json.loads(response.text)['choices'][0]['message']['content']
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def run_pooled(url, requests_count, transport='requests'):
+    latencies = []
+    with FoundryHttpClient(endpoint=url, api_key='mock-key', transport=transport) as client:
+        for _ in range(requests_count):
+            start = time.perf_counter()
+            client.chat_completion(MESSAGES, model="gpt-4.1", max_tokens=100).content
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+def run_pooled_httpx(url, requests_count):
+    return run_pooled(url, requests_count, transport='httpx')
+
+def summarize(name, latencies):
+    return {
+        "mode": name,
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "total_s": round(sum(latencies), 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-call requests.post with a pooled session and a pooled httpx client')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--chat-latency', type=float, default=0.0)
+    parser.add_argument('--connect-latency', type=float, default=0.02, help='Emulated TCP and TLS handshake time in seconds')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    server = start_mock_server(chat_latency=args.chat_latency, connect_latency=args.connect_latency)
+    try:
+        ## Warm up both paths so one-time import and DNS costs are not measured
+        run_per_call(server.url, 5)
+        run_pooled(server.url, 5)
+        run_pooled_httpx(server.url, 5)
+
+        results = []
+        for name, run in (('requests.post per call', run_per_call), ('pooled session', run_pooled), ('pooled httpx client', run_pooled_httpx)):
+            connections = server.counts.get('connection', 0)
+            result = summarize(name, run(server.url, args.requests))
+            result['connections_opened'] = server.counts.get('connection', 0) - connections
+            results.append(result)
+    finally:
+        server.shutdown()
+
+    for result in results:
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from utils import configure_logging, percentile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## This benchmark measures what each of the sample code paths costs: the time to import the SDK,
+## construct the client, acquire a token and send a request, and the memory the process ends up
+## using. Each case runs in a fresh interpreter so import times and memory are not shared between
+## cases. The mock server emulates the Entra ID token endpoint, the App Service managed identity
+## endpoint and both chat completions routes.
+##
+SCOPE = "https://cognitiveservices.azure.com/.default"
+DEPLOYMENT = "gpt-4.1"
+API_VERSION = "2024-10-21"
+API_KEY = "mock-key"
+
+MESSAGES = [
+    {
+        "role": "system",
+        "content": "You are a helpful assistant that provides interesting facts."
+    },
+    {
+        "role": "user",
+        "content": "Tell me an interesting fact"
+    }
+]
+
+## The SDK and authentication combinations used by the samples. The client credentials flow of the
+## REST sample is measured with a direct token request because MSAL only accepts https authorities.
+## The on-behalf-of flow goes through MSAL and the OBO token cache, with the requests for a fake
+## https authority sent to the mock server as obo_cache.py does.
+##
+CASES = [
+    ('openai', 'api-key'),
+    ('openai', 'managed-identity'),
+    ('openai', 'default-credential'),
+    ('openai', 'obo'),
+    ('openai-legacy', 'api-key'),
+    ('openai-legacy', 'managed-identity'),
+    ('openai-legacy', 'default-credential'),
+    ('inference', 'managed-identity'),
+    ('inference', 'default-credential'),
+    ('langchain', 'api-key'),
+    ('langchain', 'default-credential'),
+    ('rest', 'api-key'),
+    ('rest', 'client-credentials')
+]
+
+METRICS = ('import_ms', 'construct_ms', 'token_ms', 'token_repeat_ms', 'first_request_ms', 'request_p50_ms', 'request_p99_ms', 'overhead_ms', 'peak_rss_mb')
+
+def peak_rss_mb():
+    """This function returns the peak resident memory of the process
+        Returns:
+            float: The peak resident set size in MB or None where the resource module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Linux reports kilobytes and macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def import_sdk(sdk, auth):
+    """This function imports the modules a sample needs
+        Args:
+            sdk (str): The SDK of the case
+            auth (str): The authentication flow of the case
+    """
+    if auth in ('managed-identity', 'default-credential'):
+        import azure.identity  # noqa: F401
+    elif auth == 'obo':
+        import msal  # noqa: F401
+        import obo_cache  # noqa: F401
+    if sdk in ('openai', 'openai-legacy'):
+        import openai  # noqa: F401
+    elif sdk == 'inference':
+        import azure.ai.inference  # noqa: F401
+        import azure.ai.inference.models  # noqa: F401
+    elif sdk == 'langchain':
+        import langchain_openai  # noqa: F401
+        import langchain_core.messages  # noqa: F401
+    elif sdk == 'rest':
+        import requests  # noqa: F401
+        if auth == 'client-credentials':
+            import token_cache  # noqa: F401
+
+def build_credential(auth):
+    """This function builds the azure-identity credential of a case
+        Args:
+            auth (str): managed-identity or default-credential
+        Returns:
+            credential: The credential
+    """
+    from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
+    if auth == 'managed-identity':
+        return ManagedIdentityCredential()
+    return DefaultAzureCredential()
+
+## This function builds a token provider that exchanges a user assertion for a downstream token through
+## the OBO token cache. The first call performs the exchange and later calls are served from the cache.
+##
+def build_obo_token_provider(url):
+    """This function builds the token provider of the on-behalf-of case
+        Args:
+            url (str): The base URL of the mock server
+        Returns:
+            token_provider: A function that returns the downstream access token
+    """
+    from obo_cache import ConfidentialClientPool, LoopbackSession, OboTokenCache, fake_user_assertion
+    authority_host = 'login.mock.local'
+    pool = ConfidentialClientPool(
+        'mock-client-id',
+        'mock-client-secret',
+        f"https://{authority_host}/mock-tenant",
+        size=1,
+        http_client=LoopbackSession(authority_host, url),
+        instance_discovery=False
+    )
+    cache = OboTokenCache(pool)
+    user_assertion = fake_user_assertion('benchmark-user', lifetime=3600)
+    return lambda: cache.get_token(user_assertion, [SCOPE])
+
+## This function builds the client of a case the way the matching sample does
+##
+def build_client(sdk, auth, url):
+    """This function builds the client of a case
+        Args:
+            sdk (str): The SDK of the case
+            auth (str): The authentication flow of the case
+            url (str): The base URL of the mock server
+        Returns:
+            tuple: A function that acquires a token or None for API keys, a function that sends one
+                chat completion and a function that closes the client
+    """
+    if auth == 'obo':
+        token_provider = build_obo_token_provider(url)
+    elif sdk in ('openai', 'openai-legacy', 'langchain') and auth != 'api-key':
+        from azure.identity import get_bearer_token_provider
+        token_provider = get_bearer_token_provider(build_credential(auth), SCOPE)
+    else:
+        token_provider = None
+
+    if sdk == 'openai':
+        from openai import OpenAI
+        client = OpenAI(base_url=f"{url}/openai/v1", api_key=token_provider or API_KEY)
+        send = lambda: client.chat.completions.create(model=DEPLOYMENT, messages=MESSAGES, max_tokens=100).choices[0].message.content
+        return token_provider, send, client.close
+
+    if sdk == 'openai-legacy':
+        from openai import AzureOpenAI
+        if token_provider:
+            client = AzureOpenAI(api_version=API_VERSION, azure_endpoint=url, azure_ad_token_provider=token_provider)
+        else:
+            client = AzureOpenAI(api_version=API_VERSION, azure_endpoint=url, api_key=API_KEY)
+        send = lambda: client.chat.completions.create(model=DEPLOYMENT, messages=MESSAGES, max_tokens=100).choices[0].message.content
+        return token_provider, send, client.close
+
+    if sdk == 'inference':
+        from azure.ai.inference import ChatCompletionsClient
+        from azure.ai.inference.models import SystemMessage, UserMessage
+        credential = build_credential(auth)
+        client = ChatCompletionsClient(
+            endpoint=f"{url}/openai/deployments/{DEPLOYMENT}",
+            credential=credential,
+            credential_scopes=[SCOPE],
+            api_version=API_VERSION
+        )
+        messages = [SystemMessage(content=MESSAGES[0]['content']), UserMessage(content=MESSAGES[1]['content'])]
+
+        ## azure-core refuses to send bearer tokens over http unless enforce_https is turned off
+        send = lambda: client.complete(messages=messages, max_tokens=100, model=DEPLOYMENT, enforce_https=False).choices[0].message.content
+        return lambda: credential.get_token(SCOPE).token, send, client.close
+
+    if sdk == 'langchain':
+        from langchain_openai import AzureChatOpenAI
+        from langchain_core.messages import HumanMessage, SystemMessage
+        if token_provider:
+            llm = AzureChatOpenAI(azure_endpoint=url, azure_deployment=DEPLOYMENT, api_version=API_VERSION, azure_ad_token_provider=token_provider)
+        else:
+            llm = AzureChatOpenAI(azure_endpoint=url, azure_deployment=DEPLOYMENT, api_version=API_VERSION, api_key=API_KEY)
+        messages = [SystemMessage(content=MESSAGES[0]['content']), HumanMessage(content=MESSAGES[1]['content'])]
+        send = lambda: llm.invoke(messages, max_tokens=100).content
+        return token_provider, send, lambda: None
+
+    if sdk == 'rest':
+        import requests
+        get_token = None
+        if auth == 'client-credentials':
+            from token_cache import http_token_fetcher
+            fetch_token = http_token_fetcher('mock-client-id', 'mock-client-secret', 'mock-tenant', [SCOPE], authority_host=url)
+            get_token = lambda: fetch_token()[0]
+
+        ## The REST samples send each request with requests.post and no shared session
+        def send():
+            headers = {'Content-Type': 'application/json'}
+            if get_token:
+                headers['Authorization'] = 'Bearer ' + get_token()
+            else:
+                headers['api-key'] = API_KEY
+            response = requests.post(
+                url=f"{url}/openai/v1/chat/completions",
+                headers=headers,
+                json={"model": DEPLOYMENT, "messages": MESSAGES, "max_tokens": 100}
+            )
+            response.raise_for_status()
+            return response.json()['choices'][0]['message']['content']
+        return get_token, send, lambda: None
+
+    raise ValueError(f'Unknown SDK: {sdk}')
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+## This function measures one case. It runs in a fresh interpreter started by run_case.
+##
+def measure_case(sdk, auth, url, requests_count, chat_latency):
+    """This function measures the cost of one case
+        Args:
+            sdk (str): The SDK of the case
+            auth (str): The authentication flow of the case
+            url (str): The base URL of the mock server
+            requests_count (int): The number of chat completions used to measure per-request latency
+            chat_latency (float): The latency of the mock server which is subtracted to get the client overhead
+        Returns:
+            dict: The measurements in milliseconds and MB
+    """
+    result = {"sdk": sdk, "auth": auth, "baseline_rss_mb": peak_rss_mb()}
+    result['import_ms'] = timed(lambda: import_sdk(sdk, auth))
+
+    start = time.perf_counter()
+    get_token, send, close = build_client(sdk, auth, url)
+    result['construct_ms'] = (time.perf_counter() - start) * 1000
+
+    if get_token:
+        result['token_ms'] = timed(get_token)
+        result['token_repeat_ms'] = timed(get_token)
+
+    try:
+        result['first_request_ms'] = timed(send)
+        latencies = [timed(send) for _ in range(requests_count)]
+    finally:
+        close()
+    result['request_p50_ms'] = percentile(latencies, 50)
+    result['request_p99_ms'] = percentile(latencies, 99)
+    result['overhead_ms'] = result['request_p50_ms'] - chat_latency * 1000
+    result['peak_rss_mb'] = peak_rss_mb()
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}
+
+## This function runs one case in a child interpreter pointed at the mock server
+##
+def run_case(sdk, auth, url, requests_count, chat_latency):
+    """This function runs one case in a child interpreter
+        Args:
+            sdk (str): The SDK of the case
+            auth (str): The authentication flow of the case
+            url (str): The base URL of the mock server
+            requests_count (int): The number of chat completions used to measure per-request latency
+            chat_latency (float): The latency of the mock server
+        Returns:
+            dict: The measurements of the case
+    """
+    env = dict(os.environ)
+
+    ## Point managed identity at the mock server and make sure DefaultAzureCredential does not find a
+    ## service principal or workload identity in the environment first
+    for name in ('AZURE_CLIENT_ID', 'AZURE_CLIENT_SECRET', 'AZURE_TENANT_ID', 'AZURE_FEDERATED_TOKEN_FILE', 'MSI_ENDPOINT', 'MSI_SECRET'):
+        env.pop(name, None)
+    env['IDENTITY_ENDPOINT'] = f"{url}/msi/token"
+    env['IDENTITY_HEADER'] = 'mock-identity-header'
+
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--case', sdk, auth, '--url', url,
+         '--requests', str(requests_count), '--chat-latency', str(chat_latency)],
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        timeout=600
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f'Case {sdk} {auth} failed: {completed.stderr.strip()}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def summarize(runs):
+    """This function takes the median of each measurement over repeated runs of a case
+        Args:
+            runs (list): The results of each run of the case
+        Returns:
+            dict: The median of each measurement
+    """
+    summary = {"sdk": runs[0]['sdk'], "auth": runs[0]['auth'], "runs": len(runs)}
+    for metric in ('baseline_rss_mb',) + METRICS:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        if values:
+            summary[metric] = round(statistics.median(values), 3)
+    return summary
+
+def package_versions():
+    from importlib import metadata
+    versions = {}
+    for package in ('openai', 'azure-identity', 'azure-ai-inference', 'azure-core', 'langchain-openai', 'msal', 'requests', 'httpx'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+## This function compares results to a baseline file and returns the measurements that regressed
+##
+def compare(results, baseline, threshold, min_delta_ms=1.0, sdks=None):
+    """This function compares results to a baseline
+        Args:
+            results (list): The summarized results
+            baseline (dict): The contents of a previous results file
+            threshold (float): The relative increase that counts as a regression such as 0.2 for 20%
+            min_delta_ms (float, optional): Increases smaller than this are ignored as noise. Defaults to 1.
+            sdks (list, optional): The SDKs whose cases were run. Defaults to every SDK of the baseline.
+        Returns:
+            list: The regressions found
+    """
+    previous = {(r['sdk'], r['auth']): r for r in baseline.get('results', [])}
+    regressions = []
+
+    ## A case that ran in the baseline and has no result now is broken, which is the worst regression
+    current = {(r['sdk'], r['auth']) for r in results}
+    for sdk, auth in previous:
+        if (sdk, auth) not in current and (not sdks or sdk in sdks):
+            regressions.append({"sdk": sdk, "auth": auth, "metric": "missing", "baseline": None, "current": None})
+    for result in results:
+        before = previous.get((result['sdk'], result['auth']))
+        if not before:
+            continue
+        for metric in METRICS:
+            old, new = before.get(metric), result.get(metric)
+            if old is None or new is None or old <= 0:
+                continue
+            if new > old * (1 + threshold) and (metric == 'peak_rss_mb' or new - old >= min_delta_ms):
+                regressions.append({"sdk": result['sdk'], "auth": result['auth'], "metric": metric, "baseline": old, "current": new})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import, construction, token, request and memory cost of each sample code path')
+    parser.add_argument('--sdk', nargs='+', help='Only run the cases of these SDKs')
+    parser.add_argument('--requests', type=int, default=50, help='Chat completions sent per case after the first')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case. The median of each measurement is reported.')
+    parser.add_argument('--chat-latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    parser.add_argument('--connect-latency', type=float, default=0.0)
+    parser.add_argument('--output', default='benchmark-results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='A previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative increase over the baseline reported as a regression')
+    parser.add_argument('--case', nargs=2, metavar=('SDK', 'AUTH'), help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    ## Child mode measures a single case and prints it as JSON
+    if args.case:
+        configure_logging("ERROR")
+        print(json.dumps(measure_case(args.case[0], args.case[1], args.url, args.requests, args.chat_latency)))
+        return
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+    server = start_mock_server_process(
+        chat_latency=args.chat_latency,
+        token_latency=args.token_latency,
+        connect_latency=args.connect_latency
+    )
+    cases = [(sdk, auth) for sdk, auth in CASES if not args.sdk or sdk in args.sdk]
+    results = []
+    failed = []
+    try:
+        for sdk, auth in cases:
+            try:
+                runs = [run_case(sdk, auth, server.url, args.requests, args.chat_latency) for _ in range(args.repeat)]
+            except Exception:
+                logging.error(f'Failed to benchmark {sdk} with {auth}: ', exc_info=True)
+                failed.append({"sdk": sdk, "auth": auth})
+                continue
+            results.append(summarize(runs))
+            print(json.dumps(results[-1]))
+    finally:
+        server.shutdown()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "packages": package_versions(),
+        "settings": {
+            "requests": args.requests,
+            "repeat": args.repeat,
+            "chat_latency": args.chat_latency,
+            "token_latency": args.token_latency,
+            "connect_latency": args.connect_latency
+        },
+        "results": results,
+        "failed": failed
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold, sdks=args.sdk)
+        for regression in regressions:
+            print(json.dumps({"regression": regression}))
+    if regressions or failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
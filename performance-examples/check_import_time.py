@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils import configure_logging
+
+## This script runs the unified CLI under python -X importtime for every SDK and authentication mode
+## against the mock server and fails when a mode imports more than its budget or loads a library it
+## doesn't use. Each mode runs twice with the same token cache. The first run fetches a token and the
+## second is what a cron job sees once a token is cached.
+##
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+## Import time budgets in milliseconds for the first run of each mode, measured with -X importtime
+## which adds some overhead of its own. Scale them with --scale on slower machines.
+##
+BUDGETS = {
+    'rest': 150,
+    'openai': 1200,
+    'openai-legacy': 1200,
+    'inference': 500,
+    'langchain': 2500
+}
+AUTH_BUDGETS = {
+    'api-key': 0,
+    'service-principal': 50,
+    'managed-identity': 400
+}
+
+## The libraries each SDK and authentication mode may load. Anything else in HEAVY_MODULES is a regression.
+##
+HEAVY_MODULES = ('openai', 'langchain_openai', 'langchain_core', 'azure.ai.inference', 'azure.core', 'azure.identity', 'msal', 'requests', 'httpx', 'httpx2')
+SDK_MODULES = {
+    'rest': set(),
+    'openai': {'openai', 'httpx', 'httpx2'},
+    'openai-legacy': {'openai', 'httpx', 'httpx2'},
+    'inference': {'azure.ai.inference', 'azure.core', 'requests'},
+    'langchain': {'langchain_openai', 'langchain_core', 'openai', 'httpx', 'httpx2', 'requests'}
+}
+AUTH_MODULES = {
+    'api-key': set(),
+    'service-principal': set(),
+    'managed-identity': {'azure.identity', 'azure.core', 'msal', 'requests'}
+}
+
+def parse_importtime(stderr):
+    """This function reads the output of python -X importtime
+        Args:
+            stderr (str): The standard error of the process
+        Returns:
+            tuple: The total import time in milliseconds, the set of modules imported and the top-level imports with their cumulative time
+    """
+    total_us = 0
+    modules = set()
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        indent = len(name) - len(name.lstrip()) - 1
+        name = name.strip()
+        modules.add(name)
+        if indent == 0:
+            total_us += int(cumulative)
+            top_level.append((name, int(cumulative) / 1000))
+    return total_us / 1000, modules, top_level
+
+def heavy_imports(modules):
+    return sorted(heavy for heavy in HEAVY_MODULES if heavy in modules)
+
+def run_mode(sdk, auth, env):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.join(HERE, 'cli.py'), '--sdk', sdk, '--auth', auth, '--no-dotenv'],
+        cwd=HERE, env=env, capture_output=True, text=True, timeout=120
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f'{sdk} {auth} failed: {result.stdout[-2000:]}')
+    import_ms, modules, top_level = parse_importtime(result.stderr)
+    return {
+        "import_ms": round(import_ms, 1),
+        "wall_ms": round(wall_ms, 1),
+        "heavy_imports": heavy_imports(modules),
+        "top_imports": [name for name, _ in sorted(top_level, key=lambda item: -item[1])[:5]]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the start-up import cost of each CLI mode against a budget')
+    parser.add_argument('--sdk', nargs='+', default=list(BUDGETS), choices=list(BUDGETS))
+    parser.add_argument('--auth', nargs='+', default=list(AUTH_BUDGETS), choices=list(AUTH_BUDGETS))
+    parser.add_argument('--repeat', type=int, default=3, help='The fastest of this many runs is compared with the budget')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies every budget')
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+    server = start_mock_server_process()
+    env = {
+        **os.environ,
+        'FOUNDRY_ENDPOINT': server.url,
+        'DEPLOYMENT_NAME': 'gpt-4.1',
+        'FOUNDRY_API_KEY': 'mock-key',
+        'IDENTITY_ENDPOINT': f"{server.url}/msi/token",
+        'IDENTITY_HEADER': 'mock-identity-header',
+        'AZURE_AUTHORITY_HOST': server.url,
+        'AZURE_TENANT_ID': 'mock-tenant',
+        'AZURE_CLIENT_ID': 'mock-client-id',
+        'AZURE_CLIENT_SECRET': 'mock-client-secret'
+    }
+
+    results = []
+    failures = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for sdk in args.sdk:
+                for auth in args.auth:
+                    budget = (BUDGETS[sdk] + AUTH_BUDGETS[auth]) * args.scale
+                    runs = {'first': [], 'cached': []}
+                    for attempt in range(args.repeat):
+                        ## A new token cache per attempt so the first run always fetches a token
+                        env['TOKEN_CACHE_PATH'] = os.path.join(directory, f"{sdk}-{auth}-{attempt}.db")
+                        runs['first'].append(run_mode(sdk, auth, env))
+                        runs['cached'].append(run_mode(sdk, auth, env))
+
+                    for run, measurements in runs.items():
+                        fastest = min(measurements, key=lambda m: m['import_ms'])
+                        allowed = SDK_MODULES[sdk] | (AUTH_MODULES[auth] if run == 'first' else set())
+                        unexpected = sorted(set(fastest['heavy_imports']) - allowed)
+                        result = {"sdk": sdk, "auth": auth, "run": run, "budget_ms": round(budget, 1), **fastest, "unexpected_imports": unexpected}
+                        if fastest['import_ms'] > budget:
+                            failures.append(f"{sdk} {auth} {run} run imported for {fastest['import_ms']} ms, over the {budget:.0f} ms budget")
+                        if unexpected:
+                            failures.append(f"{sdk} {auth} {run} run imported {', '.join(unexpected)}")
+                        results.append(result)
+                        print(json.dumps(result))
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
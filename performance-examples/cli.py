@@ -0,0 +1,228 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from settings import DEFAULT_API_VERSION, ConfigurationError, load_settings
+from utils import configure_logging
+
+## This is a single entry point for every SDK and authentication mode of the samples. Only the standard
+## library is imported at start-up. The SDK and credential libraries are imported once the mode is known
+## so a short-lived run only pays for the libraries it uses.
+##
+SDKS = ('openai', 'openai-legacy', 'inference', 'langchain', 'rest')
+AUTH_MODES = ('api-key', 'managed-identity', 'service-principal', 'obo')
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+## This function builds the token fetcher of the service principal and managed identity modes. The
+## fetcher returns the token with its expiry so callers can cache it.
+##
+def get_token_fetcher(auth, identity):
+    """This function builds a token fetcher for an authentication mode
+        Args:
+            auth (str): managed-identity or service-principal
+            identity (Identity): The Entra ID settings
+        Returns:
+            tuple: The cache key of the token and a function that returns a tuple of (access_token, expires_on)
+    """
+    if auth == 'service-principal':
+        from token_cache import http_token_fetcher
+        ## The client credentials grant is posted with the standard library instead of MSAL
+        fetch_token = http_token_fetcher(
+            identity.client_id,
+            identity.client_secret,
+            identity.tenant_id,
+            [SCOPE],
+            authority_host=identity.authority_host
+        )
+        return f"{identity.authority_host}|{identity.tenant_id}|{identity.client_id}|{SCOPE}", fetch_token
+    if auth == 'managed-identity':
+        credential = []
+
+        def fetch_token():
+            ## azure-identity is only imported when the cache has no usable token
+            if not credential:
+                from credential_selector import build_credential
+                credential.append(build_credential('managed-identity', {'managed_identity_client_id': identity.managed_identity_client_id}))
+            token = credential[0].get_token(SCOPE)
+            return token.token, token.expires_on
+        return f"managed-identity|{identity.managed_identity_client_id}|{SCOPE}", fetch_token
+    raise ValueError(f'Unknown authentication mode: {auth}')
+
+## This function builds the token provider of an Entra ID authentication mode. Tokens for managed
+## identity and service principals go through the token cache so a run started by cron reuses the
+## token of the previous run when TOKEN_CACHE_PATH is set, and then imports no credential library.
+##
+def get_token_provider(auth, settings):
+    """This function builds a token provider for an authentication mode
+        Args:
+            auth (str): managed-identity, service-principal or obo
+            settings (Settings): The settings with the Entra ID identity and the token cache path
+        Returns:
+            token_provider: A function that returns an access token
+    """
+    identity = settings.identity
+    if auth == 'obo':
+        from auth import acquire_user_assertion, authenticate_obo
+        user_assertion = acquire_user_assertion(identity.client_id, identity.tenant_id, identity.initial_scope or f'{identity.client_id}/.default')
+        return authenticate_obo(identity.tenant_id, identity.client_id, identity.client_secret, user_assertion, scope=SCOPE)
+
+    from token_cache import get_default_cache
+    key, fetch_token = get_token_fetcher(auth, identity)
+    cache = get_default_cache(settings)
+    return lambda: cache.get_token(key, fetch_token)
+
+## Azure AI Inference takes a credential rather than a token provider
+##
+class _ProviderCredential:
+    def __init__(self, token_provider):
+        self.token_provider = token_provider
+
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        ## The token cache only hands out tokens with more than its refresh margin left, so azure-core
+        ## is told the token expires soon and asks again on each request, which the cache answers
+        return AccessToken(self.token_provider(), int(time.time()) + 300)
+
+def _complete_rest(endpoint, deployment, messages, max_tokens, api_key, token_provider):
+    ## The standard library client keeps the REST mode free of third-party imports
+    import urllib.request
+    headers = {'Content-Type': 'application/json'}
+    if api_key:
+        headers['api-key'] = api_key
+    else:
+        headers['Authorization'] = 'Bearer ' + token_provider()
+    request = urllib.request.Request(
+        f"{endpoint.rstrip('/')}/openai/v1/chat/completions",
+        data=json.dumps({"model": deployment, "messages": messages, "max_tokens": max_tokens}).encode('utf-8'),
+        headers=headers,
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())['choices'][0]['message']['content']
+
+## This function performs a chat completion with the selected SDK, importing it on first use
+##
+def complete(sdk, endpoint, deployment, messages, max_tokens=100, api_version=DEFAULT_API_VERSION, api_key=None, token_provider=None):
+    """This function performs a chat completion with one of the SDKs
+        Args:
+            sdk (str): One of openai, openai-legacy, inference, langchain or rest
+            endpoint (str): The Foundry or Azure OpenAI endpoint
+            deployment (str): The deployment name
+            messages (list): The chat messages as dicts with role and content
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+            api_version (str, optional): The API version used by the legacy API, Azure AI Inference and LangChain
+            api_key (str, optional): The API key. Either api_key or token_provider must be provided.
+            token_provider (callable, optional): A function that returns an access token
+        Returns:
+            str: The content of the assistant message
+    """
+    if sdk == 'rest':
+        return _complete_rest(endpoint, deployment, messages, max_tokens, api_key, token_provider)
+    if sdk == 'openai':
+        from openai import OpenAI
+        client = OpenAI(base_url=f"{endpoint.rstrip('/')}/openai/v1", api_key=api_key or token_provider)
+        with client:
+            response = client.chat.completions.create(model=deployment, messages=messages, max_tokens=max_tokens)
+        return response.choices[0].message.content
+    if sdk == 'openai-legacy':
+        from openai import AzureOpenAI
+        if api_key:
+            client = AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key)
+        else:
+            client = AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, azure_ad_token_provider=token_provider)
+        with client:
+            response = client.chat.completions.create(model=deployment, messages=messages, max_tokens=max_tokens)
+        return response.choices[0].message.content
+    if sdk == 'inference':
+        from azure.ai.inference import ChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        client = ChatCompletionsClient(
+            endpoint=f"{endpoint.rstrip('/')}/openai/deployments/{deployment}",
+            credential=AzureKeyCredential(api_key) if api_key else _ProviderCredential(token_provider),
+            credential_scopes=[SCOPE],
+            api_version=api_version
+        )
+        ## azure-core refuses to send bearer tokens over http, which only the local mock server uses
+        options = {} if api_key or endpoint.startswith('https') else {'enforce_https': False}
+        with client:
+            response = client.complete(messages=messages, max_tokens=max_tokens, model=deployment, **options)
+        return response.choices[0].message.content
+    if sdk == 'langchain':
+        from langchain_openai import AzureChatOpenAI
+        if api_key:
+            llm = AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, api_key=api_key)
+        else:
+            llm = AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, azure_ad_token_provider=token_provider)
+        return llm.invoke([(m['role'], m['content']) for m in messages], max_tokens=max_tokens).content
+    raise ValueError(f'Unknown SDK: {sdk}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Perform a chat completion with any SDK and authentication mode used by the samples')
+    parser.add_argument('--sdk', default='openai', choices=SDKS)
+    parser.add_argument('--auth', choices=AUTH_MODES, help='Overrides AUTH_MODE')
+    parser.add_argument('--prompt', default='Tell me an interesting fact')
+    parser.add_argument('--system', default='You are a helpful assistant that provides interesting facts.')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--endpoint', help='Overrides FOUNDRY_ENDPOINT')
+    parser.add_argument('--deployment', help='Overrides DEPLOYMENT_NAME')
+    parser.add_argument('--api-version', help='Overrides OPENAI_API_VERSION')
+    parser.add_argument('--no-dotenv', action='store_true', help='Do not read a .env file')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    ## Load and validate the settings from the environment and the .env file. The variables loaded include
+    ## FOUNDRY_ENDPOINT, DEPLOYMENT_NAME, OPENAI_API_VERSION and the variables used by the selected
+    ## authentication mode. The command line options replace the matching variables.
+    overrides = {
+        'FOUNDRY_ENDPOINT': args.endpoint,
+        'DEPLOYMENT_NAME': args.deployment,
+        'OPENAI_API_VERSION': args.api_version,
+        'AUTH_MODE': args.auth
+    }
+    try:
+        settings = load_settings(dotenv_path=None if args.no_dotenv else '.env', overrides={k: v for k, v in overrides.items() if v})
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+    profile = settings.profile()
+    if profile.auth_mode not in AUTH_MODES:
+        logging.error(f"The CLI doesn't support {profile.auth_mode} authentication. Set --auth or AUTH_MODE to one of {', '.join(AUTH_MODES)}")
+        sys.exit(1)
+
+    api_key = None
+    token_provider = None
+    if profile.auth_mode == 'api-key':
+        api_key = profile.api_key
+    else:
+        try:
+            token_provider = get_token_provider(profile.auth_mode, settings)
+        except Exception:
+            logging.error('Failed to obtain access token: ', exc_info=True)
+            sys.exit(1)
+
+    messages = [
+        {"role": "system", "content": args.system},
+        {"role": "user", "content": args.prompt}
+    ]
+    try:
+        print(complete(
+            args.sdk,
+            profile.endpoint,
+            profile.deployment,
+            messages,
+            max_tokens=args.max_tokens,
+            api_version=profile.api_version,
+            api_key=api_key,
+            token_provider=token_provider
+        ))
+    except Exception:
+        logging.error('Failed chat completion: ', exc_info=True)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+import argparse
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+from settings import AUTH_MODES, get_settings, mock_settings
+from utils import configure_logging, percentile
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+## This class builds each client and credential once and hands the same object to every caller.
+## Clients hold connection pools and credentials hold token caches, so building them per request
+## throws away pooled connections and cached tokens and repeats the credential chain probing.
+##
+class ClientFactory:
+    """This class memoizes SDK clients and credentials
+        Args:
+            managed_identity_client_id (str, optional): The client id of a user-assigned managed identity
+            instrumentation (Instrumentation, optional): Records construction, token and request metrics of the clients. Defaults to None.
+    """
+    def __init__(self, managed_identity_client_id=None, instrumentation=None):
+        self.managed_identity_client_id = managed_identity_client_id
+        self.instrumentation = instrumentation
+        self._objects = {}
+        self._lock = threading.RLock()
+        self._closed = False
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _get(self, key, build):
+        ## Construction is synchronous for every SDK so a thread lock also keeps coroutines from
+        ## building the same client twice. Nothing awaits while the lock is held.
+        client = self._objects.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The client factory has been closed')
+            client = self._objects.get(key)
+            if client is None:
+                if self.instrumentation is not None and not key[0].endswith('token-provider'):
+                    auth = next((part for part in key if part in AUTH_MODES), 'none')
+                    with self.instrumentation.construction(key[0], auth):
+                        client = build()
+                else:
+                    client = build()
+                self._objects[key] = client
+            return client
+
+    @staticmethod
+    def _key_id(auth, api_key):
+        ## Clients built with different API keys are different clients. The key is hashed so the memo keys don't hold it.
+        if auth != 'api-key' or api_key is None:
+            return None
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def _auth_options(self, sdk, auth, api_key, asynchronous=False):
+        ## The token provider and transport of a client are wrapped when the factory is instrumented
+        if auth == 'api-key':
+            secret = api_key
+        elif asynchronous:
+            secret = self.async_token_provider(auth)
+            if self.instrumentation is not None:
+                secret = self.instrumentation.async_token_provider(secret, sdk, auth)
+        else:
+            secret = self.token_provider(auth)
+            if self.instrumentation is not None:
+                secret = self.instrumentation.token_provider(secret, sdk, auth)
+        options = {}
+        if self.instrumentation is not None:
+            if asynchronous:
+                options['http_client'] = self.instrumentation.async_http_client(sdk, auth)
+            else:
+                options['http_client'] = self.instrumentation.http_client(sdk, auth)
+        return secret, options
+
+    def _inference_options(self, sdk, auth, api_key, credential):
+        from azure.core.credentials import AzureKeyCredential
+        if auth == 'api-key':
+            return AzureKeyCredential(api_key), {}
+        if self.instrumentation is None:
+            return credential, {}
+        if sdk.startswith('async-'):
+            credential = self.instrumentation.async_credential(credential, sdk, auth)
+        else:
+            credential = self.instrumentation.credential(credential, sdk, auth)
+        return credential, {'per_retry_policies': [self.instrumentation.policy(sdk, auth)]}
+
+    def _loop_key(self):
+        ## Async clients and credentials are bound to the event loop that uses them. The loop is keyed by
+        ## a weak reference rather than its id, which a later loop can reuse, and its entries are dropped
+        ## when it is garbage collected.
+        loop = asyncio.get_running_loop()
+        ref = self._loops.get(loop)
+        if ref is None:
+            ref = self._loops[loop] = weakref.ref(loop, self._forget_loop)
+        return ref
+
+    def _forget_loop(self, ref):
+        ## This runs from the garbage collector so it doesn't take the lock. Single dict operations are atomic.
+        for key in [key for key in list(self._objects) if key[-1] is ref]:
+            self._objects.pop(key, None)
+
+    def credential(self, auth):
+        """This function returns the azure-identity credential of an authentication mode
+            Args:
+                auth (str): managed-identity or default
+            Returns:
+                credential: The credential
+        """
+        if auth not in ('managed-identity', 'default'):
+            raise ValueError(f'The client factory does not support {auth} authentication')
+
+        def build():
+            from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
+            if auth == 'managed-identity':
+                return ManagedIdentityCredential(client_id=self.managed_identity_client_id)
+            return DefaultAzureCredential(managed_identity_client_id=self.managed_identity_client_id)
+        return self._get(('credential', auth), build)
+
+    def async_credential(self, auth):
+        """This function returns the azure.identity.aio credential of an authentication mode for the running event loop
+            Args:
+                auth (str): managed-identity or default
+            Returns:
+                credential: The async credential
+        """
+        if auth not in ('managed-identity', 'default'):
+            raise ValueError(f'The client factory does not support {auth} authentication')
+
+        def build():
+            from azure.identity.aio import DefaultAzureCredential, ManagedIdentityCredential
+            if auth == 'managed-identity':
+                return ManagedIdentityCredential(client_id=self.managed_identity_client_id)
+            return DefaultAzureCredential(managed_identity_client_id=self.managed_identity_client_id)
+        return self._get(('async-credential', auth, self._loop_key()), build)
+
+    def token_provider(self, auth, scope=SCOPE):
+        """This function returns a bearer token provider backed by the memoized credential
+            Args:
+                auth (str): managed-identity or default
+                scope (str, optional): The scope of the token. Defaults to the Cognitive Services scope.
+            Returns:
+                token_provider: A function that returns an access token
+        """
+        def build():
+            from azure.identity import get_bearer_token_provider
+            return get_bearer_token_provider(self.credential(auth), scope)
+        return self._get(('token-provider', auth, scope), build)
+
+    def async_token_provider(self, auth, scope=SCOPE):
+        """This function returns an async bearer token provider backed by the memoized async credential
+            Args:
+                auth (str): managed-identity or default
+                scope (str, optional): The scope of the token. Defaults to the Cognitive Services scope.
+            Returns:
+                token_provider: A coroutine function that returns an access token
+        """
+        def build():
+            ## Tokens are refreshed in the background so coroutines don't wait on Entra ID
+            from async_token_provider import AsyncTokenProvider
+            return AsyncTokenProvider(self.async_credential(auth))
+        return self._get(('async-token-provider', auth, self._loop_key()), build).provider(scope)
+
+    def openai(self, endpoint, auth='api-key', api_key=None):
+        """This function returns the OpenAI client of the v1 API
+            Args:
+                endpoint (str): The Foundry endpoint
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                OpenAI: The client
+        """
+        def build():
+            from openai import OpenAI
+            secret, options = self._auth_options('openai', auth, api_key)
+            return OpenAI(base_url=f"{endpoint.rstrip('/')}/openai/v1", api_key=secret, **options)
+        return self._get(('openai', endpoint, None, None, auth, self._key_id(auth, api_key)), build)
+
+    def async_openai(self, endpoint, auth='api-key', api_key=None):
+        """This function returns the AsyncOpenAI client of the v1 API for the running event loop
+            Args:
+                endpoint (str): The Foundry endpoint
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                AsyncOpenAI: The client
+        """
+        def build():
+            from openai import AsyncOpenAI
+            secret, options = self._auth_options('async-openai', auth, api_key, asynchronous=True)
+            return AsyncOpenAI(base_url=f"{endpoint.rstrip('/')}/openai/v1", api_key=secret, **options)
+        return self._get(('async-openai', endpoint, None, None, auth, self._key_id(auth, api_key), self._loop_key()), build)
+
+    def azure_openai(self, endpoint, api_version, auth='api-key', api_key=None):
+        """This function returns the AzureOpenAI client of the legacy API
+            Args:
+                endpoint (str): The Azure OpenAI endpoint
+                api_version (str): The API version
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                AzureOpenAI: The client
+        """
+        def build():
+            from openai import AzureOpenAI
+            secret, options = self._auth_options('azure-openai', auth, api_key)
+            if auth == 'api-key':
+                return AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=secret, **options)
+            return AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, azure_ad_token_provider=secret, **options)
+        return self._get(('azure-openai', endpoint, None, api_version, auth, self._key_id(auth, api_key)), build)
+
+    def inference(self, endpoint, deployment, api_version=None, auth='api-key', api_key=None):
+        """This function returns the Azure AI Inference ChatCompletionsClient of a deployment
+            Args:
+                endpoint (str): The Foundry endpoint
+                deployment (str): The deployment name
+                api_version (str, optional): The API version
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                ChatCompletionsClient: The client
+        """
+        def build():
+            from azure.ai.inference import ChatCompletionsClient
+            credential, options = self._inference_options('inference', auth, api_key, None if auth == 'api-key' else self.credential(auth))
+            if api_version:
+                options['api_version'] = api_version
+            return ChatCompletionsClient(
+                endpoint=f"{endpoint.rstrip('/')}/openai/deployments/{deployment}",
+                credential=credential,
+                credential_scopes=[SCOPE],
+                **options
+            )
+        return self._get(('inference', endpoint, deployment, api_version, auth, self._key_id(auth, api_key)), build)
+
+    def async_inference(self, endpoint, deployment, api_version=None, auth='api-key', api_key=None):
+        """This function returns the async Azure AI Inference ChatCompletionsClient of a deployment for the running event loop
+            Args:
+                endpoint (str): The Foundry endpoint
+                deployment (str): The deployment name
+                api_version (str, optional): The API version
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                ChatCompletionsClient: The async client
+        """
+        def build():
+            from azure.ai.inference.aio import ChatCompletionsClient
+            credential, options = self._inference_options('async-inference', auth, api_key, None if auth == 'api-key' else self.async_credential(auth))
+            if api_version:
+                options['api_version'] = api_version
+            return ChatCompletionsClient(
+                endpoint=f"{endpoint.rstrip('/')}/openai/deployments/{deployment}",
+                credential=credential,
+                credential_scopes=[SCOPE],
+                **options
+            )
+        return self._get(('async-inference', endpoint, deployment, api_version, auth, self._key_id(auth, api_key), self._loop_key()), build)
+
+    def langchain(self, endpoint, deployment, api_version, auth='api-key', api_key=None):
+        """This function returns the LangChain AzureChatOpenAI model of a deployment
+            Args:
+                endpoint (str): The Azure OpenAI endpoint
+                deployment (str): The deployment name
+                api_version (str): The API version
+                auth (str, optional): The authentication mode. Defaults to api-key.
+                api_key (str, optional): The API key when auth is api-key
+            Returns:
+                AzureChatOpenAI: The chat model
+        """
+        def build():
+            from langchain_openai import AzureChatOpenAI
+            secret, options = self._auth_options('langchain', auth, api_key)
+            if self.instrumentation is not None:
+                options['http_async_client'] = self.instrumentation.async_http_client('langchain', auth)
+            if auth == 'api-key':
+                return AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, api_key=secret, **options)
+            return AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, azure_ad_token_provider=secret, **options)
+        return self._get(('langchain', endpoint, deployment, api_version, auth, self._key_id(auth, api_key)), build)
+
+    def _release(self, asynchronous):
+        with self._lock:
+            released = [(key, obj) for key, obj in self._objects.items() if key[0].startswith('async-') == asynchronous]
+            for key, _ in released:
+                del self._objects[key]
+        return released
+
+    def close(self):
+        """This function closes the transports of the sync clients and credentials. It is registered
+            to run at exit for the default factory.
+        """
+        for key, obj in self._release(asynchronous=False):
+            close = getattr(obj, 'close', None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    logging.warning(f'Failed to close {key[0]}', exc_info=True)
+
+    async def aclose(self):
+        """This function closes the async clients and credentials that belong to the running event loop"""
+        loop_key = self._loop_key()
+        with self._lock:
+            released = [(key, obj) for key, obj in self._objects.items() if key[0].startswith('async-') and key[-1] == loop_key]
+            for key, _ in released:
+                del self._objects[key]
+
+        ## Close clients before the credentials they use
+        released.sort(key=lambda item: item[0][0] == 'async-credential')
+        for key, obj in released:
+            close = getattr(obj, 'close', None)
+            if callable(close):
+                try:
+                    await close()
+                except Exception:
+                    logging.warning(f'Failed to close {key[0]}', exc_info=True)
+
+## The process-wide factory shared by request handlers and worker threads
+##
+_default_factory = None
+_default_factory_lock = threading.Lock()
+
+def get_factory(settings=None):
+    """This function returns the process-wide client factory, creating it on first use
+        Args:
+            settings (Settings, optional): The settings with the managed identity client id used on first use. Defaults to get_settings().
+        Returns:
+            ClientFactory: The process-wide client factory
+    """
+    global _default_factory
+    if _default_factory is None:
+        with _default_factory_lock:
+            if _default_factory is None:
+                settings = settings or get_settings()
+                _default_factory = ClientFactory(managed_identity_client_id=settings.identity.managed_identity_client_id)
+                atexit.register(_default_factory.close)
+    return _default_factory
+
+## The microbenchmark compares building the client and credential inside every request handler
+## with asking the factory for them. Managed identity is served by the mock server.
+##
+MESSAGES = [{"role": "user", "content": "Tell me an interesting fact"}]
+
+def per_request_openai(url, auth):
+    from openai import OpenAI
+    if auth == 'api-key':
+        client = OpenAI(base_url=f"{url}/openai/v1", api_key='mock-key')
+    else:
+        from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+        client = OpenAI(base_url=f"{url}/openai/v1", api_key=get_bearer_token_provider(DefaultAzureCredential(), SCOPE))
+    try:
+        return client.chat.completions.create(model='gpt-4.1', messages=MESSAGES, max_tokens=100)
+    finally:
+        client.close()
+
+def factory_openai(url, auth):
+    client = get_factory().openai(url, auth=auth, api_key='mock-key')
+    return client.chat.completions.create(model='gpt-4.1', messages=MESSAGES, max_tokens=100)
+
+def per_request_inference(url, auth):
+    from azure.ai.inference import ChatCompletionsClient
+    from azure.identity import DefaultAzureCredential
+    credential = DefaultAzureCredential()
+    client = ChatCompletionsClient(endpoint=f"{url}/openai/deployments/gpt-4.1", credential=credential, credential_scopes=[SCOPE])
+    try:
+        return client.complete(messages=MESSAGES, max_tokens=100, model='gpt-4.1', enforce_https=False)
+    finally:
+        client.close()
+        credential.close()
+
+def factory_inference(url, auth):
+    client = get_factory().inference(url, 'gpt-4.1', auth=auth, api_key='mock-key')
+    return client.complete(messages=MESSAGES, max_tokens=100, model='gpt-4.1', enforce_https=False)
+
+def measure(name, request, url, auth, requests_count, server_counts):
+    tokens = server_counts().get('token', 0)
+    connections = server_counts().get('connection', 0)
+    latencies = []
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        request(url, auth)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "mode": name,
+        "auth": auth,
+        "requests": requests_count,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "token_requests": server_counts().get('token', 0) - tokens,
+        "connections_opened": server_counts().get('connection', 0) - connections
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare building clients per request with the memoizing client factory')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--connect-latency', type=float, default=0.005, help='Emulated TCP and TLS handshake time in seconds')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server
+    server = start_mock_server(connect_latency=args.connect_latency)
+
+    ## Point managed identity at the mock server so DefaultAzureCredential resolves to it
+    for name in ('AZURE_CLIENT_ID', 'AZURE_CLIENT_SECRET', 'AZURE_TENANT_ID', 'AZURE_FEDERATED_TOKEN_FILE'):
+        os.environ.pop(name, None)
+    os.environ['IDENTITY_ENDPOINT'] = f"{server.url}/msi/token"
+    os.environ['IDENTITY_HEADER'] = 'mock-identity-header'
+    get_factory(mock_settings(server.url))
+
+    try:
+        ## Warm up imports so they are not charged to the first mode measured
+        per_request_openai(server.url, 'api-key')
+        per_request_inference(server.url, 'default')
+
+        for name, request, auth in (
+            ('openai per request', per_request_openai, 'api-key'),
+            ('openai factory', factory_openai, 'api-key'),
+            ('openai per request', per_request_openai, 'default'),
+            ('openai factory', factory_openai, 'default'),
+            ('inference per request', per_request_inference, 'default'),
+            ('inference factory', factory_inference, 'default')
+        ):
+            print(json.dumps(measure(name, request, server.url, auth, args.requests, lambda: dict(server.counts))))
+    finally:
+        get_factory().close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from settings import CREDENTIAL_KINDS, Identity, get_settings
+from utils import configure_logging
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+KINDS = tuple(kind for kind in CREDENTIAL_KINDS if kind != 'auto')
+
+## This function reads the credential settings from the Entra ID settings, which come from the same
+## environment variables azure-identity uses
+##
+def credential_config(identity=None):
+    """This function reads the credential settings from the Entra ID settings
+        Args:
+            identity (Identity, optional): The Entra ID settings. Defaults to those of get_settings().
+        Returns:
+            dict: The credential kind and the settings of each credential
+    """
+    identity = identity or get_settings().identity
+    return {
+        "kind": identity.credential_kind,
+        "tenant_id": identity.tenant_id,
+        "client_id": identity.client_id,
+        "client_secret": identity.client_secret,
+        "token_file_path": identity.federated_token_file,
+        "managed_identity_client_id": identity.managed_identity_client_id
+    }
+
+def configured_kinds(config):
+    """This function lists the credentials whose settings are present, most specific first
+        Args:
+            config (dict): The credential settings
+        Returns:
+            list: The credential kinds that can be tried
+    """
+    kinds = []
+    if config.get('tenant_id') and config.get('client_id') and config.get('token_file_path'):
+        kinds.append('workload-identity')
+    if config.get('tenant_id') and config.get('client_id') and config.get('client_secret'):
+        kinds.append('client-secret')
+
+    ## Managed identity needs no settings so it is always the last resort
+    kinds.append('managed-identity')
+    return kinds
+
+## This function builds a single credential of the given kind without walking a credential chain
+##
+def build_credential(kind, config):
+    """This function builds a credential of the given kind
+        Args:
+            kind (str): workload-identity, client-secret or managed-identity
+            config (dict): The credential settings
+        Returns:
+            credential: The azure-identity credential
+    """
+    if kind == 'managed-identity':
+        from azure.identity import ManagedIdentityCredential
+        return ManagedIdentityCredential(client_id=config.get('managed_identity_client_id'))
+    if kind == 'client-secret':
+        from azure.identity import ClientSecretCredential
+        return ClientSecretCredential(config['tenant_id'], config['client_id'], config['client_secret'])
+    if kind == 'workload-identity':
+        from azure.identity import WorkloadIdentityCredential
+        return WorkloadIdentityCredential(
+            tenant_id=config['tenant_id'],
+            client_id=config['client_id'],
+            token_file_path=config['token_file_path']
+        )
+    raise ValueError(f'Unknown credential kind: {kind}')
+
+## This class resolves the credential to use from configuration instead of probing every credential
+## DefaultAzureCredential knows about. In auto mode the kind that worked is saved to a state file and
+## tried first on the next start.
+##
+class CredentialSelector:
+    """This class selects and holds a single azure-identity credential. It can be passed anywhere a
+        TokenCredential is accepted.
+        Args:
+            kind (str, optional): auto, workload-identity, client-secret or managed-identity. Defaults to auto.
+            config (dict, optional): The credential settings. Defaults to credential_config().
+            state_path (str, optional): The file that remembers the kind that worked. Defaults to None which does not remember.
+            scope (str, optional): The scope used to test credentials in auto mode. Defaults to the Cognitive Services scope.
+    """
+    def __init__(self, kind='auto', config=None, state_path=None, scope=SCOPE):
+        if kind != 'auto' and kind not in KINDS:
+            raise ValueError(f'Unknown credential kind: {kind}')
+        self.kind = kind
+        self.config = config if config is not None else credential_config()
+        self.state_path = state_path
+        self.scope = scope
+        self.selected = None
+        self._credential = None
+        self._lock = threading.Lock()
+        self._prewarm_thread = None
+
+    def _fingerprint(self):
+        ## Identifies the configuration without storing secrets in the state file
+        settings = [self.config.get(name) or '' for name in ('tenant_id', 'client_id', 'managed_identity_client_id')]
+        settings.append('token-file' if self.config.get('token_file_path') else '')
+        settings.append('secret' if self.config.get('client_secret') else '')
+        return hashlib.sha256('|'.join(settings).encode('utf-8')).hexdigest()
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as file:
+                return json.load(file).get(self._fingerprint())
+        except (OSError, ValueError):
+            logging.warning(f'Ignoring unreadable credential state file {self.state_path}')
+            return None
+
+    def _save_state(self, kind):
+        if not self.state_path:
+            return
+        state = {}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                state = {}
+        state[self._fingerprint()] = kind
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.credential-state-')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.state_path)
+
+    def _resolve(self):
+        if self.kind != 'auto':
+            self.selected = self.kind
+            return build_credential(self.kind, self.config)
+
+        candidates = configured_kinds(self.config)
+        remembered = self._load_state()
+        if remembered in candidates:
+            candidates.remove(remembered)
+            candidates.insert(0, remembered)
+
+        errors = []
+        for kind in candidates:
+            credential = build_credential(kind, self.config)
+            try:
+                ## The token is kept in the credential's cache so the first request does not fetch it again
+                credential.get_token(self.scope)
+            except Exception as e:
+                logging.info(f'Credential {kind} failed: {e}')
+                errors.append(f'{kind}: {e}')
+                credential.close()
+                continue
+            self.selected = kind
+            if kind != remembered:
+                self._save_state(kind)
+            return credential
+        raise RuntimeError('No credential could obtain a token. ' + ' '.join(errors))
+
+    def credential(self):
+        """This function returns the selected credential, resolving it on first use
+            Returns:
+                credential: The azure-identity credential
+        """
+        if self._credential is None:
+            with self._lock:
+                if self._credential is None:
+                    self._credential = self._resolve()
+        return self._credential
+
+    def get_token(self, *scopes, **kwargs):
+        return self.credential().get_token(*scopes, **kwargs)
+
+    def prewarm(self, scopes=None):
+        """This function resolves the credential and fetches the first token on a background thread so
+            the token is cached by the time the first request needs it
+            Args:
+                scopes (list, optional): The scopes to fetch tokens for. Defaults to the selector's scope.
+            Returns:
+                thread: The background thread
+        """
+        def warm():
+            try:
+                for scope in scopes or [self.scope]:
+                    self.get_token(scope)
+            except Exception:
+                logging.warning('Failed to pre-warm the credential', exc_info=True)
+
+        self._prewarm_thread = threading.Thread(target=warm, name='credential-prewarm', daemon=True)
+        self._prewarm_thread.start()
+        return self._prewarm_thread
+
+    def close(self):
+        if self._credential is not None:
+            self._credential.close()
+
+## This function obtains a token provider from the credential selector. It replaces the
+## DefaultAzureCredential used by authenticate_with_managed_identity and authenticate_with_service_principal.
+##
+def authenticate_with_selected_credential(scope, prewarm=True, settings=None):
+    """This function obtains a token provider from the credential selected by configuration
+        Args:
+            scope (str): The scope for which the access token is requested
+            prewarm (bool, optional): Fetch the first token in the background. Defaults to True.
+            settings (Settings, optional): The settings with the credential kind and state path. Defaults to get_settings().
+        Returns:
+            token_provider: A token provider that can be used to obtain access tokens for the specified scope
+    """
+    try:
+        from azure.identity import get_bearer_token_provider
+        settings = settings or get_settings()
+        selector = CredentialSelector(
+            kind=settings.identity.credential_kind,
+            config=credential_config(settings.identity),
+            state_path=settings.credential_state_path,
+            scope=scope
+        )
+        if prewarm:
+            selector.prewarm()
+        return get_bearer_token_provider(selector, scope)
+    except Exception:
+        logging.error('Failed to obtain access token: ', exc_info=True)
+        sys.exit(1)
+
+def time_first_token(build):
+    start = time.perf_counter()
+    credential = build()
+    credential.get_token(SCOPE)
+    elapsed = time.perf_counter() - start
+    credential.close()
+    return round(elapsed * 1000, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare DefaultAzureCredential with the credential selector against a local IMDS stand-in')
+    parser.add_argument('--imds-latency', type=float, default=0.05, help='Seconds the IMDS stand-in takes to answer')
+    parser.add_argument('--startup-work', type=float, default=0.3, help='Seconds of application start-up work that pre-warming overlaps')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server
+    server = start_mock_server(token_latency=args.imds_latency)
+
+    ## Point managed identity at the IMDS stand-in and remove settings that would change what
+    ## DefaultAzureCredential picks
+    for name in ('AZURE_CLIENT_ID', 'AZURE_CLIENT_SECRET', 'AZURE_TENANT_ID', 'AZURE_FEDERATED_TOKEN_FILE', 'IDENTITY_ENDPOINT', 'IDENTITY_HEADER', 'MSI_ENDPOINT'):
+        os.environ.pop(name, None)
+    os.environ['AZURE_POD_IDENTITY_AUTHORITY_HOST'] = server.url
+
+    ## The selectors get an empty identity, so they don't depend on the .env file either
+    managed_identity = credential_config(Identity())
+    state_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        from azure.identity import DefaultAzureCredential
+        DefaultAzureCredential().close()
+
+        results.append({"mode": "DefaultAzureCredential", "first_token_ms": time_first_token(DefaultAzureCredential)})
+        results.append({"mode": "selector managed-identity", "first_token_ms": time_first_token(lambda: CredentialSelector('managed-identity', config=managed_identity))})
+
+        ## A workload identity that is configured but broken is tried before managed identity on the
+        ## first start. The second start goes straight to the managed identity that worked.
+        token_file = os.path.join(state_dir, 'federated-token')
+        with open(token_file, 'w') as file:
+            file.write('mock-federated-token')
+        broken_workload = {
+            "tenant_id": "mock-tenant",
+            "client_id": "mock-client-id",
+            "token_file_path": token_file
+        }
+        os.environ['AZURE_AUTHORITY_HOST'] = 'https://127.0.0.1:9'
+        state_path = os.path.join(state_dir, 'credential-state.json')
+        for mode in ('selector auto first start', 'selector auto remembered'):
+            selector = CredentialSelector('auto', config=broken_workload, state_path=state_path)
+            results.append({"mode": mode, "first_token_ms": time_first_token(lambda: selector), "selected": selector.selected})
+        os.environ.pop('AZURE_AUTHORITY_HOST')
+
+        ## Pre-warming overlaps the token request with the rest of application start-up
+        for prewarm in (False, True):
+            start = time.perf_counter()
+            selector = CredentialSelector('managed-identity', config=managed_identity)
+            if prewarm:
+                selector.prewarm()
+            time.sleep(args.startup_work)
+            selector.get_token(SCOPE)
+            results.append({
+                "mode": f"start-up with{'' if prewarm else 'out'} pre-warm",
+                "ready_ms": round((time.perf_counter() - start) * 1000, 3),
+                "startup_work_ms": args.startup_work * 1000
+            })
+            selector.close()
+    finally:
+        server.shutdown()
+
+    for result in results:
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,837 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import random
+import signal
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from http import HTTPStatus
+
+import httpx
+
+from instrumentation import Counter, Histogram, MetricsRegistry
+from rate_limiter import RateLimiter
+from response_cache import MemoryCacheBackend, ResponseCache, cache_key
+from response_parser import dumps, loads
+from retry_policy import retry_after_seconds
+from settings import LOCAL_HOSTS, ConfigurationError, Identity, get_settings, mock_settings
+from utils import configure_logging, percentile
+
+## This module is a local OpenAI-compatible gateway. Apps on the host point FOUNDRY_ENDPOINT at it
+## instead of the Foundry resource and keep their code unchanged. The gateway authenticates to the
+## deployment once with the profile's AUTH_MODE, sends every app's requests over one pool of kept-alive
+## upstream connections, paces them with a shared rate limiter and answers repeated deterministic
+## requests from a shared response cache. It only uses asyncio streams for the server side so it has
+## no web framework dependency.
+##
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+## Headers that describe a single connection or carry the caller's credentials are not forwarded
+##
+HOP_HEADERS = frozenset((
+    'host', 'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te', 'trailer',
+    'upgrade', 'expect', 'content-length', 'authorization', 'api-key'
+))
+RESPONSE_HOP_HEADERS = frozenset(('connection', 'keep-alive', 'transfer-encoding', 'content-length', 'content-encoding'))
+
+## Request bodies are read into memory, so their size is capped whatever length the client declares.
+## Batch input files can be up to 200 MB.
+##
+MAX_BODY_BYTES = 200 * 1024 * 1024
+
+## The events counted by the gateway, exported as gateway_events_total{event="..."}
+##
+EVENTS = (
+    'connections', 'requests', 'chat', 'streamed', 'passed_through', 'errors',
+    'cache_hits', 'cache_misses', 'cache_bypasses', 'coalesced',
+    'upstream_requests', 'upstream_errors', 'upstream_throttled', 'rate_limit_waits'
+)
+
+class GatewayError(Exception):
+    """This exception is turned into an error response in the format of Azure OpenAI
+        Args:
+            status (int): The HTTP status code
+            message (str): The error message
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+## This class holds a request read from a client connection
+##
+class Request:
+    __slots__ = ('method', 'target', 'path', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.path = target.split('?', 1)[0]
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def bearer(self):
+        scheme, _, token = self.headers.get('authorization', '').partition(' ')
+        return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+## These functions read HTTP/1.1 requests and write responses on asyncio streams
+##
+async def read_request(reader, writer=None, max_body=MAX_BODY_BYTES):
+    """This function reads one request from a client connection
+        Args:
+            reader (StreamReader): The connection
+            writer (StreamWriter, optional): The connection, used to tell clients that wait for it to send the body
+            max_body (int, optional): The largest request body accepted in bytes. Defaults to MAX_BODY_BYTES.
+        Returns:
+            Request: The request, or None when the client closed the connection between requests
+        Raises:
+            GatewayError: When the request is malformed
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise GatewayError(400, 'The request ended before its headers')
+    except asyncio.LimitOverrunError:
+        raise GatewayError(431, 'The request headers are too large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise GatewayError(400, 'Malformed request line') from None
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+    length = 0
+    if not chunked:
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise GatewayError(400, 'Invalid Content-Length') from None
+        if length < 0:
+            raise GatewayError(400, 'Invalid Content-Length')
+        if length > max_body:
+            raise GatewayError(413, f'The request body is larger than {max_body} bytes')
+
+    if writer is not None and headers.get('expect', '').lower() == '100-continue':
+        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+    if chunked:
+        body = await _read_chunked(reader, max_body)
+    else:
+        body = await reader.readexactly(length) if length else b''
+    return Request(method, target, version, headers, body)
+
+async def _read_chunked(reader, max_body):
+    chunks = []
+    total = 0
+    try:
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+            if size < 0:
+                raise ValueError(size)
+            total += size
+            if total > max_body:
+                raise GatewayError(413, f'The request body is larger than {max_body} bytes')
+            if size == 0:
+                ## Skip the trailers
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            if await reader.readexactly(2) != b'\r\n':
+                raise ValueError('missing chunk terminator')
+    except (ValueError, asyncio.LimitOverrunError):
+        raise GatewayError(400, 'Malformed chunked request body') from None
+
+def _reason(status):
+    try:
+        return HTTPStatus(status).phrase
+    except ValueError:
+        return ''
+
+def response_head(status, headers, keep_alive=True):
+    """This function encodes the status line and headers of a response
+        Args:
+            status (int): The HTTP status code
+            headers (list): Tuples of header name and value
+            keep_alive (bool, optional): Keep the connection open for the next request. Defaults to True.
+        Returns:
+            bytes: The response head
+    """
+    lines = [f'HTTP/1.1 {status} {_reason(status)}']
+    lines.extend(f'{name}: {value}' for name, value in headers)
+    if not keep_alive:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+def error_body(status, message):
+    return dumps({"error": {"code": str(status), "message": message}})
+
+def _forwarded_headers(headers):
+    return [(name, value) for name, value in headers.multi_items() if name.lower() not in RESPONSE_HOP_HEADERS]
+
+def _deployment_in_path(path):
+    ## /openai/deployments/{deployment}/chat/completions
+    parts = path.split('/')
+    return parts[3] if len(parts) > 4 and parts[2] == 'deployments' else None
+
+def is_chat_completion(path):
+    return path == '/openai/v1/chat/completions' or (path.startswith('/openai/deployments/') and path.endswith('/chat/completions'))
+
+## This class adds the gateway's own credentials to upstream requests. Service principal and managed
+## identity tokens are fetched once and refreshed in the background for every client. With OBO the
+## bearer token of each caller is exchanged through the OBO token cache, so a user's exchange is shared
+## by all of that user's requests.
+##
+class UpstreamAuth:
+    """This class builds the authentication headers of upstream requests
+        Args:
+            profile (Profile): The upstream endpoint and authentication mode
+            settings (Settings): The settings with the Entra ID values
+            obo_options (dict, optional): Options passed to the confidential client applications of the OBO flow
+    """
+    def __init__(self, profile, settings, obo_options=None):
+        self.mode = profile.auth_mode
+        self.api_key = profile.api_key
+        self._providers = None
+        self._async_provider = None
+        self._credential = None
+        self._obo = None
+        self._provider = None
+        if self.mode in ('service-principal', 'managed-identity'):
+            from langchain_runner import TokenProviders
+            self._providers = TokenProviders(self.mode, settings)
+            self._provider = self._providers.async_token_provider()
+        elif self.mode == 'obo':
+            from obo_cache import ConfidentialClientPool, OboTokenCache
+            identity = settings.identity
+            pool = ConfidentialClientPool(
+                identity.client_id,
+                identity.client_secret,
+                f"{identity.authority_host}/{identity.tenant_id}",
+                size=settings.concurrency,
+                **(obo_options or {})
+            )
+            self._obo = OboTokenCache(pool)
+        elif self.mode == 'default':
+            from azure.identity.aio import DefaultAzureCredential
+            from async_token_provider import AsyncTokenProvider
+            self._credential = DefaultAzureCredential(managed_identity_client_id=settings.identity.managed_identity_client_id)
+            self._async_provider = AsyncTokenProvider(self._credential)
+            self._provider = self._async_provider.provider(SCOPE)
+
+    async def headers(self, request):
+        """This function returns the authentication headers of the upstream request
+            Args:
+                request (Request): The client request, whose bearer token is the user assertion in the OBO flow
+            Returns:
+                dict: The api-key or Authorization header
+        """
+        if self.mode == 'api-key':
+            return {'api-key': self.api_key}
+        if self._obo is not None:
+            user_assertion = request.bearer()
+            if user_assertion is None:
+                raise GatewayError(401, 'The on-behalf-of flow needs the access token of the caller in the Authorization header')
+            try:
+                ## MSAL is blocking, so cache misses are exchanged in a worker thread
+                token = await asyncio.to_thread(self._obo.get_token, user_assertion, [SCOPE])
+            except Exception as e:
+                logging.error(f'On-behalf-of exchange failed: {e}')
+                raise GatewayError(401, 'The access token of the caller could not be exchanged') from None
+        else:
+            try:
+                token = await self._provider()
+            except Exception as e:
+                logging.error(f'Upstream token request failed: {e!r}')
+                raise GatewayError(502, 'The gateway could not get an access token for the upstream endpoint') from None
+        return {'Authorization': 'Bearer ' + token}
+
+    def metrics(self):
+        """This function returns the token fetches and exchanges made for upstream requests"""
+        result = {"mode": self.mode}
+        if self._providers is not None:
+            result["token_fetches"] = self._providers.fetches
+        if self._async_provider is not None:
+            result.update(self._async_provider.metrics())
+        if self._obo is not None:
+            result.update(self._obo.metrics())
+        return result
+
+    async def aclose(self):
+        if self._providers is not None:
+            await self._providers.aclose()
+        if self._async_provider is not None:
+            await self._async_provider.close()
+        if self._credential is not None:
+            await self._credential.close()
+
+## This class is the gateway. Chat completions go through the shared rate limiter and response cache,
+## and identical requests that arrive while the first is still in flight wait for its response instead
+## of being sent again. Every other path under /openai/ and /models/, such as embeddings, files and
+## batches, is passed through with the gateway's credentials.
+##
+class Gateway:
+    """This class serves the OpenAI-compatible API in front of one Foundry deployment
+        Args:
+            settings (Settings): The settings. The default profile is the upstream endpoint.
+            api_key (str, optional): The key clients must send as api-key or as a bearer token. Defaults to GATEWAY_API_KEY, and None accepts any client.
+            max_connections (int, optional): The upstream connections shared by all clients. Defaults to POOL_SIZE.
+            cache_entries (int, optional): The most responses kept in the response cache. 0 disables it. Defaults to 10000.
+            cache_ttl (float, optional): Seconds a cached response is kept. Defaults to 3600.
+            max_temperature (float, optional): Requests with a higher temperature bypass the cache. Defaults to 0.
+            obo_options (dict, optional): Options passed to the confidential client applications of the OBO flow
+            max_body (int, optional): The largest request body accepted in bytes. Defaults to MAX_BODY_BYTES.
+            registry (MetricsRegistry, optional): The registry the gateway's metrics are added to. Defaults to a new registry.
+    """
+    def __init__(self, settings, api_key=None, max_connections=None, cache_entries=10000, cache_ttl=3600.0, max_temperature=0.0, obo_options=None,
+                 max_body=MAX_BODY_BYTES, registry=None):
+        self.settings = settings
+        self.profile = settings.profile()
+        self.api_key = api_key or settings.gateway_api_key
+        self.auth = UpstreamAuth(self.profile, settings, obo_options)
+        self.cache = ResponseCache(MemoryCacheBackend(max_entries=cache_entries, ttl=cache_ttl), max_temperature) if cache_entries else None
+        self.rate_limiter = RateLimiter(settings.rate_limits())
+
+        http2 = True
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.info('The h2 package is not installed so HTTP/1.1 will be used upstream')
+            http2 = False
+        max_connections = max_connections or settings.pool_size
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=settings.request_timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=30.0)
+        )
+        self.max_body = max_body
+        self._inflight = {}
+        self._latencies = []
+
+        ## The counters are served at /metrics in the Prometheus format of the instrumentation module
+        self.registry = registry or MetricsRegistry()
+        self._events = self.registry.register(Counter('gateway_events_total', 'Connections, requests, cache lookups and upstream calls of the gateway', ('event',)))
+        self._rate_limit_wait = self.registry.register(Counter('gateway_rate_limit_wait_seconds_total', 'Seconds requests waited for the shared rate limiter', ()))
+        self._upstream_latency = self.registry.register(Histogram('gateway_upstream_request_seconds', 'Latency of upstream requests until the response headers', ('status',)))
+        for event in EVENTS:
+            self._events.labels(event)
+
+    def _count(self, event):
+        self._events.labels(event).inc()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """This function starts listening for clients
+            Args:
+                host (str, optional): The interface to listen on. Defaults to 127.0.0.1 so only local apps can connect.
+                port (int, optional): The port to listen on. 0 picks a free port. Defaults to 8000.
+            Returns:
+                Server: The asyncio server
+        """
+        self.server = await asyncio.start_server(self._handle_connection, host, port, backlog=1024)
+        return self.server
+
+    @property
+    def url(self):
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def aclose(self):
+        await self.client.aclose()
+        await self.auth.aclose()
+
+    def _limiter(self, deployment):
+        try:
+            return self.rate_limiter.for_deployment(deployment)
+        except KeyError:
+            return None
+
+    def _authorized(self, request):
+        if not self.api_key:
+            return True
+        ## With OBO the bearer token is the caller's identity, so the gateway key can only come as api-key
+        supplied = request.headers.get('api-key') or (request.bearer() if self.auth.mode != 'obo' else None)
+        return supplied is not None and hmac.compare_digest(supplied.encode('utf-8'), self.api_key.encode('utf-8'))
+
+    async def _handle_connection(self, reader, writer):
+        self._count('connections')
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, writer, self.max_body)
+                except GatewayError as e:
+                    self._count('errors')
+                    body = error_body(e.status, e.message)
+                    writer.write(response_head(e.status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))], False) + body)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                await self._dispatch(request, writer)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _dispatch(self, request, writer):
+        self._count('requests')
+        keep_alive = request.keep_alive
+        try:
+            if request.method == 'GET' and request.path == '/healthz':
+                await self._write(writer, 200, [('Content-Type', 'application/json')], b'{"status":"ok"}', keep_alive)
+            elif not self._authorized(request):
+                raise GatewayError(401, 'Access denied due to a missing or invalid gateway key')
+            elif request.method == 'GET' and request.path == '/metrics':
+                await self._write(writer, 200, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')], self.registry.render().encode('utf-8'), keep_alive)
+            elif request.method == 'GET' and request.path == '/stats':
+                await self._write(writer, 200, [('Content-Type', 'application/json')], dumps(self.stats()), keep_alive)
+            elif request.method == 'POST' and is_chat_completion(request.path):
+                await self._chat(request, writer)
+            elif request.path.startswith(('/openai/', '/models/')):
+                self._count('passed_through')
+                await self._pass_through(request, writer)
+            else:
+                raise GatewayError(404, f'No route for {request.path}')
+        except GatewayError as e:
+            self._count('errors')
+            await self._write(writer, e.status, [('Content-Type', 'application/json')], error_body(e.status, e.message), keep_alive)
+        except ConnectionError:
+            raise
+        except Exception:
+            ## Nothing has been written yet, since failures after the response head drop the connection
+            self._count('errors')
+            logging.exception(f'Failed to handle {request.method} {request.path}')
+            await self._write(writer, 500, [('Content-Type', 'application/json')], error_body(500, 'The gateway failed to handle the request'), keep_alive)
+
+    async def _write(self, writer, status, headers, body, keep_alive):
+        writer.write(response_head(status, [*headers, ('Content-Length', str(len(body)))], keep_alive) + body)
+        await writer.drain()
+
+    async def _send(self, request, auth_headers, stream):
+        headers = {name: value for name, value in request.headers.items() if name not in HOP_HEADERS}
+        headers.update(auth_headers)
+        upstream_request = self.client.build_request(request.method, self.profile.endpoint + request.target, headers=headers, content=request.body)
+        self._count('upstream_requests')
+        start = time.perf_counter()
+        try:
+            response = await self.client.send(upstream_request, stream=stream)
+        except httpx.HTTPError as e:
+            self._count('upstream_errors')
+            logging.error(f'Upstream request failed: {e!r}')
+            raise GatewayError(502, 'The upstream endpoint could not be reached') from None
+        elapsed = time.perf_counter() - start
+        self._upstream_latency.labels(str(response.status_code)).observe(elapsed)
+        self._latencies.append(elapsed)
+        ## Keep a bounded window of samples for the percentiles
+        if len(self._latencies) > 10000:
+            del self._latencies[:5000]
+        if response.status_code == 429:
+            self._count('upstream_throttled')
+        return response
+
+    async def _stream(self, writer, response, keep_alive):
+        ## The body is relayed as it arrives, still encoded as the upstream sent it
+        headers = [(name, value) for name, value in response.headers.multi_items() if name.lower() not in ('connection', 'keep-alive', 'transfer-encoding', 'content-length')]
+        writer.write(response_head(response.status_code, [*headers, ('Transfer-Encoding', 'chunked')], keep_alive))
+        try:
+            async for chunk in response.aiter_raw():
+                if chunk:
+                    writer.write(b'%X\r\n%b\r\n' % (len(chunk), chunk))
+                    await writer.drain()
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as e:
+            ## The status line is already sent, so the only way left to signal the failure is to drop the connection
+            self._count('upstream_errors')
+            logging.error(f'Upstream stream failed: {e!r}')
+            raise ConnectionResetError('Upstream stream failed') from None
+        finally:
+            await response.aclose()
+
+    async def _pass_through(self, request, writer):
+        response = await self._send(request, await self.auth.headers(request), stream=True)
+        await self._stream(writer, response, request.keep_alive)
+
+    async def _chat(self, request, writer):
+        self._count('chat')
+        try:
+            payload = loads(request.body)
+        except ValueError:
+            raise GatewayError(400, 'The request body is not valid JSON') from None
+        if not isinstance(payload, dict):
+            raise GatewayError(400, 'The request body must be a JSON object')
+        deployment = _deployment_in_path(request.path) or payload.get('model')
+        ## Upstream credentials are resolved first so an OBO caller whose token can't be exchanged is never served from the cache
+        auth_headers = await self.auth.headers(request)
+        keep_alive = request.keep_alive
+
+        if payload.get('stream'):
+            self._count('streamed')
+            limiter, reservation = await self._reserve(deployment, payload)
+            response = await self._send(request, auth_headers, stream=True)
+            self._settle(limiter, reservation, response, None)
+            await self._stream(writer, response, keep_alive)
+            return
+
+        params = {name: value for name, value in payload.items() if name not in ('model', 'messages')}
+        if self.cache is None or not self.cache.cacheable(params):
+            self._count('cache_bypasses')
+            status, headers, body = await self._complete(request, deployment, payload, auth_headers)
+            await self._write(writer, status, headers, body, keep_alive)
+            return
+
+        key = cache_key(deployment, payload.get('messages') or [], params)
+        cached = self.cache.backend.get(key)
+        if cached is not None:
+            self._count('cache_hits')
+            await self._write(writer, 200, [('Content-Type', 'application/json'), ('x-gateway-cache', 'hit')], cached.encode('utf-8'), keep_alive)
+            return
+
+        ## Identical requests already in flight share its response. A failed response isn't shared,
+        ## so each waiting request then makes its own attempt.
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._count('coalesced')
+            result = await asyncio.shield(inflight)
+            if result is not None and result[0] == 200:
+                await self._write(writer, 200, [*result[1], ('x-gateway-cache', 'coalesced')], result[2], keep_alive)
+                return
+
+        self._count('cache_misses')
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await self._complete(request, deployment, payload, auth_headers)
+            if result[0] == 200:
+                self.cache.backend.set(key, result[2].decode('utf-8'))
+        finally:
+            future.set_result(result)
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        status, headers, body = result
+        await self._write(writer, status, [*headers, ('x-gateway-cache', 'miss')], body, keep_alive)
+
+    async def _reserve(self, deployment, payload):
+        limiter = self._limiter(deployment)
+        if limiter is None:
+            return None, None
+        start = time.perf_counter()
+        reservation = await limiter.acquire_async(payload.get('messages') or [], payload.get('max_tokens') or payload.get('max_completion_tokens'))
+        waited = time.perf_counter() - start
+        if waited > 0.001:
+            self._count('rate_limit_waits')
+            self._rate_limit_wait.labels().inc(waited)
+        return limiter, reservation
+
+    def _settle(self, limiter, reservation, response, usage):
+        if limiter is None:
+            return
+        if response.status_code == 429:
+            limiter.throttled(retry_after_seconds(response.headers))
+        else:
+            limiter.complete(reservation, usage, response.headers)
+
+    async def _complete(self, request, deployment, payload, auth_headers):
+        limiter, reservation = await self._reserve(deployment, payload)
+        response = await self._send(request, auth_headers, stream=False)
+        body = response.content
+        usage = None
+        if limiter is not None and response.status_code == 200:
+            try:
+                usage = loads(body).get('usage')
+            except (ValueError, AttributeError):
+                pass
+        self._settle(limiter, reservation, response, usage)
+        return response.status_code, _forwarded_headers(response.headers), body
+
+    def stats(self):
+        """This function returns the request, cache, rate limit and upstream counters of the gateway
+            Returns:
+                dict: The counters, the upstream latency percentiles in milliseconds and the authentication metrics
+        """
+        counts = {event: self._events.labels(event).value for event in EVENTS}
+        counts['rate_limit_wait_s'] = round(self._rate_limit_wait.labels().value, 3)
+        lookups = counts['cache_hits'] + counts['cache_misses']
+        latencies = self._latencies
+        return {
+            **counts,
+            "cache_hit_ratio": round(counts['cache_hits'] / lookups, 4) if lookups else 0.0,
+            "upstream_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "upstream_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            "auth": self.auth.metrics()
+        }
+
+## This function runs the gateway until it is cancelled
+##
+async def serve(settings, host='127.0.0.1', port=8000, ready=None, **options):
+    """This function runs the gateway
+        Args:
+            settings (Settings): The settings
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 8000.
+            ready (callable, optional): Called with the URL of the gateway once it is listening
+            **options: Additional options passed to Gateway
+    """
+    gateway = Gateway(settings, **options)
+    server = await gateway.start(host, port)
+    logging.info(f'Gateway listening on {gateway.url} in front of {gateway.profile.endpoint}')
+    if ready is not None:
+        ready(gateway.url)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await gateway.aclose()
+
+def _serve(settings, host, port, options, ready):
+    ## The parent stops the gateway with terminate() so Ctrl-C is left to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve(settings, host, port, ready.put, **options))
+
+class GatewayProcess:
+    """This class runs the gateway in a child process so it does not compete with the clients being measured for the GIL
+        Args:
+            url (str): The base URL of the gateway
+            process (multiprocessing.Process): The child process running the gateway
+    """
+    def __init__(self, url, process):
+        self.url = url
+        self.process = process
+
+    def stats(self, api_key=None):
+        request = urllib.request.Request(f"{self.url}/stats", headers={'api-key': api_key} if api_key else {})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join()
+
+def start_gateway_process(settings, host='127.0.0.1', port=0, **options):
+    """This function starts the gateway in a child process
+        Args:
+            settings (Settings): The settings
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 0 which picks a free port.
+            **options: Additional options passed to Gateway
+        Returns:
+            GatewayProcess: The running gateway. Call shutdown() when done with it
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(settings, host, port, options, ready), name='gateway', daemon=True)
+    process.start()
+    url = ready.get(timeout=30)
+    return GatewayProcess(url, process)
+
+## The load test runs the same traffic from several apps twice against the mock server. First each
+## app calls the deployment directly with its own service principal token and connection pool, the
+## way each sample does today, then every app calls the gateway with the gateway key. The mock counts
+## the upstream connections, token requests, chat completions and 429 responses of each run.
+##
+def _mock_counts(url):
+    with urllib.request.urlopen(f"{url}/mock/counts", timeout=10) as response:
+        return json.loads(response.read())
+
+def _count_delta(before, after):
+    delta = {name: after.get(name, 0) - before.get(name, 0) for name in ('connection', 'token', 'chat', 'throttled')}
+    ## Reading the counters opens a connection of its own
+    delta['connection'] -= 1
+    return delta
+
+def _run_apps(clients, model, prompts, concurrency):
+    latencies = []
+    failures = []
+
+    def send(app, prompt):
+        start = time.perf_counter()
+        try:
+            clients[app].chat.completions.create(
+                model=model,
+                messages=[{"role": "system", "content": "You are a helpful assistant that provides interesting facts."}, {"role": "user", "content": prompt}],
+                max_tokens=50,
+                temperature=0
+            )
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            failures.append(repr(e))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency * len(clients)) as executor:
+        list(executor.map(send, [i % len(clients) for i in range(len(prompts))], prompts))
+    elapsed = time.perf_counter() - start
+    if failures:
+        logging.warning(f'{len(failures)} requests failed, the first with {failures[0]}')
+    return {
+        "requests": len(prompts),
+        "failed": len(failures),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+    }
+
+def _check_clients(url, model, api_key, api_version):
+    ## The other ways the samples call the deployment, pointed at the gateway unchanged
+    from openai import AzureOpenAI, OpenAI
+    import requests
+
+    results = {}
+    with AzureOpenAI(azure_endpoint=url, api_key=api_key, api_version=api_version) as client:
+        response = client.chat.completions.create(model=model, messages=[{"role": "user", "content": "Hello"}], max_tokens=20)
+        results["azure_openai"] = bool(response.choices[0].message.content)
+    with OpenAI(base_url=f"{url}/openai/v1", api_key=api_key) as client:
+        stream = client.chat.completions.create(model=model, messages=[{"role": "user", "content": "Hello"}], max_tokens=20, stream=True, stream_options={"include_usage": True})
+        results["openai_stream"] = bool(''.join(chunk.choices[0].delta.content or '' for chunk in stream if chunk.choices))
+        results["openai_embeddings"] = len(client.embeddings.create(model='text-embedding-3-small', input=['Hello']).data) == 1
+    response = requests.post(
+        f"{url}/openai/v1/chat/completions",
+        headers={'api-key': api_key},
+        json={"model": model, "messages": [{"role": "user", "content": "Hello"}], "max_tokens": 20},
+        timeout=30
+    )
+    results["rest"] = response.status_code == 200 and bool(response.json()['choices'][0]['message']['content'])
+    return results
+
+def run_load_test(args):
+    from mock_server import start_mock_server_process
+    from openai import OpenAI
+    from cli import get_token_fetcher
+    from token_cache import TokenCache
+
+    server = start_mock_server_process(chat_latency=args.chat_latency, connect_latency=args.connect_latency, rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit)
+    identity = Identity(tenant_id='mock-tenant', client_id='mock-client-id', client_secret='mock-client-secret', authority_host=server.url)
+    settings = mock_settings(server.url, identity=identity, pool_size=args.pool_size)
+    profile = replace(settings.profile(), auth_mode='service-principal', api_key=None, rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit)
+    settings = replace(settings, profiles=(profile,), backends=(profile,))
+
+    ## A few questions are asked much more often than the rest
+    questions = [f"Tell me an interesting fact about topic {i}" for i in range(args.distinct)]
+    prompts = random.Random(7).choices(questions, weights=[1 / (rank + 1) for rank in range(args.distinct)], k=args.requests)
+    gateway = None
+    try:
+        ## Each app authenticates and connects on its own, as if it ran in its own pod
+        clients = []
+        for _ in range(args.apps):
+            key, fetch_token = get_token_fetcher('service-principal', identity)
+            cache = TokenCache()
+            clients.append(OpenAI(base_url=profile.base_url, api_key=lambda cache=cache, key=key, fetch_token=fetch_token: cache.get_token(key, fetch_token), max_retries=settings.max_retries))
+        before = _mock_counts(server.url)
+        result = _run_apps(clients, profile.deployment, prompts, args.concurrency)
+        for client in clients:
+            client.close()
+        print(json.dumps({"mode": "direct", "apps": args.apps, **result, "upstream": _count_delta(before, _mock_counts(server.url))}))
+
+        gateway_key = 'mock-gateway-key'
+        gateway = start_gateway_process(settings, api_key=gateway_key, max_temperature=0.0)
+        clients = [OpenAI(base_url=f"{gateway.url}/openai/v1", api_key=gateway_key, max_retries=settings.max_retries) for _ in range(args.apps)]
+        before = _mock_counts(server.url)
+        result = _run_apps(clients, profile.deployment, prompts, args.concurrency)
+        for client in clients:
+            client.close()
+        upstream = _count_delta(before, _mock_counts(server.url))
+        metrics = gateway.stats(gateway_key)
+        print(json.dumps({
+            "mode": "gateway",
+            "apps": args.apps,
+            **result,
+            "upstream": upstream,
+            "gateway": {name: metrics[name] for name in ('connections', 'cache_hits', 'cache_misses', 'coalesced', 'cache_hit_ratio', 'upstream_throttled', 'rate_limit_waits', 'rate_limit_wait_s', 'upstream_p50_ms', 'upstream_p99_ms')},
+            "auth": metrics["auth"]
+        }))
+        print(json.dumps({"mode": "compatibility", **_check_clients(gateway.url, profile.deployment, gateway_key, profile.api_version)}))
+    finally:
+        if gateway is not None:
+            gateway.shutdown()
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local OpenAI-compatible gateway that authenticates, pools connections, rate limits and caches for every app on the host')
+    parser.add_argument('--host', default='127.0.0.1', help='The interface to listen on. Only local apps can connect by default.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pool-size', type=int, help='The upstream connections shared by all clients. Defaults to POOL_SIZE.')
+    parser.add_argument('--cache-entries', type=int, default=10000, help='The most responses kept in the response cache. 0 disables the cache.')
+    parser.add_argument('--cache-ttl', type=float, default=3600.0, help='Seconds a cached response is kept')
+    parser.add_argument('--max-body-mb', type=int, default=MAX_BODY_BYTES // (1024 * 1024), help='The largest request body accepted in MB')
+    parser.add_argument('--max-temperature', type=float, default=0.0, help='Requests with a higher temperature bypass the cache')
+    parser.add_argument('--mock', action='store_true', help='Load test direct calls and the gateway against the local mock server')
+    parser.add_argument('--apps', type=int, default=8, help='The apps simulated by the load test, each with its own client')
+    parser.add_argument('--concurrency', type=int, default=4, help='The requests in flight per app in the load test')
+    parser.add_argument('--requests', type=int, default=2000, help='The requests sent by the load test')
+    parser.add_argument('--distinct', type=int, default=200, help='The distinct prompts of the load test')
+    parser.add_argument('--chat-latency', type=float, default=0.05, help='Mock seconds per chat completion')
+    parser.add_argument('--connect-latency', type=float, default=0.05, help='Mock seconds per new connection to emulate a TLS handshake')
+    parser.add_argument('--rpm-limit', type=int, help='The requests per minute quota of the mock deployment, also given to the gateway')
+    parser.add_argument('--tpm-limit', type=int, help='The tokens per minute quota of the mock deployment, also given to the gateway')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("WARNING" if args.mock else "INFO")
+
+    if args.mock:
+        if bool(args.rpm_limit) != bool(args.tpm_limit):
+            parser.error('--rpm-limit and --tpm-limit are given together')
+        if args.pool_size is None:
+            args.pool_size = 10
+        try:
+            run_load_test(args)
+        except Exception:
+            logging.error('Load test failed: ', exc_info=True)
+            sys.exit(1)
+        return
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME, AUTH_MODE and GATEWAY_API_KEY
+    try:
+        settings = get_settings()
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+    if not settings.gateway_api_key and args.host not in LOCAL_HOSTS:
+        logging.error('Set GATEWAY_API_KEY before listening on an interface other apps on the network can reach')
+        sys.exit(1)
+
+    try:
+        asyncio.run(serve(
+            settings,
+            args.host,
+            args.port,
+            max_connections=args.pool_size,
+            cache_entries=args.cache_entries,
+            cache_ttl=args.cache_ttl,
+            max_temperature=args.max_temperature,
+            max_body=args.max_body_mb * 1024 * 1024
+        ))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
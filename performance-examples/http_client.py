@@ -0,0 +1,197 @@
+import logging
+import sys
+import requests
+from requests.adapters import HTTPAdapter
+
+from response_parser import read_completion
+from settings import ConfigurationError, get_settings
+from utils import configure_logging
+
+## This class wraps a long-lived requests Session so chat completions reuse pooled
+## keep-alive connections instead of opening a new TCP and TLS connection per call. The httpx
+## transport sends them over an httpx Client instead, which multiplexes them over HTTP/2 when h2 is installed.
+##
+class FoundryHttpClient:
+    """This class sends chat completion requests to the Foundry v1 API over a pooled requests Session
+        Args:
+            endpoint (str): The Foundry endpoint such as https://FOUNDRY_RESOURCE_NAME.services.ai.azure.com
+            api_key (str, optional): The Foundry API key. Either api_key or token_provider must be provided.
+            token_provider (callable, optional): A function that returns an Entra ID access token.
+            pool_connections (int, optional): The number of per-host connection pools to keep. Defaults to 10.
+            pool_maxsize (int, optional): The maximum number of connections kept alive per host. Defaults to 10.
+            pool_block (bool, optional): Block when a host's pool is exhausted instead of opening extra connections. Defaults to False.
+            timeout (float, optional): The request timeout in seconds. Defaults to 60.
+            retry_policy (RetryPolicy, optional): Retries throttled and failed requests. Defaults to None which sends each request once.
+                With the httpx transport, give it retry_exceptions=(httpx.TransportError,) since httpx errors aren't OSErrors.
+            transport (str, optional): requests or httpx. Defaults to requests.
+    """
+    TRANSPORTS = ('requests', 'httpx')
+
+    def __init__(self, endpoint, api_key=None, token_provider=None, pool_connections=10, pool_maxsize=10, pool_block=False, timeout=60, retry_policy=None, transport='requests'):
+        if not api_key and not token_provider:
+            raise ValueError('Either api_key or token_provider must be provided')
+        if transport not in self.TRANSPORTS:
+            raise ValueError(f'Unknown transport: {transport}')
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self._api_key = api_key
+        self._token_provider = token_provider
+        self.retry_policy = retry_policy
+        self.transport = transport
+        if transport == 'httpx':
+            ## httpx has one pool for every host. Without pool_block the pool is allowed to grow past pool_maxsize
+            ## as a requests pool does, and only pool_maxsize idle connections are kept alive.
+            self.session = create_httpx_client(
+                max_connections=pool_maxsize if pool_block else None,
+                max_keepalive_connections=pool_maxsize,
+                timeout=timeout
+            )
+        else:
+            self.session = create_session(pool_connections, pool_maxsize, pool_block)
+
+    def _headers(self):
+        if self._api_key:
+            return {'api-key': self._api_key}
+        return {'Authorization': 'Bearer ' + self._token_provider()}
+
+    def post(self, path, body):
+        """This function posts a JSON body to a path under the endpoint
+            Args:
+                path (str): The path of the operation such as /openai/v1/chat/completions
+                body (dict): The JSON body of the request
+            Returns:
+                response: The requests or httpx Response
+        """
+        def send():
+            return self.session.post(
+                url=f"{self.endpoint}{path}",
+                headers=self._headers(),
+                json=body,
+                timeout=self.timeout
+            )
+
+        if self.retry_policy is None:
+            return send()
+        return self.retry_policy.call(self.endpoint, send)
+
+    def chat_completion(self, messages, model=None, **params):
+        """This function performs a chat completion against the v1 API
+            Args:
+                messages (list): The chat messages
+                model (str, optional): The deployment name
+                **params: Additional parameters such as max_tokens
+            Returns:
+                ChatCompletion: The decoded chat completion response
+        """
+        body = {"messages": messages, **params}
+        if model:
+            body["model"] = model
+        ## The body is decoded from bytes into slotted objects, skipping the str copy and charset
+        ## detection of response.json() and the dicts of the full response
+        return read_completion(self.post('/openai/v1/chat/completions', body))
+
+    def close(self):
+        """This function closes the pooled connections"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+## This function creates a requests Session with a sized connection pool
+##
+def create_session(pool_connections=10, pool_maxsize=10, pool_block=False):
+    """This function creates a requests Session with a sized connection pool
+        Args:
+            pool_connections (int, optional): The number of per-host connection pools to keep. Defaults to 10.
+            pool_maxsize (int, optional): The maximum number of connections kept alive per host. Defaults to 10.
+            pool_block (bool, optional): Block when a host's pool is exhausted instead of opening extra connections. Defaults to False.
+        Returns:
+            session: A requests Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+## This function creates an httpx Client that negotiates HTTP/2 when the h2 package is installed.
+## HTTP/2 multiplexes concurrent requests over a single connection per host.
+##
+def create_httpx_client(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=60.0, http2=True):
+    """This function creates an httpx Client with connection limits and HTTP/2 where available
+        Args:
+            max_connections (int, optional): The maximum number of open connections, or None for no limit. Defaults to 100.
+            max_keepalive_connections (int, optional): The maximum number of idle connections kept alive. Defaults to 20.
+            keepalive_expiry (float, optional): Seconds an idle connection is kept alive. Defaults to 30.
+            timeout (float, optional): The request timeout in seconds. Defaults to 60.
+            http2 (bool, optional): Negotiate HTTP/2 when the h2 package is installed. Defaults to True.
+        Returns:
+            client: An httpx Client
+    """
+    import httpx
+
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.info('The h2 package is not installed so HTTP/1.1 will be used')
+            http2 = False
+
+    return httpx.Client(
+        http2=http2,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+    )
+
+def main():
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_API_KEY, DEPLOYMENT_NAME, and FOUNDRY_ENDPOINT
+    try:
+        settings = get_settings()
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+    profile = settings.profile()
+
+    ## Send a few chat completions over the same pooled connection
+    ##
+    try:
+        with FoundryHttpClient(
+            endpoint=profile.endpoint,
+            api_key=profile.api_key,
+            pool_maxsize=settings.pool_size,
+            timeout=settings.request_timeout
+        ) as client:
+            for _ in range(3):
+                response = client.chat_completion(
+                    model=profile.deployment,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": "Tell me an interesting fact"
+                        }
+                    ],
+                    max_tokens=100
+                )
+                print(response.content)
+    except:
+        logging.error('Failed to inference: ', exc_info=True)
+
+if __name__ == "__main__":
+    main()
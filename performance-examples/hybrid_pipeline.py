@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from batch_runner import DEFAULT_SYSTEM_PROMPT, InvalidRecord, build_messages, read_prompts
+from settings import ConfigurationError, get_settings
+from token_counter import get_counter
+from utils import configure_logging, percentile
+
+## The CPU stages run in worker processes. Each worker loads the tokenizer once and keeps it.
+##
+def _load_tokenizer(model):
+    return get_counter(model).tokenizer
+
+## This function templates and tokenizes a chunk of input records and serializes the request bodies.
+## It runs in a worker process so it doesn't compete with the event loop for the GIL.
+##
+def prepare_chunk(records, model, template, max_tokens, tokenizer_model=None, tpm_limit=None):
+    """This function builds the request bodies for a chunk of input records
+        Args:
+            records (list): The line number and decoded JSON object of each input line
+            model (str): The deployment name
+            template (str): A format string for the user message. The fields of the record can be used as placeholders.
+            max_tokens (int): The default maximum number of tokens to generate
+            tokenizer_model (str, optional): The model behind the deployment. Defaults to the deployment name.
+            tpm_limit (int, optional): The tokens per minute quota max_tokens is sized to
+        Returns:
+            list: The line number, record id, serialized body and prompt token count of each record.
+                Records that can't be templated have a body of None and the error in place of the token count.
+    """
+    counter = get_counter(tokenizer_model or model)
+    prepared = []
+    for line, record in records:
+        if isinstance(record, InvalidRecord):
+            prepared.append((line, None, None, record.error))
+            continue
+        record_id = record.get('id')
+        try:
+            if 'messages' not in record and template:
+                record = {**record, "prompt": template.format_map(record)}
+            messages = build_messages(record, record.get('system', DEFAULT_SYSTEM_PROMPT))
+            prompt_tokens = counter.count_messages(messages)
+            ## Prompts that leave no room for a completion fail here instead of at the service
+            budget = counter.budget_max_tokens(prompt_tokens, record.get('max_tokens', max_tokens), tpm_limit)
+            body = json.dumps({"model": model, "messages": messages, "max_tokens": budget}).encode('utf-8')
+            prepared.append((line, record_id, body, prompt_tokens))
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            prepared.append((line, record_id, None, f'Failed to template line {line}: {e!r}'))
+    return prepared
+
+## This function parses, validates and post-processes a chunk of raw chat completion responses and
+## serializes the output lines. It runs in a worker process for the same reason as prepare_chunk.
+##
+def parse_chunk(responses, parse_content_json):
+    """This function turns raw chat completion responses into output lines
+        Args:
+            responses (list): The line number, record id, status code, raw body, prompt token count and latency of each request
+            parse_content_json (bool): Decode the assistant message as JSON and fail lines where it isn't valid
+        Returns:
+            tuple: The output lines in the format of the batch runner with prompt and completion token counts added
+                and the number of lines with an error
+    """
+    lines = []
+    errors = 0
+    for line, record_id, status, body, prompt_tokens, latency in responses:
+        result = {"line": line}
+        if record_id is not None:
+            result["id"] = record_id
+        try:
+            if isinstance(body, str):
+                raise ValueError(body)
+            if status >= 400:
+                raise ValueError(f'HTTP {status}: {body[:200].decode("utf-8", "replace")}')
+            payload = json.loads(body)
+            choice = payload['choices'][0]
+            if choice.get('finish_reason') not in ('stop', 'length'):
+                raise ValueError(f"Unexpected finish reason {choice.get('finish_reason')}")
+            content = choice['message']['content']
+            if parse_content_json:
+                content = json.loads(content)
+            result["content"] = content
+            result["error"] = None
+            result["prompt_tokens"] = prompt_tokens
+            result["completion_tokens"] = payload.get('usage', {}).get('completion_tokens')
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            result["content"] = None
+            result["error"] = str(e)
+            result["prompt_tokens"] = prompt_tokens if isinstance(prompt_tokens, int) else None
+            result["completion_tokens"] = None
+            errors += 1
+        result["latency_ms"] = round(latency * 1000, 3)
+        lines.append(json.dumps(result) + '\n')
+    return lines, errors
+
+def _offload(executor, function, *args):
+    ## With no executor the stage runs inline on the event loop, which is the single interpreter layout
+    if executor is None:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(function(*args))
+        return future
+    return asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+## This function runs the input through three stages. Worker processes template and tokenize prompts,
+## the event loop sends the requests, and worker processes parse the responses. The stages are joined
+## by bounded queues so a slow stage makes the ones before it wait instead of piling up work in memory.
+##
+async def run_pipeline(backend, model, input_stream, output, executor=None, concurrency=16, chunk_size=32,
+                       queue_size=8, template=None, max_tokens=100, parse_content_json=False, tokenizer_model=None, tpm_limit=None):
+    """This function runs every prompt of the input through the backend and writes results in completion order
+        Args:
+            backend (RestBackend): The backend used to send the requests
+            model (str): The deployment name
+            input_stream (file): A text stream with one JSON object per line
+            output (file): A text stream the JSONL results are written to
+            executor (ProcessPoolExecutor, optional): The worker processes. Defaults to None which runs the CPU stages on the event loop.
+            concurrency (int, optional): The maximum number of requests in flight. Defaults to 16.
+            chunk_size (int, optional): The number of records sent to a worker at a time. Defaults to 32.
+            queue_size (int, optional): The number of chunks each queue holds before its producer waits. Defaults to 8.
+            template (str, optional): A format string for the user message. Defaults to None which uses the prompt field.
+            max_tokens (int, optional): The default maximum number of tokens to generate. Defaults to 100.
+            parse_content_json (bool, optional): Decode each assistant message as JSON. Defaults to False.
+            tokenizer_model (str, optional): The model behind the deployment, which picks the tokenizer. Defaults to the deployment name.
+            tpm_limit (int, optional): The tokens per minute quota max_tokens is sized to. Defaults to None.
+        Returns:
+            dict: The counts, latency and queue wait times of the run
+    """
+    prepared_queue = asyncio.Queue(maxsize=queue_size)
+    parsed_queue = asyncio.Queue(maxsize=queue_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"requests": 0, "errors": 0, "skipped": 0, "latencies": [], "reader_wait_s": 0.0, "dispatch_wait_s": 0.0}
+
+    async def put(queue, item, wait_key):
+        start = time.perf_counter()
+        await queue.put(item)
+        stats[wait_key] += time.perf_counter() - start
+
+    async def reader():
+        chunk = []
+        for line, record in read_prompts(input_stream):
+            if record is None:
+                stats['skipped'] += 1
+                continue
+            chunk.append((line, record))
+            if len(chunk) >= chunk_size:
+                await put(prepared_queue, _offload(executor, prepare_chunk, chunk, model, template, max_tokens, tokenizer_model, tpm_limit), 'reader_wait_s')
+                chunk = []
+        if chunk:
+            await put(prepared_queue, _offload(executor, prepare_chunk, chunk, model, template, max_tokens, tokenizer_model, tpm_limit), 'reader_wait_s')
+        await prepared_queue.put(None)
+
+    async def dispatcher():
+        responses = []
+        in_flight = set()
+
+        async def send(line, record_id, body, prompt_tokens):
+            start = time.perf_counter()
+            try:
+                if body is None:
+                    status, raw = 0, prompt_tokens
+                else:
+                    status, raw = await backend.post_raw(body)
+            except Exception as e:
+                logging.error(f'Failed chat completion for line {line}: {e!r}')
+                status, raw = 0, f'Request failed: {e!r}'
+            finally:
+                semaphore.release()
+            latency = time.perf_counter() - start
+            if body is not None:
+                stats['latencies'].append(latency)
+            responses.append((line, record_id, status, raw, prompt_tokens, latency))
+
+        async def flush(force=False):
+            nonlocal responses
+            while len(responses) >= chunk_size or (force and responses):
+                chunk, responses = responses[:chunk_size], responses[chunk_size:]
+                await put(parsed_queue, _offload(executor, parse_chunk, chunk, parse_content_json), 'dispatch_wait_s')
+
+        while True:
+            prepared = await prepared_queue.get()
+            if prepared is None:
+                break
+            for line, record_id, body, prompt_tokens in await prepared:
+                await semaphore.acquire()
+                task = asyncio.create_task(send(line, record_id, body, prompt_tokens))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                stats['requests'] += 1
+                await flush()
+        if in_flight:
+            await asyncio.wait(in_flight)
+        await flush(force=True)
+        await parsed_queue.put(None)
+
+    async def writer():
+        while True:
+            parsed = await parsed_queue.get()
+            if parsed is None:
+                break
+            lines, errors = await parsed
+            output.writelines(lines)
+            stats['errors'] += errors
+
+    await asyncio.gather(reader(), dispatcher(), writer())
+    latencies = stats.pop('latencies')
+    return {
+        **{key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()},
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+    }
+
+## The benchmark runs the same input with the CPU stages on the event loop and with a growing number
+## of worker processes. The mock returns a JSON document as the assistant message so parsing it and
+## serializing the output is real work. A heartbeat task measures how long the event loop is blocked.
+##
+def _benchmark_input(requests):
+    import io
+    records = (
+        json.dumps({"id": i, "topic": f"number {i}", "prompt": f"Tell me ten interesting facts about the number {i}. " * 20})
+        for i in range(requests)
+    )
+    return io.StringIO('\n'.join(records) + '\n')
+
+async def _benchmark_run(url, workers, args):
+    from async_engine import RestBackend
+    from async_token_provider import heartbeat
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+    backend = RestBackend(url, 'gpt-4.1', api_key='mock-key', max_connections=args.concurrency)
+    stalls = []
+    monitor = asyncio.ensure_future(heartbeat(stalls))
+    try:
+        if executor is not None:
+            ## Start the workers before timing so process start-up is not counted
+            await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(executor, _load_tokenizer, 'gpt-4.1') for _ in range(workers)])
+        with open(os.devnull, 'w') as output:
+            start = time.perf_counter()
+            result = await run_pipeline(
+                backend, 'gpt-4.1', _benchmark_input(args.requests), output,
+                executor=executor,
+                concurrency=args.concurrency,
+                chunk_size=args.chunk_size,
+                queue_size=args.queue_size,
+                template='{prompt} Answer as JSON about {topic}.',
+                parse_content_json=True
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        monitor.cancel()
+        await backend.aclose()
+        if executor is not None:
+            executor.shutdown()
+    return {
+        "workers": workers,
+        "cpu_count": os.cpu_count(),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(result['requests'] / elapsed, 2),
+        "loop_stall_max_ms": round(max(stalls, default=0.0) * 1000, 3),
+        **result
+    }
+
+def benchmark(args):
+    from mock_server import start_mock_server_process
+
+    facts = [{"fact": f"Fact {i} about the number", "source": "mock", "confidence": i / 100, "tags": ["math", "trivia"]} for i in range(100)]
+    server = start_mock_server_process(chat_latency=args.chat_latency, completion_text=json.dumps(facts))
+    try:
+        for workers in args.workers:
+            print(json.dumps(asyncio.run(_benchmark_run(server.url, workers, args))))
+    finally:
+        server.shutdown()
+
+async def run(args, settings):
+    from async_engine import RestBackend
+
+    credential = None
+    profile = settings.profile()
+    model = profile.deployment
+    token_provider = None
+    if profile.auth_mode != 'api-key':
+        from async_token_provider import get_cached_bearer_token_provider
+        from azure.identity.aio import DefaultAzureCredential
+        credential = DefaultAzureCredential(managed_identity_client_id=settings.identity.managed_identity_client_id)
+        token_provider = get_cached_bearer_token_provider(credential, "https://cognitiveservices.azure.com/.default")
+
+    backend = RestBackend(profile.endpoint, model, api_key=profile.api_key, token_provider=token_provider, max_connections=args.concurrency)
+    executor = ProcessPoolExecutor(max_workers=args.workers[0]) if args.workers[0] else None
+    input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    try:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            result = await run_pipeline(
+                backend, model, input_stream, output,
+                executor=executor,
+                concurrency=args.concurrency,
+                chunk_size=args.chunk_size,
+                queue_size=args.queue_size,
+                template=args.template,
+                max_tokens=args.max_tokens,
+                parse_content_json=args.parse_content_json,
+                tokenizer_model=profile.model_name,
+                tpm_limit=profile.tpm_limit
+            )
+        logging.warning(f'Finished: {json.dumps(result)}')
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if executor is not None:
+            executor.shutdown()
+        await backend.aclose()
+        if token_provider is not None:
+            await token_provider.aclose()
+        if credential is not None:
+            await credential.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run prompts through an asyncio request loop with templating, tokenization and parsing in worker processes')
+    parser.add_argument('--input', default='-', help='The JSONL input file or - for stdin')
+    parser.add_argument('--output', help='The JSONL output file')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='Worker processes. 0 runs the CPU stages on the event loop. Defaults to the CPU count, or 0 up to the CPU count for the benchmark.')
+    parser.add_argument('--concurrency', type=int, help='Defaults to CONCURRENCY or 16')
+    parser.add_argument('--chunk-size', type=int, default=32)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--template', help='A format string for the user message such as "Summarize: {text}"')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--parse-content-json', action='store_true', help='Decode each assistant message as JSON')
+    parser.add_argument('--benchmark', action='store_true', help='Measure throughput against the local mock server for each --workers value')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--chat-latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("WARNING")
+
+    cpu_count = os.cpu_count() or 1
+    if args.benchmark:
+        args.concurrency = args.concurrency or 16
+        args.workers = args.workers or [0] + [n for n in (1, 2, 4, 8, 16, 32) if n < cpu_count] + [cpu_count]
+        benchmark(args)
+        return
+    if not args.output:
+        parser.error('--output is required unless --benchmark is used')
+    args.workers = args.workers or [cpu_count]
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME and optionally FOUNDRY_API_KEY.
+    ## Without an API key DefaultAzureCredential is used.
+    try:
+        settings = get_settings()
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+    args.concurrency = args.concurrency or settings.concurrency
+
+    asyncio.run(run(args, settings))
+
+if __name__ == "__main__":
+    main()
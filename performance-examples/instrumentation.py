@@ -0,0 +1,764 @@
+import argparse
+import bisect
+import contextvars
+import importlib.metadata
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import configure_logging
+
+## The transports are handed to the openai SDK so they have to come from the httpx package it uses.
+## openai 3 and later use httpx2, which has the same API. The version is read without importing openai.
+##
+try:
+    _openai_major = int(re.match(r'\D*(\d+)', importlib.metadata.version('openai')).group(1))
+except (importlib.metadata.PackageNotFoundError, AttributeError, ValueError):
+    _openai_major = 0
+if _openai_major >= 3:
+    import httpx2 as httpx
+else:
+    import httpx
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+## The usage block is near the end of a chat completion and in the last event of a stream, so only the
+## tail of the body is kept and searched instead of decoding the whole response a second time
+##
+USAGE_TAIL_BYTES = 8192
+_PROMPT_TOKENS = re.compile(rb'"prompt_tokens"\s*:\s*(\d+)')
+_COMPLETION_TOKENS = re.compile(rb'"completion_tokens"\s*:\s*(\d+)')
+_CACHED_TOKENS = re.compile(rb'"cached_tokens"\s*:\s*(\d+)')
+
+## These classes are a minimal Prometheus client. Each metric keeps one child per set of label values
+## and the registry renders them in the Prometheus text exposition format.
+##
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class Metric:
+    """This class is a labeled Prometheus metric
+        Args:
+            name (str): The metric name
+            documentation (str): The help text
+            labelnames (tuple): The label names
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """This function returns the child of a set of label values, creating it on first use
+            Args:
+                *values (str): The label values in the order of the label names
+            Returns:
+                child: An object with inc for counters or observe for histograms
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def render(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+class Histogram(Metric):
+    """This class is a labeled Prometheus histogram
+        Args:
+            name (str): The metric name
+            documentation (str): The help text
+            labelnames (tuple): The label names
+            buckets (tuple, optional): The upper bounds of the buckets. Defaults to latency buckets in seconds.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def render(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, (('le', bound),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}"
+
+class MetricsRegistry:
+    """This class holds metrics and renders them for a Prometheus scrape"""
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """This function renders every metric in the Prometheus text exposition format
+            Returns:
+                str: The exposition
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+## OpenTelemetry is optional. When opentelemetry-api is installed spans go to whatever tracer provider
+## the application configured, otherwise the span helpers do nothing.
+##
+_last_token_span = contextvars.ContextVar('last_token_span', default=None)
+
+try:
+    from opentelemetry import trace as _trace
+except ImportError:
+    _trace = None
+
+@contextmanager
+def span(name, attributes=None, links=None):
+    """This function opens an OpenTelemetry span when opentelemetry-api is installed
+        Args:
+            name (str): The span name
+            attributes (dict, optional): The span attributes
+            links (list, optional): The span contexts to link to
+        Yields:
+            Span: The span or None without OpenTelemetry
+    """
+    if _trace is None:
+        yield None
+        return
+    tracer = _trace.get_tracer('performance-examples')
+    with tracer.start_as_current_span(name, attributes=attributes, links=[_trace.Link(context) for context in links or ()]) as current:
+        yield current
+
+## This class records the metrics of every hot path of the samples, labeled by SDK flavor and
+## authentication mode. It hands out instrumented transports, policies and wrappers that are plugged
+## into the clients, so the calling code doesn't change.
+##
+class Instrumentation:
+    """This class records token acquisition, client construction, request latency, time to first token,
+        response size, throttling, retries and token usage
+        Args:
+            registry (MetricsRegistry, optional): The registry the metrics are added to. Defaults to a new registry.
+    """
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        labels = ('sdk', 'auth')
+        add = self.registry.register
+        self.token_seconds = add(Histogram('llm_token_acquisition_seconds', 'Time spent getting an access token', labels))
+        self.construction_seconds = add(Histogram('llm_client_construction_seconds', 'Time spent building a client or credential', labels))
+        self.request_seconds = add(Histogram('llm_request_duration_seconds', 'Time from sending a request to reading the last byte of the response', labels))
+        self.ttft_seconds = add(Histogram('llm_time_to_first_token_seconds', 'Time from sending a streaming request to its first event', labels))
+        self.response_bytes = add(Histogram('llm_response_size_bytes', 'Size of response bodies', labels, buckets=SIZE_BUCKETS))
+        self.requests = add(Counter('llm_requests_total', 'HTTP requests sent including retries', (*labels, 'status')))
+        self.throttled = add(Counter('llm_throttled_requests_total', 'Responses with status 429', labels))
+        self.retries = add(Counter('llm_retries_total', 'Requests that were retries of an earlier attempt', labels))
+        self.tokens = add(Counter('llm_tokens_total', 'Tokens reported in the usage of responses', (*labels, 'type')))
+
+    @contextmanager
+    def construction(self, sdk, auth):
+        """This function times the construction of a client or credential
+            Args:
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+        """
+        start = time.perf_counter()
+        with span('client.construct', {'sdk': sdk, 'auth': auth}):
+            yield
+        self.construction_seconds.labels(sdk, auth).observe(time.perf_counter() - start)
+
+    def record_token(self, sdk, auth, elapsed, current=None):
+        self.token_seconds.labels(sdk, auth).observe(elapsed)
+        if current is not None:
+            _last_token_span.set(current.get_span_context())
+
+    def record_response(self, sdk, auth, status, elapsed, size, tail, first_byte=None, retry=False):
+        """This function records one HTTP response
+            Args:
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+                status (int): The HTTP status code
+                elapsed (float): Seconds from sending the request to reading the whole body
+                size (int): The size of the body in bytes
+                tail (bytes): The end of the body which holds the usage block
+                first_byte (float, optional): Seconds to the first event of a streaming response
+                retry (bool, optional): The request was a retry of an earlier attempt
+        """
+        self.request_seconds.labels(sdk, auth).observe(elapsed)
+        self.response_bytes.labels(sdk, auth).observe(size)
+        self.requests.labels(sdk, auth, str(status)).inc()
+        if first_byte is not None:
+            self.ttft_seconds.labels(sdk, auth).observe(first_byte)
+        if status == 429:
+            self.throttled.labels(sdk, auth).inc()
+        if retry:
+            self.retries.labels(sdk, auth).inc()
+        if status < 400 and tail:
+            prompt = _PROMPT_TOKENS.findall(tail)
+            completion = _COMPLETION_TOKENS.findall(tail)
+            if prompt:
+                self.tokens.labels(sdk, auth, 'prompt').inc(int(prompt[-1]))
+            if completion:
+                self.tokens.labels(sdk, auth, 'completion').inc(int(completion[-1]))
+            ## Prompt tokens served from the prompt cache, which are also counted in the prompt tokens
+            cached = _CACHED_TOKENS.findall(tail)
+            if cached:
+                self.tokens.labels(sdk, auth, 'cached_prompt').inc(int(cached[-1]))
+
+    def token_provider(self, provider, sdk, auth):
+        """This function wraps a bearer token provider so each call is timed and traced
+            Args:
+                provider (callable): A function that returns an access token
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                token_provider: The wrapped provider
+        """
+        def instrumented_provider():
+            start = time.perf_counter()
+            with span('token.acquire', {'sdk': sdk, 'auth': auth}) as current:
+                token = provider()
+            self.record_token(sdk, auth, time.perf_counter() - start, current)
+            return token
+        return instrumented_provider
+
+    def async_token_provider(self, provider, sdk, auth):
+        """This function wraps an async bearer token provider so each call is timed and traced
+            Args:
+                provider (callable): A coroutine function that returns an access token
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                token_provider: The wrapped provider
+        """
+        async def instrumented_provider():
+            start = time.perf_counter()
+            with span('token.acquire', {'sdk': sdk, 'auth': auth}) as current:
+                token = await provider()
+            self.record_token(sdk, auth, time.perf_counter() - start, current)
+            return token
+        return instrumented_provider
+
+    def credential(self, credential, sdk, auth):
+        """This function wraps an azure-identity credential so each get_token call is timed and traced
+            Args:
+                credential (TokenCredential): A sync credential
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                credential: The wrapped credential
+        """
+        return _InstrumentedCredential(self, credential, sdk, auth)
+
+    def async_credential(self, credential, sdk, auth):
+        """This function wraps an azure.identity.aio credential so each get_token call is timed and traced
+            Args:
+                credential (AsyncTokenCredential): An async credential
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                credential: The wrapped credential
+        """
+        return _InstrumentedAsyncCredential(self, credential, sdk, auth)
+
+    def http_client(self, sdk, auth):
+        """This function builds an httpx client for the OpenAI SDK and LangChain with an instrumented transport
+            Args:
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                httpx.Client: The client to pass as http_client
+        """
+        from openai import DefaultHttpxClient
+        ## The limits match the openai SDK defaults, which don't apply once a transport is passed in
+        transport = httpx.HTTPTransport(limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100))
+        return DefaultHttpxClient(transport=InstrumentedTransport(self, sdk, auth, transport))
+
+    def async_http_client(self, sdk, auth):
+        """This function builds an httpx async client for the OpenAI SDK and LangChain with an instrumented transport
+            Args:
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                httpx.AsyncClient: The client to pass as http_client or http_async_client
+        """
+        from openai import DefaultAsyncHttpxClient
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100))
+        return DefaultAsyncHttpxClient(transport=AsyncInstrumentedTransport(self, sdk, auth, transport))
+
+    def policy(self, sdk, auth):
+        """This function builds an azure-core policy for the Azure AI Inference clients. Pass it in
+            per_retry_policies so every attempt is recorded.
+            Args:
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+            Returns:
+                SansIOHTTPPolicy: The policy
+        """
+        return _instrumentation_policy(self, sdk, auth)
+
+    def mount(self, session, sdk, auth):
+        """This function replaces the https and http adapters of a requests Session with instrumented ones
+            that keep the pool settings of the adapters they replace
+            Args:
+                session (requests.Session): The session used by the REST samples
+                sdk (str): The SDK flavor
+                auth (str): The authentication mode
+        """
+        for prefix in ('https://', 'http://'):
+            adapter = session.get_adapter(prefix)
+            session.mount(prefix, _instrumented_adapter(self, sdk, auth, adapter))
+
+class _InstrumentedCredential:
+    def __init__(self, instrumentation, credential, sdk, auth):
+        self._instrumentation = instrumentation
+        self._credential = credential
+        self._labels = (sdk, auth)
+
+    def get_token(self, *scopes, **kwargs):
+        start = time.perf_counter()
+        with span('token.acquire', {'sdk': self._labels[0], 'auth': self._labels[1]}) as current:
+            token = self._credential.get_token(*scopes, **kwargs)
+        self._instrumentation.record_token(*self._labels, time.perf_counter() - start, current)
+        return token
+
+    def close(self):
+        self._credential.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _InstrumentedAsyncCredential:
+    def __init__(self, instrumentation, credential, sdk, auth):
+        self._instrumentation = instrumentation
+        self._credential = credential
+        self._labels = (sdk, auth)
+
+    async def get_token(self, *scopes, **kwargs):
+        start = time.perf_counter()
+        with span('token.acquire', {'sdk': self._labels[0], 'auth': self._labels[1]}) as current:
+            token = await self._credential.get_token(*scopes, **kwargs)
+        self._instrumentation.record_token(*self._labels, time.perf_counter() - start, current)
+        return token
+
+    async def close(self):
+        await self._credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+## The transports wrap the response body so the request is only recorded once the SDK has read it all,
+## which is when the latency, size and usage of streaming and non-streaming responses are known
+##
+class _ResponseMeter:
+    def __init__(self, instrumentation, sdk, auth, status, streaming, retry, request_span, start):
+        self.instrumentation = instrumentation
+        self.sdk = sdk
+        self.auth = auth
+        self.status = status
+        self.streaming = streaming
+        self.retry = retry
+        self.request_span = request_span
+        self.start = start
+        self.first_byte = None
+        self.size = 0
+        self.tail = b''
+        self.done = False
+
+    def chunk(self, data):
+        if self.first_byte is None and self.streaming:
+            self.first_byte = time.perf_counter() - self.start
+        self.size += len(data)
+        self.tail = (self.tail + data)[-USAGE_TAIL_BYTES:]
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.instrumentation.record_response(
+            self.sdk, self.auth, self.status, time.perf_counter() - self.start,
+            self.size, self.tail, first_byte=self.first_byte, retry=self.retry
+        )
+        if self.request_span is not None:
+            self.request_span.set_attribute('http.status_code', self.status)
+            self.request_span.end()
+
+def _start_request(sdk, auth, method, path):
+    ## The span ends when the body has been read, which can be in another context than the one that
+    ## sent the request, so it is started without being made current. It links to the token span.
+    if _trace is None:
+        return None
+    token_context = _last_token_span.get()
+    _last_token_span.set(None)
+    return _trace.get_tracer('performance-examples').start_span(
+        'llm.request',
+        attributes={'sdk': sdk, 'auth': auth, 'http.method': method, 'url.path': path},
+        links=[_trace.Link(token_context)] if token_context is not None else None
+    )
+
+def _fail_request(request_span, error):
+    if request_span is not None:
+        request_span.record_exception(error)
+        request_span.end()
+
+def _is_streaming(headers):
+    return headers.get('content-type', '').startswith('text/event-stream')
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """This class wraps an httpx transport and records every request sent through it
+        Args:
+            instrumentation (Instrumentation): Where the measurements are recorded
+            sdk (str): The SDK flavor
+            auth (str): The authentication mode
+            transport (httpx.BaseTransport): The transport that sends the requests
+    """
+    def __init__(self, instrumentation, sdk, auth, transport):
+        self.instrumentation = instrumentation
+        self.sdk = sdk
+        self.auth = auth
+        self.transport = transport
+
+    def handle_request(self, request):
+        retry = request.headers.get('x-stainless-retry-count', '0') != '0'
+        request_span = _start_request(self.sdk, self.auth, request.method, request.url.path)
+        start = time.perf_counter()
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException as e:
+            _fail_request(request_span, e)
+            raise
+        meter = _ResponseMeter(self.instrumentation, self.sdk, self.auth, response.status_code,
+                               _is_streaming(response.headers), retry, request_span, start)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_MeteredStream(response.stream, meter),
+            extensions=response.extensions
+        )
+
+    def close(self):
+        self.transport.close()
+
+class AsyncInstrumentedTransport(httpx.AsyncBaseTransport):
+    """This class wraps an httpx async transport and records every request sent through it
+        Args:
+            instrumentation (Instrumentation): Where the measurements are recorded
+            sdk (str): The SDK flavor
+            auth (str): The authentication mode
+            transport (httpx.AsyncBaseTransport): The transport that sends the requests
+    """
+    def __init__(self, instrumentation, sdk, auth, transport):
+        self.instrumentation = instrumentation
+        self.sdk = sdk
+        self.auth = auth
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        retry = request.headers.get('x-stainless-retry-count', '0') != '0'
+        request_span = _start_request(self.sdk, self.auth, request.method, request.url.path)
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException as e:
+            _fail_request(request_span, e)
+            raise
+        meter = _ResponseMeter(self.instrumentation, self.sdk, self.auth, response.status_code,
+                               _is_streaming(response.headers), retry, request_span, start)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_AsyncMeteredStream(response.stream, meter),
+            extensions=response.extensions
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class _MeteredStream(httpx.SyncByteStream):
+    def __init__(self, stream, meter):
+        self.stream = stream
+        self.meter = meter
+
+    def __iter__(self):
+        for data in self.stream:
+            self.meter.chunk(data)
+            yield data
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.meter.finish()
+
+class _AsyncMeteredStream(httpx.AsyncByteStream):
+    def __init__(self, stream, meter):
+        self.stream = stream
+        self.meter = meter
+
+    async def __aiter__(self):
+        async for data in self.stream:
+            self.meter.chunk(data)
+            yield data
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.meter.finish()
+
+def _instrumentation_policy(instrumentation, sdk, auth):
+    from azure.core.pipeline.policies import SansIOHTTPPolicy
+
+    ## azure-core reads non-streaming bodies before the policies see the response, so time to first
+    ## token is not recorded for the Azure AI Inference clients
+    class InstrumentationPolicy(SansIOHTTPPolicy):
+        def on_request(self, request):
+            request.context['instrumentation_start'] = time.perf_counter()
+
+        def on_response(self, request, response):
+            http_response = response.http_response
+            try:
+                body = http_response.body() or b''
+            except Exception:
+                ## The body of a streaming response has not been read yet
+                body = b''
+            instrumentation.record_response(
+                sdk, auth, http_response.status_code,
+                time.perf_counter() - request.context['instrumentation_start'],
+                len(body) or int(http_response.headers.get('content-length', 0)),
+                body[-USAGE_TAIL_BYTES:],
+                retry=request.context.get('retry_count', 0) > 0
+            )
+
+    return InstrumentationPolicy()
+
+def _instrumented_adapter(instrumentation, sdk, auth, adapter):
+    from requests.adapters import HTTPAdapter
+
+    class InstrumentedAdapter(HTTPAdapter):
+        def send(self, request, stream=False, **kwargs):
+            start = time.perf_counter()
+            response = super().send(request, stream=stream, **kwargs)
+            body = b'' if stream else response.content
+            instrumentation.record_response(
+                sdk, auth, response.status_code, time.perf_counter() - start,
+                len(body) or int(response.headers.get('content-length', 0)),
+                body[-USAGE_TAIL_BYTES:]
+            )
+            return response
+
+    return InstrumentedAdapter(
+        pool_connections=getattr(adapter, '_pool_connections', 10),
+        pool_maxsize=getattr(adapter, '_pool_maxsize', 10),
+        max_retries=adapter.max_retries,
+        pool_block=getattr(adapter, '_pool_block', False)
+    )
+
+## This function serves the registry at /metrics for Prometheus to scrape
+##
+def start_metrics_server(registry, host='127.0.0.1', port=9464):
+    """This function starts a /metrics endpoint in a background thread. The endpoint has no authentication,
+        so it only listens on the loopback interface unless a deployment passes a wider host such as 0.0.0.0.
+        Args:
+            registry (MetricsRegistry): The metrics to serve
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 9464.
+        Returns:
+            server: The ThreadingHTTPServer. Call shutdown() when done with it
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+## The demo measures what the instrumentation costs. The per-request cost is measured against an
+## in-memory transport so network noise doesn't hide it, and compared with the latency of a request
+## to the mock server. Then the same client is run with and without instrumentation against the mock.
+##
+def _measure_transport_cost(instrumentation, requests_count):
+    body = json.dumps({
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Honey never spoils."}}],
+        "usage": {"prompt_tokens": 20, "completion_tokens": 12, "total_tokens": 32}
+    }).encode('utf-8')
+    handler = lambda request: httpx.Response(200, headers={'content-type': 'application/json'}, content=body)
+    plain = httpx.Client(transport=httpx.MockTransport(handler))
+    instrumented = httpx.Client(transport=InstrumentedTransport(instrumentation, 'openai', 'api-key', httpx.MockTransport(handler)))
+    timings = {}
+    for name, client in (('plain', plain), ('instrumented', instrumented), ('plain', plain), ('instrumented', instrumented)):
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            client.post('http://mock/openai/v1/chat/completions', content=b'{}').read()
+        timings[name] = (time.perf_counter() - start) / requests_count
+    plain.close()
+    instrumented.close()
+    return timings['instrumented'] - timings['plain']
+
+def _measure_throughput(url, instrumentation, requests_count, rounds):
+    from openai import OpenAI
+
+    clients = {
+        'plain': OpenAI(base_url=f"{url}/openai/v1", api_key='mock-key'),
+        'instrumented': OpenAI(base_url=f"{url}/openai/v1", api_key='mock-key', http_client=instrumentation.http_client('openai', 'api-key'))
+    }
+    messages = [{"role": "user", "content": "Tell me an interesting fact"}]
+    elapsed = {name: 0.0 for name in clients}
+    for _ in range(rounds):
+        ## Rounds alternate so drift in the mock server affects both modes alike
+        for name, client in clients.items():
+            start = time.perf_counter()
+            for _ in range(requests_count):
+                client.chat.completions.create(model='gpt-4.1', messages=messages, max_tokens=100)
+            elapsed[name] += time.perf_counter() - start
+    for client in clients.values():
+        client.close()
+    total = requests_count * rounds
+    return {name: total / seconds for name, seconds in elapsed.items()}
+
+def _run_scenario(url, instrumentation, requests_count):
+    ## Drives every instrumented path through the client factory. The mock server throttles and fails
+    ## some requests so the 429 and retry counters move, and managed identity is served by the mock.
+    import os
+    from client_factory import ClientFactory
+
+    os.environ['IDENTITY_ENDPOINT'] = f"{url}/msi/token"
+    os.environ['IDENTITY_HEADER'] = 'mock-identity-header'
+    factory = ClientFactory(instrumentation=instrumentation)
+    messages = [{"role": "user", "content": "Tell me an interesting fact"}]
+    try:
+        client = factory.openai(url, auth='managed-identity')
+        for _ in range(requests_count):
+            client.chat.completions.create(model='gpt-4.1', messages=messages, max_tokens=100)
+        for _ in range(max(1, requests_count // 10)):
+            stream = client.chat.completions.create(model='gpt-4.1', messages=messages, max_tokens=100,
+                                                    stream=True, stream_options={"include_usage": True})
+            for _ in stream:
+                pass
+        inference = factory.inference(url, 'gpt-4.1', auth='managed-identity')
+        for _ in range(max(1, requests_count // 10)):
+            inference.complete(messages=messages, max_tokens=100, model='gpt-4.1', enforce_https=False)
+    finally:
+        factory.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of the instrumentation and serve the metrics it records')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--chat-latency', type=float, default=0.02, help='Seconds the mock server takes to answer')
+    parser.add_argument('--metrics-port', type=int, default=9464)
+    parser.add_argument('--serve', action='store_true', help='Keep serving /metrics after the measurements until interrupted')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+    server = start_mock_server_process(chat_latency=args.chat_latency)
+    scenario_server = start_mock_server_process(chat_latency=args.chat_latency, rpm_limit=600, fault_rate=0.05)
+    instrumentation = Instrumentation()
+    metrics_server = start_metrics_server(instrumentation.registry, host='127.0.0.1', port=args.metrics_port)
+    try:
+        cost = _measure_transport_cost(Instrumentation(), args.requests * 4)
+        throughput = _measure_throughput(server.url, Instrumentation(), args.requests, args.rounds)
+        request_latency = 1 / throughput['plain']
+        print(json.dumps({
+            "instrumentation_cost_us": round(cost * 1e6, 2),
+            "mock_request_ms": round(request_latency * 1000, 3),
+            "cost_share_of_request_pct": round(cost / request_latency * 100, 3),
+            "plain_requests_per_s": round(throughput['plain'], 2),
+            "instrumented_requests_per_s": round(throughput['instrumented'], 2),
+            "throughput_change_pct": round((throughput['instrumented'] / throughput['plain'] - 1) * 100, 3)
+        }))
+
+        _run_scenario(scenario_server.url, instrumentation, args.requests)
+        import urllib.request
+        with urllib.request.urlopen(f"http://127.0.0.1:{args.metrics_port}/metrics") as response:
+            scraped = response.read().decode('utf-8')
+        print('\n'.join(line for line in scraped.splitlines() if not line.startswith('#') and '_bucket' not in line))
+
+        if args.serve:
+            print(f"Serving http://127.0.0.1:{args.metrics_port}/metrics. Press Ctrl+C to stop.")
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics_server.shutdown()
+        scenario_server.shutdown()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import namedtuple
+from dataclasses import replace
+
+from batch_runner import InvalidRecord, build_messages, get_credential, read_prompts
+from settings import AUTH_MODES, ConfigurationError, Identity, get_settings, mock_settings
+from utils import configure_logging, percentile
+
+## This module runs prompts through LangChain's AzureChatOpenAI with Runnable.batch, abatch and
+## astream_events. max_concurrency bounds the requests in flight, and a refreshing token provider
+## replaces the static azure_ad_token so a long job keeps working after the first token expires.
+##
+SCOPE = "https://cognitiveservices.azure.com/.default"
+MODES = ('batch', 'abatch', 'stream')
+
+AccessToken = namedtuple('AccessToken', ['token', 'expires_on'])
+
+## This class lets AsyncTokenProvider cache and refresh tokens from a token fetcher. The fetch is
+## blocking HTTP so it runs in a thread and a refresh never stalls the event loop.
+##
+class _FetcherCredential:
+    def __init__(self, fetch_token):
+        self.fetch_token = fetch_token
+
+    async def get_token(self, *scopes, **kwargs):
+        access_token, expires_on = await asyncio.to_thread(self.fetch_token)
+        return AccessToken(access_token, float(expires_on))
+
+class TokenProviders:
+    """This class builds the sync and async token providers passed to AzureChatOpenAI and counts token fetches.
+        Service principal and managed identity tokens are cached and refreshed before they expire. The
+        other Entra ID modes use the providers of the batch runner.
+        Args:
+            auth (str): One of api-key, managed-identity, service-principal, obo or default
+            settings (Settings): The settings
+    """
+    def __init__(self, auth, settings):
+        self.auth = auth
+        self.settings = settings
+        self.fetches = 0
+        self._fetch_token = None
+        self._async_provider = None
+        if auth in ('service-principal', 'managed-identity'):
+            from cli import get_token_fetcher
+            from token_cache import TokenCache
+            key, fetch_token = get_token_fetcher(auth, settings.identity)
+
+            def counted_fetch():
+                self.fetches += 1
+                return fetch_token()
+            self._fetch_token = counted_fetch
+            cache = TokenCache(path=settings.token_cache_path, refresh_margin=settings.token_refresh_margin)
+            self.token_provider = lambda: cache.get_token(key, counted_fetch)
+        elif auth == 'api-key':
+            self.token_provider = None
+        else:
+            self.token_provider = get_credential(auth, settings)
+
+    def async_token_provider(self):
+        """This function returns an async token provider for the running event loop
+            Returns:
+                token_provider: A coroutine function that returns an access token, or None to use the sync provider
+        """
+        if self._fetch_token is None:
+            return None
+        from async_token_provider import AsyncTokenProvider
+        self._async_provider = AsyncTokenProvider(
+            _FetcherCredential(self._fetch_token),
+            expiry_margin=min(30.0, self.settings.token_refresh_margin)
+        )
+        return self._async_provider.provider(SCOPE)
+
+    async def aclose(self):
+        """This function stops the background refreshes of the async provider"""
+        if self._async_provider is not None:
+            await self._async_provider.close()
+            self._async_provider = None
+
+## This function builds the chat model. A new one is built for each event loop because the async
+## client keeps its connections on the loop that opened them.
+##
+def build_llm(profile, settings, providers=None, static_token=None, max_tokens=100, http_async_client=None):
+    """This function builds an AzureChatOpenAI chat model
+        Args:
+            profile (Profile): The endpoint, deployment and API version
+            settings (Settings): The settings with the retries and timeout
+            providers (TokenProviders, optional): The token providers. Not needed for api-key authentication.
+            static_token (str, optional): A single access token, which is what the LangChain sample used to pass
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+            http_async_client (AsyncClient, optional): The async HTTP client. Defaults to one LangChain shares between event loops.
+        Returns:
+            AzureChatOpenAI: The chat model
+    """
+    from langchain_openai import AzureChatOpenAI
+
+    options = {
+        "azure_endpoint": profile.endpoint,
+        "azure_deployment": profile.deployment,
+        "api_version": profile.api_version,
+        "max_retries": settings.max_retries,
+        "timeout": settings.request_timeout,
+        "max_tokens": max_tokens,
+        ## Streamed responses only carry token usage when it is asked for
+        "stream_usage": True
+    }
+    if http_async_client is not None:
+        options["http_async_client"] = http_async_client
+    if static_token is not None:
+        options["azure_ad_token"] = static_token
+    elif providers is None or providers.auth == 'api-key':
+        options["api_key"] = profile.api_key
+    else:
+        options["azure_ad_token_provider"] = providers.token_provider
+        options["azure_ad_async_token_provider"] = providers.async_token_provider()
+    return AzureChatOpenAI(**options)
+
+class RunStats:
+    """This class counts the requests, errors, tokens and time to first token of a run"""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.ttfts = []
+        self.start = time.perf_counter()
+
+    def row(self, line, record, output):
+        """This function records a result and returns its output line
+            Args:
+                line (int): The input line number
+                record (dict): The input record
+                output (AIMessage or Exception): The chat model output
+            Returns:
+                dict: The result written to the output file
+        """
+        self.requests += 1
+        result = {"line": line}
+        if 'id' in record:
+            result["id"] = record['id']
+        if isinstance(output, Exception):
+            self.errors += 1
+            logging.error(f'Failed chat completion for line {line}: {output}')
+            result["content"] = None
+            result["error"] = str(output)
+            return result
+        usage = output.usage_metadata or {}
+        self.input_tokens += usage.get('input_tokens', 0)
+        self.output_tokens += usage.get('output_tokens', 0)
+        result["content"] = output.content
+        result["error"] = None
+        result["usage"] = {"input_tokens": usage.get('input_tokens'), "output_tokens": usage.get('output_tokens')}
+        return result
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            "requests": self.requests,
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(self.requests / elapsed, 2) if elapsed else 0.0,
+            "output_tokens": self.output_tokens,
+            "output_tokens_per_s": round(self.output_tokens / elapsed, 1) if elapsed else 0.0,
+            "total_tokens_per_s": round((self.input_tokens + self.output_tokens) / elapsed, 1) if elapsed else 0.0
+        }
+        if self.ttfts:
+            summary["ttft_p50_ms"] = round(percentile(self.ttfts, 50) * 1000, 3)
+            summary["ttft_p99_ms"] = round(percentile(self.ttfts, 99) * 1000, 3)
+        return summary
+
+## The prompts are read in chunks so memory stays flat on large inputs. Each chunk is one batch call.
+## Lines that can't be turned into messages get their error result right away and stay out of the chunks.
+##
+def read_chunks(input_stream, chunk_size, output, stats):
+    chunk = []
+    for line, record in read_prompts(input_stream):
+        if record is None:
+            continue
+        if isinstance(record, InvalidRecord):
+            output.write(json.dumps(stats.row(line, {}, ValueError(record.error))) + '\n')
+            continue
+        try:
+            messages = build_messages(record)
+        except (KeyError, TypeError) as e:
+            output.write(json.dumps(stats.row(line, record, ValueError(f'Line {line} has no prompt or messages: {e!r}'))) + '\n')
+            continue
+        chunk.append((line, record, messages))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def run_batch(llm, input_stream, output, concurrency=16, chunk_size=256):
+    """This function runs the prompts with Runnable.batch, which sends them from a thread pool
+        Args:
+            llm (AzureChatOpenAI): The chat model
+            input_stream (file): A text stream with one JSON object per line
+            output (file): The text stream the JSONL results are written to
+            concurrency (int, optional): The max_concurrency of the batch. Defaults to 16.
+            chunk_size (int, optional): The number of prompts per batch call. Defaults to 256.
+        Returns:
+            dict: The throughput summary
+    """
+    stats = RunStats()
+    for chunk in read_chunks(input_stream, chunk_size, output, stats):
+        outputs = llm.batch([messages for _, _, messages in chunk], config={"max_concurrency": concurrency}, return_exceptions=True)
+        for (line, record, _), result in zip(chunk, outputs):
+            output.write(json.dumps(stats.row(line, record, result)) + '\n')
+    return stats.summary()
+
+async def run_abatch(llm, input_stream, output, concurrency=16, chunk_size=256):
+    """This function runs the prompts with Runnable.abatch on the event loop
+        Args:
+            llm (AzureChatOpenAI): The chat model
+            input_stream (file): A text stream with one JSON object per line
+            output (file): The text stream the JSONL results are written to
+            concurrency (int, optional): The max_concurrency of the batch. Defaults to 16.
+            chunk_size (int, optional): The number of prompts per batch call. Defaults to 256.
+        Returns:
+            dict: The throughput summary
+    """
+    stats = RunStats()
+    for chunk in read_chunks(input_stream, chunk_size, output, stats):
+        outputs = await llm.abatch([messages for _, _, messages in chunk], config={"max_concurrency": concurrency}, return_exceptions=True)
+        for (line, record, _), result in zip(chunk, outputs):
+            output.write(json.dumps(stats.row(line, record, result)) + '\n')
+    return stats.summary()
+
+async def run_stream(llm, input_stream, output, concurrency=16, chunk_size=256):
+    """This function runs each chunk through abatch inside astream_events, so responses stream in token by
+        token and each result is written as soon as its request finishes. Results are in completion order.
+        Args:
+            llm (AzureChatOpenAI): The chat model
+            input_stream (file): A text stream with one JSON object per line
+            output (file): The text stream the JSONL results are written to
+            concurrency (int, optional): The max_concurrency of the batch. Defaults to 16.
+            chunk_size (int, optional): The number of prompts per batch call. Defaults to 256.
+        Returns:
+            dict: The throughput summary
+    """
+    from langchain_core.runnables import RunnableLambda
+
+    stats = RunStats()
+    for chunk in read_chunks(input_stream, chunk_size, output, stats):
+        ## The input index travels in the run metadata so each event can be matched to its prompt
+        configs = [{"max_concurrency": concurrency, "metadata": {"index": i}} for i in range(len(chunk))]
+        outputs = []
+
+        async def fan_out(batch):
+            outputs.extend(await llm.abatch(batch, config=configs, return_exceptions=True))
+            return len(outputs)
+
+        started = {}
+        done = set()
+        async for event in RunnableLambda(fan_out).astream_events([messages for _, _, messages in chunk], version='v2'):
+            kind = event['event']
+            if kind == 'on_chat_model_start':
+                started[event['run_id']] = time.perf_counter()
+            elif kind == 'on_chat_model_stream':
+                ## The first chunk only carries the role, so time to first token is taken at the first content
+                if event['run_id'] in started and event['data']['chunk'].content:
+                    stats.ttfts.append(time.perf_counter() - started.pop(event['run_id']))
+            elif kind == 'on_chat_model_end':
+                index = event['metadata']['index']
+                line, record, _ = chunk[index]
+                done.add(index)
+                output.write(json.dumps(stats.row(line, record, event['data']['output'])) + '\n')
+
+        ## Failed requests end without an end event and come back as exceptions from abatch
+        for index, result in enumerate(outputs):
+            if index not in done:
+                line, record, _ = chunk[index]
+                output.write(json.dumps(stats.row(line, record, result)) + '\n')
+    return stats.summary()
+
+async def _run_async(mode, profile, settings, providers, input_stream, output, args, static_token=None):
+    from openai import DefaultAsyncHttpxClient
+
+    ## LangChain otherwise caches one async client per process, which breaks once its event loop is closed
+    http_async_client = DefaultAsyncHttpxClient(timeout=settings.request_timeout)
+    llm = build_llm(profile, settings, providers, static_token=static_token, max_tokens=args.max_tokens, http_async_client=http_async_client)
+    try:
+        run = run_stream if mode == 'stream' else run_abatch
+        return await run(llm, input_stream, output, concurrency=args.concurrency, chunk_size=args.chunk_size)
+    finally:
+        await providers.aclose()
+        await http_async_client.aclose()
+
+def run_mode(mode, profile, settings, providers, input_stream, output, args, static_token=None):
+    """This function runs the prompts with one of the modes
+        Args:
+            mode (str): One of batch, abatch or stream
+            profile (Profile): The endpoint, deployment and API version
+            settings (Settings): The settings
+            providers (TokenProviders): The token providers
+            input_stream (file): A text stream with one JSON object per line
+            output (file): The text stream the JSONL results are written to
+            args (Namespace): The concurrency, chunk_size and max_tokens options
+            static_token (str, optional): Use a single access token instead of the providers
+        Returns:
+            dict: The throughput summary
+    """
+    fetches = providers.fetches
+    if mode == 'batch':
+        llm = build_llm(profile, settings, providers, static_token=static_token, max_tokens=args.max_tokens)
+        summary = run_batch(llm, input_stream, output, concurrency=args.concurrency, chunk_size=args.chunk_size)
+    else:
+        summary = asyncio.run(_run_async(mode, profile, settings, providers, input_stream, output, args, static_token))
+    return {
+        "mode": mode,
+        "auth": 'static-token' if static_token else providers.auth,
+        "concurrency": args.concurrency,
+        **summary,
+        "token_fetches": providers.fetches - fetches
+    }
+
+def demo(args):
+    from io import StringIO
+    from mock_server import start_mock_server_process
+
+    ## Tokens from the mock expire after a few seconds and expired tokens are rejected, so each run
+    ## outlives several tokens. The static token is what the LangChain sample passed before.
+    server = start_mock_server_process(chat_latency=args.chat_latency, stream_delay=0.002, token_lifetime=args.token_lifetime)
+    settings = mock_settings(
+        server.url,
+        concurrency=args.concurrency,
+        token_refresh_margin=1,
+        identity=Identity(tenant_id='mock-tenant', client_id='mock-client-id', client_secret='mock-client-secret', authority_host=server.url)
+    )
+    profile = replace(settings.profile(), auth_mode='service-principal')
+    prompts = ''.join(json.dumps({"id": i, "prompt": f"Tell me an interesting fact about the number {i}"}) + '\n' for i in range(args.requests))
+    try:
+        providers = TokenProviders('service-principal', settings)
+        with open(os.devnull, 'w') as output:
+            ## Requests with the expired static token are expected to fail, so their errors aren't logged
+            static_token = providers.token_provider()
+            logging.disable(logging.ERROR)
+            try:
+                print(json.dumps(run_mode('abatch', profile, settings, providers, StringIO(prompts), output, args, static_token=static_token)))
+            finally:
+                logging.disable(logging.NOTSET)
+            for mode in args.mode:
+                print(json.dumps(run_mode(mode, profile, settings, providers, StringIO(prompts), output, args)))
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run prompts through LangChain batch, abatch or astream_events with a refreshing token provider')
+    parser.add_argument('--mode', nargs='+', choices=MODES, help='The mode of a run, abatch by default. The mock demo compares every mode given and defaults to all of them')
+    parser.add_argument('--input', default='-', help='The JSONL input file or - for stdin')
+    parser.add_argument('--output', help='The JSONL output file')
+    parser.add_argument('--auth', choices=AUTH_MODES, help='Overrides AUTH_MODE')
+    parser.add_argument('--concurrency', type=int, help='The max_concurrency of each batch. Defaults to CONCURRENCY or 16')
+    parser.add_argument('--chunk-size', type=int, default=256, help='The number of prompts per batch call')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--mock', action='store_true', help='Compare a static token with the refreshing provider in each mode against the local mock server')
+    parser.add_argument('--requests', type=int, default=1000, help='The number of prompts sent by the mock demo')
+    parser.add_argument('--chat-latency', type=float, default=0.05)
+    parser.add_argument('--token-lifetime', type=int, default=3, help='The lifetime in seconds of the tokens handed out by the mock')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    if args.mock:
+        args.concurrency = args.concurrency or 16
+        args.mode = args.mode or list(MODES)
+        demo(args)
+        return
+    if not args.output:
+        parser.error('--output is required unless --mock is used')
+    ## Every mode would write the results of the whole input to the same output file
+    args.mode = args.mode or ['abatch']
+    if len(args.mode) > 1:
+        parser.error('Only one --mode can be run at a time unless --mock is used')
+    mode = args.mode[0]
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME, OPENAI_API_VERSION and the
+    ## variables used by the selected authentication mode
+    try:
+        settings = get_settings()
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+    profile = settings.profile()
+    args.concurrency = args.concurrency or settings.concurrency
+
+    try:
+        providers = TokenProviders(args.auth or profile.auth_mode, settings)
+    except Exception:
+        logging.error('Failed to obtain access token: ', exc_info=True)
+        sys.exit(1)
+
+    input_stream = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    try:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            print(json.dumps(run_mode(mode, profile, settings, providers, input_stream, output, args)))
+    except Exception:
+        logging.error('Failed to run the prompts: ', exc_info=True)
+        sys.exit(1)
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from response_parser import read_completion
+from retry_policy import retry_after_seconds
+from settings import ConfigurationError, get_settings
+from utils import configure_logging
+
+## This exception is raised by a request function when a backend is throttling, failing or can't be
+## reached so the router can eject it and fail over to another backend
+##
+class BackendUnavailable(Exception):
+    """This exception is raised when a backend is throttling or unavailable
+        Args:
+            status_code (int): The status code returned by the backend or None when it could not be reached
+            retry_after (float, optional): The number of seconds the backend asked to wait
+    """
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f'Backend returned {status_code}' if status_code is not None else 'Backend could not be reached')
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class Backend:
+    """This class is one regional deployment the router can send requests to
+        Args:
+            endpoint (str): The Foundry endpoint
+            deployment (str): The deployment name at that endpoint
+            credential (str or callable): An API key or a token provider
+            weight (float, optional): The relative capacity of the backend, such as its share of quota. Defaults to 1.
+    """
+    def __init__(self, endpoint, deployment, credential, weight=1.0):
+        self.endpoint = endpoint.rstrip('/')
+        self.deployment = deployment
+        self.credential = credential
+        self.weight = weight
+        self.outstanding = 0
+        self.latency = 0.0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self._http_client = None
+        self._openai_client = None
+        self._clients_lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"{self.endpoint}/{self.deployment}"
+
+    def http_client(self):
+        """This function returns the pooled REST client of the backend, creating it on first use"""
+        with self._clients_lock:
+            if self._http_client is None:
+                from http_client import FoundryHttpClient
+                if callable(self.credential):
+                    self._http_client = FoundryHttpClient(self.endpoint, token_provider=self.credential)
+                else:
+                    self._http_client = FoundryHttpClient(self.endpoint, api_key=self.credential)
+            return self._http_client
+
+    def openai_client(self):
+        """This function returns the OpenAI v1 client of the backend, creating it on first use"""
+        with self._clients_lock:
+            if self._openai_client is None:
+                from openai import OpenAI
+
+                ## Retries are left to the router so throttled requests fail over to another region
+                self._openai_client = OpenAI(
+                    base_url=f"{self.endpoint}/openai/v1",
+                    api_key=self.credential,
+                    max_retries=0
+                )
+            return self._openai_client
+
+    def close(self):
+        if self._http_client is not None:
+            self._http_client.close()
+        if self._openai_client is not None:
+            self._openai_client.close()
+
+## This class spreads requests over several regional deployments, ejects backends that return
+## 429 or 5xx or can't be reached and fails over to the healthy ones
+##
+class Router:
+    """This class spreads requests over several deployments
+        Args:
+            backends (list): The Backend objects to route to
+            strategy (str, optional): least-outstanding or latency. Defaults to least-outstanding.
+            eject_seconds (float, optional): How long a backend is ejected when it does not send Retry-After. Defaults to 10.
+            latency_decay (float, optional): The weight of the newest sample in the latency moving average. Defaults to 0.2.
+    """
+    STRATEGIES = ('least-outstanding', 'latency')
+
+    def __init__(self, backends, strategy='least-outstanding', eject_seconds=10.0, latency_decay=0.2):
+        if not backends:
+            raise ValueError('At least one backend is required')
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f'Unknown strategy: {strategy}')
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.eject_seconds = eject_seconds
+        self.latency_decay = latency_decay
+        self._lock = threading.Lock()
+
+    def _score(self, backend):
+        if self.strategy == 'latency':
+            ## Expected wait is the average latency times the queue in front of the new request
+            return backend.latency * (backend.outstanding + 1) / backend.weight
+        return backend.outstanding / backend.weight
+
+    def _acquire(self, exclude):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            healthy = [b for b in candidates if b.ejected_until <= now]
+            if healthy:
+                best = min(self._score(b) for b in healthy)
+                backend = random.choice([b for b in healthy if self._score(b) == best])
+            else:
+                ## Every backend is ejected so use the one that comes back first
+                backend = min(candidates, key=lambda b: b.ejected_until)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def _release(self, backend, elapsed, error=None):
+        with self._lock:
+            backend.outstanding -= 1
+            if error is None:
+                if backend.latency:
+                    backend.latency += self.latency_decay * (elapsed - backend.latency)
+                else:
+                    backend.latency = elapsed
+            else:
+                backend.failures += 1
+                wait = error.retry_after if error.retry_after else self.eject_seconds
+                backend.ejected_until = max(backend.ejected_until, time.monotonic() + wait)
+                logging.warning(f'Ejected {backend.name} for {wait:.1f}s: {error}')
+
+    def call(self, request):
+        """This function sends a request to the best backend and fails over when it is unavailable
+            Args:
+                request (callable): A function that takes a Backend, sends the request and raises BackendUnavailable on 429, 5xx or a connection error
+            Returns:
+                The value returned by request
+        """
+        tried = set()
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                raise last_error
+            tried.add(backend)
+            start = time.perf_counter()
+            try:
+                result = request(backend)
+            except BackendUnavailable as e:
+                self._release(backend, time.perf_counter() - start, e)
+                last_error = e
+                continue
+            except Exception:
+                self._release(backend, time.perf_counter() - start)
+                raise
+            self._release(backend, time.perf_counter() - start)
+            return result
+
+    def chat_completion_rest(self, messages, **params):
+        """This function performs a chat completion over the REST API on the best backend
+            Args:
+                messages (list): The chat messages
+                **params: Additional parameters such as max_tokens
+            Returns:
+                ChatCompletion: The decoded chat completion response
+        """
+        import requests
+
+        def request(backend):
+            try:
+                response = backend.http_client().post(
+                    '/openai/v1/chat/completions',
+                    {"model": backend.deployment, "messages": messages, **params}
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise BackendUnavailable(None) from e
+            if response.status_code == 429 or response.status_code >= 500:
+                raise BackendUnavailable(response.status_code, retry_after_seconds(response.headers, default=None))
+            return read_completion(response)
+        return self.call(request)
+
+    def chat_completion_openai(self, messages, **params):
+        """This function performs a chat completion with the OpenAI v1 client of the best backend
+            Args:
+                messages (list): The chat messages
+                **params: Additional parameters such as max_tokens
+            Returns:
+                ChatCompletion: The chat completion
+        """
+        import openai
+
+        def request(backend):
+            try:
+                return backend.openai_client().chat.completions.create(model=backend.deployment, messages=messages, **params)
+            except openai.APIStatusError as e:
+                if e.status_code == 429 or e.status_code >= 500:
+                    raise BackendUnavailable(e.status_code, retry_after_seconds(e.response.headers, default=None)) from e
+                raise
+            except openai.APIConnectionError as e:
+                ## APITimeoutError is a subclass of APIConnectionError
+                raise BackendUnavailable(None) from e
+        return self.call(request)
+
+    def stats(self):
+        """This function returns the request counts and health of each backend"""
+        now = time.monotonic()
+        return [
+            {
+                "backend": b.name,
+                "requests": b.requests,
+                "failures": b.failures,
+                "latency_ms": round(b.latency * 1000, 3),
+                "ejected": b.ejected_until > now
+            }
+            for b in self.backends
+        ]
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+## This function builds the backends from the settings, which read them from the named profiles of
+## FOUNDRY_PROFILES or from FOUNDRY_BACKENDS, a JSON list of objects with endpoint, deployment and
+## optionally api_key and weight. Each backend authenticates with the auth mode of its profile, and
+## backends with the same Entra ID auth mode share one token provider.
+##
+def load_backends(settings):
+    """This function builds a backend for each backend profile of the settings
+        Args:
+            settings (Settings): The settings
+        Returns:
+            list: The Backend objects
+    """
+    from batch_runner import get_credential
+
+    token_providers = {}
+    backends = []
+    for profile in settings.backends:
+        if profile.auth_mode == 'api-key':
+            credential = profile.api_key
+        else:
+            if profile.auth_mode not in token_providers:
+                token_providers[profile.auth_mode] = get_credential(profile.auth_mode, settings)
+            credential = token_providers[profile.auth_mode]
+        backends.append(Backend(profile.endpoint, profile.deployment, credential, profile.weight))
+    return backends
+
+def run_demo(strategy, requests_count, concurrency):
+    from mock_server import start_mock_server_process
+
+    ## One fast region, one slow region and one region that is out of quota
+    servers = [
+        start_mock_server_process(chat_latency=0.02),
+        start_mock_server_process(chat_latency=0.1),
+        start_mock_server_process(chat_latency=0.02, rpm_limit=60)
+    ]
+    router = Router(
+        [Backend(s.url, 'gpt-4.1', 'mock-key') for s in servers],
+        strategy=strategy,
+        eject_seconds=2.0
+    )
+    messages = [{"role": "user", "content": "Tell me an interesting fact"}]
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: router.chat_completion_openai(messages, max_tokens=100), range(requests_count)))
+        elapsed = time.perf_counter() - start
+        print(json.dumps({
+            "strategy": strategy,
+            "requests": requests_count,
+            "succeeded": len(results),
+            "elapsed_s": round(elapsed, 3),
+            "backends": router.stats()
+        }, indent=2))
+    finally:
+        router.close()
+        for server in servers:
+            server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Spread chat completions over several deployments')
+    parser.add_argument('--strategy', default='least-outstanding', choices=Router.STRATEGIES)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mock', action='store_true', help='Run against three local mock regions')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    if args.mock:
+        run_demo(args.strategy, args.requests, args.concurrency)
+        return
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_PROFILES or FOUNDRY_BACKENDS
+    try:
+        settings = get_settings()
+    except ConfigurationError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    router = Router(load_backends(settings), strategy=args.strategy)
+    try:
+        response = router.chat_completion_openai(
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant that provides interesting facts."
+                },
+                {
+                    "role": "user",
+                    "content": "Tell me an interesting fact"
+                }
+            ],
+            max_tokens=100
+        )
+        print(response.choices[0].message.content)
+    except Exception:
+        logging.error('Failed chat completion: ', exc_info=True)
+        sys.exit(1)
+    finally:
+        router.close()
+
+if __name__ == "__main__":
+    main()
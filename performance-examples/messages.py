@@ -0,0 +1,356 @@
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from functools import lru_cache
+
+from response_parser import dumps
+from utils import configure_logging
+
+## This module is a compact chat message model shared by the samples. A Message is immutable and
+## holds only its role and content. A CachedMessage also keeps its JSON encoding and its Azure AI
+## Inference and LangChain forms once they are built. A system prompt built with system() is a single
+## shared CachedMessage, so it is encoded once however many conversations send it. Other messages are
+## only cached when asked, because a cache on every turn of a long history costs more memory than it
+## saves time. Functions that take messages accept Message objects and plain dicts with role and
+## content, so existing callers keep working.
+##
+class Message:
+    """This class holds an immutable chat message
+        Args:
+            role (str): system, user or assistant
+            content (str): The text of the message
+    """
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        object.__setattr__(self, 'role', role)
+        object.__setattr__(self, 'content', content)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Message is immutable')
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {self.content!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role == other.role and self.content == other.content
+
+    def __hash__(self):
+        return hash((self.role, self.content))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['role'], data['content'])
+
+    def as_dict(self):
+        """This function returns the message as a new dict with role and content"""
+        return {"role": self.role, "content": self.content}
+
+    def encoded(self):
+        """This function returns the JSON encoding of the message
+            Returns:
+                bytes: The message as a JSON object
+        """
+        return dumps({"role": self.role, "content": self.content})
+
+    def to_sdk(self, sdk):
+        """This function returns the message as a message object of an SDK
+            Args:
+                sdk (str): inference or langchain
+            Returns:
+                object: The SDK message
+        """
+        return _sdk_types(sdk)[self.role](content=self.content)
+
+class CachedMessage(Message):
+    """This class is a Message that keeps its JSON encoding and SDK forms once they are built
+        Args:
+            role (str): system, user or assistant
+            content (str): The text of the message
+    """
+    __slots__ = ('_json', '_sdk')
+
+    def __init__(self, role, content):
+        super().__init__(role, content)
+        object.__setattr__(self, '_json', None)
+        object.__setattr__(self, '_sdk', None)
+
+    def encoded(self):
+        """This function returns the JSON encoding of the message, encoding it on first use
+            Returns:
+                bytes: The message as a JSON object
+        """
+        if self._json is None:
+            ## orjson returns its output in a buffer of at least 4 KB, so the cached copy is trimmed to size
+            object.__setattr__(self, '_json', bytes(memoryview(super().encoded())))
+        return self._json
+
+    def to_sdk(self, sdk):
+        """This function returns the message as a message object of an SDK, building it on first use
+            Args:
+                sdk (str): inference or langchain
+            Returns:
+                object: The SDK message. It is shared, so don't modify it.
+        """
+        if self._sdk is None:
+            object.__setattr__(self, '_sdk', {})
+        converted = self._sdk.get(sdk)
+        if converted is None:
+            converted = self._sdk[sdk] = super().to_sdk(sdk)
+        return converted
+
+## System prompts repeat across every request, so each distinct one is a single shared Message
+##
+@lru_cache(maxsize=256)
+def system(content):
+    """This function returns the shared CachedMessage of a system prompt"""
+    return CachedMessage('system', content)
+
+def user(content):
+    return Message('user', content)
+
+def assistant(content):
+    return Message('assistant', content)
+
+def _as_message(message):
+    return message if isinstance(message, Message) else Message.from_dict(message)
+
+## The SDK message classes are imported on first use so this module loads neither SDK
+##
+@lru_cache(maxsize=None)
+def _sdk_types(sdk):
+    if sdk == 'inference':
+        from azure.ai.inference.models import AssistantMessage, SystemMessage, UserMessage
+        return {'system': SystemMessage, 'user': UserMessage, 'assistant': AssistantMessage}
+    if sdk == 'langchain':
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+        return {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+    raise ValueError(f'Unknown SDK: {sdk}')
+
+## These functions adapt a list of messages to what each SDK takes. The OpenAI SDK and the REST API take
+## dicts, Azure AI Inference takes SystemMessage and UserMessage and LangChain takes BaseMessage objects.
+##
+def to_dicts(messages):
+    """This function adapts messages to the dicts taken by the OpenAI SDK
+        Args:
+            messages (iterable): Message objects or dicts with role and content
+        Returns:
+            list: The messages as dicts
+    """
+    return [message.as_dict() if isinstance(message, Message) else message for message in messages]
+
+def to_inference(messages):
+    """This function adapts messages to the message models of Azure AI Inference
+        Args:
+            messages (iterable): Message objects or dicts with role and content
+        Returns:
+            list: The messages as SystemMessage, UserMessage and AssistantMessage objects
+    """
+    return [_as_message(message).to_sdk('inference') for message in messages]
+
+def to_langchain(messages):
+    """This function adapts messages to the LangChain message classes
+        Args:
+            messages (iterable): Message objects or dicts with role and content
+        Returns:
+            list: The messages as SystemMessage, HumanMessage and AIMessage objects
+    """
+    return [_as_message(message).to_sdk('langchain') for message in messages]
+
+def encode_messages(messages):
+    """This function encodes messages as a JSON array, reusing the encoding of cached messages
+        Args:
+            messages (iterable): Message objects or dicts with role and content
+        Returns:
+            bytes: The JSON array
+    """
+    return b'[' + b','.join(_as_message(message).encoded() for message in messages) + b']'
+
+## This function builds the JSON body of a chat completion without encoding cached messages again
+##
+def request_body(messages, **params):
+    """This function builds the JSON body of a chat completion
+        Args:
+            messages (iterable): Message objects or dicts with role and content
+            **params: The other fields of the request such as model and max_tokens
+        Returns:
+            bytes: The request body
+    """
+    head = dumps(params)[:-1] + b',' if params else b'{'
+    return head + b'"messages":' + encode_messages(messages) + b'}'
+
+## This class is an append-only multi-turn conversation. The shared system prompt is encoded once.
+## With cache_turns, earlier turns keep their encoding too, so sending the next turn only encodes the
+## new messages, at the cost of keeping the encoding or SDK objects of every turn.
+##
+class Conversation:
+    """This class holds the messages of a multi-turn conversation
+        Args:
+            system_prompt (str, optional): The system prompt of the conversation
+            messages (iterable, optional): Messages to start with, as Message objects or dicts
+            cache_turns (bool, optional): Keep the encoding and SDK objects of each appended turn. Defaults to False.
+    """
+    __slots__ = ('messages', 'cache_turns')
+
+    def __init__(self, system_prompt=None, messages=(), cache_turns=False):
+        self.messages = [system(system_prompt)] if system_prompt else []
+        self.messages.extend(_as_message(message) for message in messages)
+        self.cache_turns = cache_turns
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def append(self, role, content):
+        """This function adds a message to the end of the conversation
+            Args:
+                role (str): system, user or assistant
+                content (str): The text of the message
+            Returns:
+                Message: The message added
+        """
+        if role == 'system':
+            message = system(content)
+        else:
+            message = CachedMessage(role, content) if self.cache_turns else Message(role, content)
+        self.messages.append(message)
+        return message
+
+    def request_body(self, **params):
+        """This function builds the JSON body of a chat completion for the conversation
+            Args:
+                **params: The other fields of the request such as model and max_tokens
+            Returns:
+                bytes: The request body
+        """
+        return request_body(self.messages, **params)
+
+## The benchmark plays many long conversations turn by turn. Each turn builds the request of one
+## SDK from the whole history the way the samples do today, with fresh dicts that are converted
+## or encoded in full, and with the compact model. Memory is measured for the stored histories.
+##
+def _turn_text(conversation, turn, role, words):
+    return f"{role} {conversation} {turn} " + ' '.join(f"word{i}" for i in range(words))
+
+def _play_dicts(conversations, turns, words, sdk, system_prompt):
+    types = _sdk_types(sdk) if sdk in ('inference', 'langchain') else None
+    histories = []
+    for c in range(conversations):
+        history = [{"role": "system", "content": system_prompt}]
+        for turn in range(turns):
+            history.append({"role": "user", "content": _turn_text(c, turn, 'user', words)})
+            if sdk == 'rest':
+                json.dumps({"model": "gpt-4.1", "messages": history, "max_tokens": 100}).encode('utf-8')
+            elif types is not None:
+                [types[m['role']](content=m['content']) for m in history]
+            history.append({"role": "assistant", "content": _turn_text(c, turn, 'assistant', words)})
+        histories.append(history)
+    return histories
+
+def _play_compact(conversations, turns, words, sdk, system_prompt, cache_turns=False):
+    histories = []
+    for c in range(conversations):
+        conversation = Conversation(system_prompt, cache_turns=cache_turns)
+        for turn in range(turns):
+            conversation.append('user', _turn_text(c, turn, 'user', words))
+            if sdk == 'rest':
+                conversation.request_body(model="gpt-4.1", max_tokens=100)
+            elif sdk == 'openai':
+                to_dicts(conversation)
+            else:
+                [message.to_sdk(sdk) for message in conversation]
+            conversation.append('assistant', _turn_text(c, turn, 'assistant', words))
+        histories.append(conversation)
+    return histories
+
+def _play_cached(conversations, turns, words, sdk, system_prompt):
+    return _play_compact(conversations, turns, words, sdk, system_prompt, cache_turns=True)
+
+def _build_dicts(conversations, turns, words, system_prompt):
+    histories = []
+    for c in range(conversations):
+        history = [{"role": "system", "content": system_prompt}]
+        for turn in range(turns):
+            history.append({"role": "user", "content": _turn_text(c, turn, 'user', words)})
+            history.append({"role": "assistant", "content": _turn_text(c, turn, 'assistant', words)})
+        histories.append(history)
+    return histories
+
+def _build_compact(conversations, turns, words, system_prompt):
+    histories = []
+    for c in range(conversations):
+        conversation = Conversation(system_prompt)
+        for turn in range(turns):
+            conversation.append('user', _turn_text(c, turn, 'user', words))
+            conversation.append('assistant', _turn_text(c, turn, 'assistant', words))
+        histories.append(conversation)
+    return histories
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def _retained(function, *args):
+    tracemalloc.start()
+    try:
+        kept = function(*args)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare fresh message dicts with the compact message model on long multi-turn conversations')
+    parser.add_argument('--sdk', nargs='+', default=['rest', 'openai', 'inference', 'langchain'], choices=['rest', 'openai', 'inference', 'langchain'])
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=40, help='The user and assistant turn pairs of each conversation')
+    parser.add_argument('--words', type=int, default=30, help='The words in each message')
+    parser.add_argument('--system-words', type=int, default=300, help='The words in the shared system prompt')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    system_prompt = "You are a helpful assistant that provides interesting facts. " + ' '.join(f"rule{i}" for i in range(args.system_words))
+    try:
+        ## The memory of the stored histories before any of them is encoded or converted
+        for name, build in (('dicts', _build_dicts), ('compact', _build_compact)):
+            size = _retained(build, args.conversations, args.turns, args.words, system_prompt)
+            print(json.dumps({
+                "benchmark": "memory",
+                "model": name,
+                "messages": args.conversations * (args.turns * 2 + 1),
+                "bytes_per_message": round(size / (args.conversations * (args.turns * 2 + 1)), 1)
+            }))
+
+        for sdk in args.sdk:
+            for name, play in (('dicts', _play_dicts), ('compact', _play_compact), ('compact cache_turns', _play_cached)):
+                ## The first call imports the SDK, so it isn't measured
+                play(1, 1, 1, sdk, system_prompt)
+                seconds = _timed(play, args.conversations, args.turns, args.words, sdk, system_prompt)
+                size = _retained(play, args.conversations, args.turns, args.words, sdk, system_prompt)
+                print(json.dumps({
+                    "benchmark": "turns",
+                    "sdk": sdk,
+                    "model": name,
+                    "turns": args.conversations * args.turns,
+                    "turns_per_s": round(args.conversations * args.turns / seconds, 1),
+                    "retained_bytes_per_message": round(size / (args.conversations * (args.turns * 2 + 1)), 1)
+                }))
+    except ImportError as e:
+        logging.error(f'The SDK of a benchmark is not installed: {e}')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,832 @@
+import argparse
+import email.policy
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import random
+import signal
+import socketserver
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from utils import configure_logging
+
+## This class emulates the quota enforcement of a deployment. Azure OpenAI evaluates quota over short
+## periods rather than a whole minute so the bucket holds roughly ten seconds worth of quota.
+##
+class QuotaBucket:
+    """This class emulates the requests or tokens per minute quota of a deployment
+        Args:
+            per_minute (int): The quota per minute
+    """
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * 10)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+## This is a local stand-in for the Microsoft Entra ID and Foundry endpoints used by the samples so the
+## performance examples can be run and measured without network access or real credentials
+##
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """This class handles requests sent to the mock server"""
+
+    ## HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    ## Send responses immediately so delayed ACKs on kept-alive connections don't stall clients
+    disable_nagle_algorithm = True
+
+    ## A handler is created for each new connection so this is where the cost of
+    ## a TCP and TLS handshake to a remote region is emulated
+    def setup(self):
+        super().setup()
+        self.server.record('connection')
+        time.sleep(self.server.connect_latency)
+
+    def log_message(self, format, *args):
+        logging.debug('Mock server: ' + format, *args)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.endswith('/v2.0/.well-known/openid-configuration'):
+            self.handle_openid_configuration(path)
+        elif path == '/msi/token':
+            self.handle_managed_identity_token({key: values[0] for key, values in parse_qs(query).items()})
+        elif path == '/metadata/identity/oauth2/token':
+            self.handle_imds_token({key: values[0] for key, values in parse_qs(query).items()})
+        elif path == '/openai/v1/files':
+            self.handle_file_list({key: values[0] for key, values in parse_qs(query).items()})
+        elif path == '/openai/v1/batches':
+            self.handle_batch_list()
+        elif path.startswith('/openai/v1/files/') and path.endswith('/content'):
+            self.handle_file_content(path.split('/')[4])
+        elif path.startswith('/openai/v1/files/'):
+            self.handle_file(path.split('/')[4])
+        elif path.startswith('/openai/v1/batches/'):
+            self.handle_batch(path.split('/')[4])
+        elif path == '/mock/counts':
+            ## The request counters, for clients of a mock server running in a child process
+            with self.server._counts_lock:
+                counts = dict(self.server.counts)
+            self._send_json(200, counts)
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": f"No route for {path}"}})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/oauth2/v2.0/token'):
+            self.handle_token(body)
+        elif path == '/openai/v1/chat/completions':
+            self.handle_chat_completion(body, model=None)
+        elif path.startswith('/openai/deployments/') and path.endswith('/chat/completions'):
+            self.handle_chat_completion(body, model=path.split('/')[3])
+        elif path == '/openai/v1/embeddings':
+            self.handle_embeddings(body)
+        elif path == '/openai/v1/files':
+            self.handle_file_upload(body)
+        elif path == '/openai/v1/batches':
+            self.handle_batch_create(body)
+        elif path.startswith('/openai/v1/batches/') and path.endswith('/cancel'):
+            self.handle_batch(path.split('/')[4], cancel=True)
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": f"No route for {path}"}})
+
+    ## Emulates the client credentials and on-behalf-of grants of the Entra ID v2.0 token endpoint
+    ##
+    def handle_token(self, body):
+        form = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        on_behalf_of = form.get('requested_token_use') == 'on_behalf_of'
+        self.server.record('obo' if on_behalf_of else 'token')
+        time.sleep(self.server.token_latency)
+        if not form.get('client_id') or not form.get('client_secret'):
+            self._send_json(401, {
+                "error": "invalid_client",
+                "error_description": "Mock server requires client_id and client_secret",
+                "correlation_id": str(uuid.uuid4())
+            })
+            return
+        if on_behalf_of and not form.get('assertion'):
+            self._send_json(400, {
+                "error": "invalid_grant",
+                "error_description": "Mock server requires a user assertion for the on-behalf-of flow",
+                "correlation_id": str(uuid.uuid4())
+            })
+            return
+        self._send_json(200, {
+            "token_type": "Bearer",
+            "expires_in": self.server.token_lifetime,
+            "ext_expires_in": self.server.token_lifetime,
+            "access_token": self.server.issue_token()
+        })
+
+    ## Emulates the OpenID Connect discovery document MSAL reads before its first token request. The
+    ## endpoints use the host the client asked for so a client that rewrites URLs keeps doing so.
+    ##
+    def handle_openid_configuration(self, path):
+        tenant = path.split('/')[1]
+        base = f"https://{self.headers.get('Host')}/{tenant}"
+        self._send_json(200, {
+            "issuer": f"{base}/v2.0",
+            "authorization_endpoint": f"{base}/oauth2/v2.0/authorize",
+            "token_endpoint": f"{base}/oauth2/v2.0/token",
+            "device_authorization_endpoint": f"{base}/oauth2/v2.0/devicecode",
+            "tenant_region_scope": None
+        })
+
+    ## Emulates the App Service managed identity endpoint. azure-identity sends requests here when the
+    ## IDENTITY_ENDPOINT and IDENTITY_HEADER environment variables point at the mock server.
+    ##
+    def handle_managed_identity_token(self, query):
+        self.server.record('token')
+        time.sleep(self.server.token_latency)
+        if not self.headers.get('X-IDENTITY-HEADER') or not query.get('resource'):
+            self._send_json(400, {
+                "statusCode": 400,
+                "message": "Mock server requires the X-IDENTITY-HEADER header and the resource parameter"
+            })
+            return
+        self._send_json(200, {
+            "token_type": "Bearer",
+            "expires_on": str(int(time.time()) + self.server.token_lifetime),
+            "resource": query['resource'],
+            "client_id": query.get('client_id', 'mock-managed-identity'),
+            "access_token": self.server.issue_token()
+        })
+
+    ## Emulates the token endpoint of the Azure Instance Metadata Service. azure-identity sends requests here
+    ## when AZURE_POD_IDENTITY_AUTHORITY_HOST points at the mock server. Requests without the Metadata
+    ## header are answered with a 400 the way IMDS answers the probe DefaultAzureCredential sends.
+    ##
+    def handle_imds_token(self, query):
+        self.server.record('token')
+        time.sleep(self.server.token_latency)
+        if self.headers.get('Metadata', '').lower() != 'true' or not query.get('resource'):
+            self._send_json(400, {
+                "error": "invalid_request",
+                "error_description": "Required metadata header not specified"
+            })
+            return
+        now = int(time.time())
+        self._send_json(200, {
+            "token_type": "Bearer",
+            "expires_in": str(self.server.token_lifetime),
+            "expires_on": str(now + self.server.token_lifetime),
+            "ext_expires_in": str(self.server.token_lifetime),
+            "not_before": str(now),
+            "resource": query['resource'],
+            "client_id": query.get('client_id', 'mock-managed-identity'),
+            "access_token": self.server.issue_token()
+        })
+
+    ## Emulates the chat completions operation of both the v1 API and the legacy deployments API
+    ##
+    def handle_chat_completion(self, body, model):
+        self.server.record('chat')
+        if not (self.headers.get('api-key') or self.headers.get('Authorization')):
+            self._send_json(401, {"error": {"code": "401", "message": "Access denied due to missing credentials"}})
+            return
+        if self.server.token_expired(self.headers.get('Authorization')):
+            self.server.record('expired_token')
+            self._send_json(401, {"error": {"code": "401", "message": "Unauthorized. Access token is missing, invalid, audience is incorrect, or have expired."}})
+            return
+        ## Fail a share of requests the way an overloaded region does
+        if self.server.fault_rate and random.random() < self.server.fault_rate:
+            self.server.record('faults')
+            status = random.choice((500, 503))
+            self._send_json(status, {"error": {"code": str(status), "message": "The service is temporarily unavailable"}})
+            return
+
+        request = json.loads(body or b'{}')
+        content = self.server.completion_text
+        prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in request.get('messages', []))
+
+        ## Quota is charged with the prompt size plus max_tokens as Azure OpenAI does when the request arrives
+        allowed, headers = self.server.charge_quota(prompt_tokens + int(request.get('max_tokens') or 16))
+        if not allowed:
+            self.server.record('throttled')
+            self._send_json(429, {
+                "error": {
+                    "code": "429",
+                    "message": "Requests to the ChatCompletions_Create Operation have exceeded the rate limit of your current tier."
+                }
+            }, headers)
+            return
+
+        ## Prompt tokens that aren't served from the prompt cache add prefill time
+        cached_tokens = self.server.cached_prompt_tokens(request)
+        time.sleep(self.server.chat_latency + self.server.prefill_latency * (prompt_tokens - cached_tokens) / 1000)
+        if request.get('stream'):
+            include_usage = (request.get('stream_options') or {}).get('include_usage', False)
+            self._send_stream(model or request.get('model', 'mock-model'), content, prompt_tokens, include_usage, headers, cached_tokens)
+            return
+        self._send_json(200, self.server.chat_completion(model or request.get('model', 'mock-model'), request, cached_tokens), headers)
+
+    ## Emulates the file upload of the v1 API. Batch input files are sent as multipart form data.
+    ##
+    def handle_file_upload(self, body):
+        self.server.record('files')
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + self.headers.get('Content-Type', '').encode('latin-1') + b'\r\n\r\n' + body
+        )
+        fields = {}
+        for part in message.iter_parts():
+            fields[part.get_param('name', header='content-disposition')] = (part.get_filename(), part.get_payload(decode=True))
+        if 'file' not in fields:
+            self._send_json(400, {"error": {"code": "invalidPayload", "message": "The file field is required"}})
+            return
+        filename, content = fields['file']
+        purpose = fields.get('purpose', (None, b'batch'))[1].decode('utf-8')
+        self._send_json(200, self.server.add_file(filename or 'upload.jsonl', content, purpose))
+
+    def handle_file_list(self, params):
+        with self.server._batches_lock:
+            files = [file['metadata'] for file in self.server.files.values()]
+        if 'purpose' in params:
+            files = [file for file in files if file['purpose'] == params['purpose']]
+        self._send_json(200, {"object": "list", "data": files, "has_more": False})
+
+    def handle_file(self, file_id):
+        file = self.server.files.get(file_id)
+        if file is None:
+            self._send_json(404, {"error": {"code": "fileNotFound", "message": f"File {file_id} was not found"}})
+            return
+        self._send_json(200, file['metadata'])
+
+    def handle_file_content(self, file_id):
+        file = self.server.files.get(file_id)
+        if file is None:
+            self._send_json(404, {"error": {"code": "fileNotFound", "message": f"File {file_id} was not found"}})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(file['content'])))
+        self.end_headers()
+        self.wfile.write(file['content'])
+
+    ## Emulates the batch operations of the v1 API. A batch completes batch_latency seconds after it is created.
+    ##
+    def handle_batch_create(self, body):
+        self.server.record('batches')
+        request = json.loads(body or b'{}')
+        if request.get('input_file_id') not in self.server.files:
+            self._send_json(400, {"error": {"code": "invalidInputFile", "message": "The input file was not found"}})
+            return
+        self._send_json(200, self.server.create_batch(request))
+
+    def handle_batch_list(self):
+        with self.server._batches_lock:
+            batch_ids = list(self.server.batches)
+        self._send_json(200, {"object": "list", "data": [self.server.get_batch(batch_id) for batch_id in batch_ids], "has_more": False})
+
+    def handle_batch(self, batch_id, cancel=False):
+        batch = self.server.get_batch(batch_id, cancel=cancel)
+        if batch is None:
+            self._send_json(404, {"error": {"code": "batchNotFound", "message": f"Batch {batch_id} was not found"}})
+            return
+        self._send_json(200, batch)
+
+    ## Emulates the embeddings operation with a hashed bag of words so similar texts get similar vectors
+    ##
+    def handle_embeddings(self, body):
+        self.server.record('embeddings')
+        request = json.loads(body or b'{}')
+        inputs = request.get('input')
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = []
+        for index, text in enumerate(inputs):
+            ## Each word is spread over four signed dimensions so different words rarely collide
+            vector = [0.0] * 256
+            for word in text.lower().split():
+                digest = hashlib.md5(word.strip('.,!?;:').encode('utf-8')).digest()
+                for i in range(4):
+                    vector[digest[2 * i]] += 1.0 if digest[2 * i + 1] & 1 else -1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            data.append({"object": "embedding", "index": index, "embedding": [v / norm for v in vector]})
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": request.get('model', 'mock-embedding'),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}
+        })
+
+    ## Streams the completion as server-sent events with one chunk per word, using chunked
+    ## transfer encoding so the connection can be kept alive afterwards
+    ##
+    def _send_stream(self, model, content, prompt_tokens, include_usage, headers, cached_tokens=0):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def chunk(choices, usage=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices
+            }
+            if usage is not None:
+                payload["usage"] = usage
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+
+        words = content.split(' ')
+        chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.stream_delay)
+            chunk([{"index": 0, "delta": {"content": word if i == 0 else ' ' + word}, "finish_reason": None}])
+        chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if include_usage:
+            chunk([], {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(words),
+                "total_tokens": prompt_tokens + len(words),
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            })
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+class MockServer(ThreadingHTTPServer):
+    """This class holds the configuration and request counters of the mock server
+        Args:
+            address (tuple): The host and port to listen on. Use port 0 to pick a free port
+            token_latency (float, optional): Seconds to wait before answering a token request. Defaults to 0.
+            token_lifetime (int, optional): Lifetime in seconds of the tokens handed out. Defaults to 3599.
+            chat_latency (float, optional): Seconds to wait before answering a chat completion. Defaults to 0.
+            completion_text (str, optional): The assistant message returned by chat completions.
+            connect_latency (float, optional): Seconds to wait when a new connection is opened to emulate a TLS handshake. Defaults to 0.
+            rpm_limit (int, optional): The requests per minute quota of every deployment. Defaults to None which is unlimited.
+            tpm_limit (int, optional): The tokens per minute quota of every deployment. Defaults to None which is unlimited.
+            fault_rate (float, optional): The share of chat completions answered with a 500 or 503. Defaults to 0.
+            stream_delay (float, optional): Seconds between streamed chunks. Defaults to 0.
+            batch_latency (float, optional): Seconds a batch job takes to complete. Defaults to 2.
+            prefill_latency (float, optional): Seconds added per 1000 prompt tokens not served from the prompt cache. Defaults to 0.
+            prompt_cache_size (int, optional): The number of cached prompt prefixes kept. Defaults to 10000.
+    """
+    daemon_threads = True
+
+    ## The default listen backlog of 5 drops connection bursts from concurrent clients
+    request_queue_size = 128
+
+    def __init__(self, address, token_latency=0.0, token_lifetime=3599, chat_latency=0.0,
+                 completion_text='Honey never spoils. Edible honey has been found in ancient Egyptian tombs.',
+                 connect_latency=0.0, rpm_limit=None, tpm_limit=None, fault_rate=0.0,
+                 stream_delay=0.0, batch_latency=2.0, prefill_latency=0.0, prompt_cache_size=10000):
+        super().__init__(address, MockRequestHandler)
+        self.token_latency = token_latency
+        self.token_lifetime = token_lifetime
+        self.chat_latency = chat_latency
+        self.completion_text = completion_text
+        self.connect_latency = connect_latency
+        self.fault_rate = fault_rate
+        self.stream_delay = stream_delay
+        self.batch_latency = batch_latency
+        self.prefill_latency = prefill_latency
+        self.prompt_cache_size = prompt_cache_size
+        self._prompt_cache = {}
+        self._prompt_cache_lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self._batches_lock = threading.Lock()
+        self.counts = {}
+        self._counts_lock = threading.Lock()
+        self._requests_quota = QuotaBucket(rpm_limit) if rpm_limit else None
+        self._tokens_quota = QuotaBucket(tpm_limit) if tpm_limit else None
+        self._quota_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def issue_token(self):
+        """This function returns a new access token. The expiry is part of the token so chat completions
+            can reject expired tokens the way Azure OpenAI does.
+        """
+        return f"mock-token-{int(time.time()) + self.token_lifetime}-{uuid.uuid4().hex}"
+
+    def token_expired(self, authorization):
+        """This function returns whether an Authorization header carries an expired mock token"""
+        parts = (authorization or '').rsplit(' ', 1)[-1].split('-')
+        return len(parts) == 4 and parts[:2] == ['mock', 'token'] and parts[2].isdigit() and int(parts[2]) <= time.time()
+
+    def cached_prompt_tokens(self, request):
+        """This function emulates the prompt caching of Azure OpenAI. Prompts of 1024 tokens or more are
+            cached by prefix, and a request is served the longest cached prefix that matches, counted in
+            1024 tokens and then steps of 128. Tokens are the words of the message contents.
+            Args:
+                request (dict): The decoded request body
+            Returns:
+                int: The number of prompt tokens served from the cache
+        """
+        words = [word for m in request.get('messages', []) for word in str(m.get('content', '')).split()]
+        if len(words) < 1024:
+            return 0
+        digest = hashlib.sha256(request.get('model', '').encode('utf-8'))
+        keys = []
+        position = 0
+        for boundary in range(1024, len(words) + 1, 128):
+            digest.update(' '.join(words[position:boundary]).encode('utf-8') + b' ')
+            position = boundary
+            keys.append((boundary, digest.copy().hexdigest()))
+        cached = 0
+        with self._prompt_cache_lock:
+            for boundary, key in keys:
+                if key in self._prompt_cache:
+                    cached = boundary
+                ## The newest prefixes are kept when the cache is full
+                self._prompt_cache.pop(key, None)
+                self._prompt_cache[key] = True
+            while len(self._prompt_cache) > self.prompt_cache_size:
+                del self._prompt_cache[next(iter(self._prompt_cache))]
+        if cached:
+            self.record('cached_prompts')
+        return cached
+
+    def chat_completion(self, model, request, cached_tokens=0):
+        """This function builds the response body of a chat completion
+            Args:
+                model (str): The model or deployment name
+                request (dict): The decoded request body
+                cached_tokens (int, optional): The prompt tokens served from the prompt cache. Defaults to 0.
+            Returns:
+                dict: The chat completion
+        """
+        content = self.completion_text
+        prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in request.get('messages', []))
+        completion_tokens = len(content.split())
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content}
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+
+    def add_file(self, filename, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        metadata = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        with self._batches_lock:
+            self.files[file_id] = {"metadata": metadata, "content": content}
+        return metadata
+
+    def create_batch(self, request):
+        batch_id = f"batch_{uuid.uuid4()}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request.get('endpoint', '/chat/completions'),
+            "input_file_id": request['input_file_id'],
+            "completion_window": request.get('completion_window', '24h'),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": request.get('metadata')
+        }
+        with self._batches_lock:
+            self.batches[batch_id] = {"batch": batch, "started": time.monotonic()}
+        return dict(batch)
+
+    def get_batch(self, batch_id, cancel=False):
+        """This function returns a batch, moving it through validating, in_progress and completed as time passes
+            Args:
+                batch_id (str): The batch id
+                cancel (bool, optional): Cancel the batch if it has not completed. Defaults to False.
+            Returns:
+                dict: The batch or None if it does not exist
+        """
+        with self._batches_lock:
+            entry = self.batches.get(batch_id)
+            if entry is None:
+                return None
+            batch = entry['batch']
+            if batch['status'] in ('completed', 'failed', 'cancelled', 'expired'):
+                return dict(batch)
+            if cancel:
+                batch['status'] = 'cancelled'
+                return dict(batch)
+            elapsed = time.monotonic() - entry['started']
+            if elapsed < self.batch_latency * 0.1:
+                batch['status'] = 'validating'
+            elif elapsed < self.batch_latency:
+                batch['status'] = 'in_progress'
+            else:
+                self._complete_batch(batch)
+            return dict(batch)
+
+    def _complete_batch(self, batch):
+        ## Results are written in no particular order as the service does
+        lines = self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+        outputs, errors = [], []
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request.get('custom_id'), "error": None}
+            body = request.get('body') or {}
+            if not body.get('messages'):
+                result['response'] = {
+                    "status_code": 400,
+                    "request_id": str(uuid.uuid4()),
+                    "body": {"error": {"code": "invalid_request", "message": "messages is required"}}
+                }
+                errors.append(result)
+            else:
+                result['response'] = {
+                    "status_code": 200,
+                    "request_id": str(uuid.uuid4()),
+                    "body": self.chat_completion(body.get('model', 'mock-model'), body)
+                }
+                outputs.append(result)
+        random.shuffle(outputs)
+        encode = lambda results: ''.join(json.dumps(r) + '\n' for r in results).encode('utf-8')
+        for key, results in (('output_file_id', outputs), ('error_file_id', errors)):
+            if results:
+                file_id = f"file-{uuid.uuid4().hex}"
+                self.files[file_id] = {
+                    "metadata": {"id": file_id, "object": "file", "bytes": 0, "created_at": int(time.time()),
+                                 "filename": f"{batch['id']}_{key[:-8]}.jsonl", "purpose": "batch_output", "status": "processed"},
+                    "content": encode(results)
+                }
+                batch[key] = file_id
+        batch['status'] = 'completed'
+        batch['completed_at'] = int(time.time())
+        batch['request_counts'] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+
+    def record(self, route):
+        with self._counts_lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def charge_quota(self, tokens):
+        """This function charges a request against the deployment quota
+            Args:
+                tokens (int): The number of tokens charged for the request
+            Returns:
+                tuple: Whether the request is allowed and the rate limit headers to return
+        """
+        headers = {}
+        if not self._requests_quota and not self._tokens_quota:
+            return True, headers
+        with self._quota_lock:
+            wait = 0.0
+            for bucket, amount in ((self._requests_quota, 1), (self._tokens_quota, tokens)):
+                if bucket:
+                    bucket.refill()
+                    wait = max(wait, bucket.seconds_until(amount))
+            allowed = wait == 0.0
+            if allowed:
+                if self._requests_quota:
+                    self._requests_quota.level -= 1
+                if self._tokens_quota:
+                    self._tokens_quota.level -= min(tokens, self._tokens_quota.capacity)
+            if self._requests_quota:
+                headers['x-ratelimit-remaining-requests'] = str(int(self._requests_quota.level))
+            if self._tokens_quota:
+                headers['x-ratelimit-remaining-tokens'] = str(int(self._tokens_quota.level))
+        if not allowed:
+            headers['retry-after-ms'] = str(int(wait * 1000) + 1)
+            headers['retry-after'] = str(int(wait) + 1)
+        return allowed, headers
+
+## This function starts the mock server on a background thread and returns it
+##
+def start_mock_server(host='127.0.0.1', port=0, **options):
+    """This function starts the mock server on a background thread
+        Args:
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 0 which picks a free port.
+            **options: Additional options passed to MockServer
+        Returns:
+            server: The running MockServer. Call shutdown() when done with it
+    """
+    server = MockServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, name='mock-server', daemon=True)
+    thread.start()
+    logging.info(f'Mock server listening on {server.url}')
+    return server
+
+## This is a local stand-in for a Redis-protocol store. It supports the PING, GET, SET with EX,
+## DEL and FLUSHDB commands used by the response cache.
+##
+class MockRedisHandler(socketserver.StreamRequestHandler):
+    """This class handles the RESP commands sent to the mock Redis server"""
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            name = command[0].upper()
+            with self.server.lock:
+                if name == b'PING':
+                    reply = b'+PONG\r\n'
+                elif name == b'GET':
+                    value, expires = store.get(command[1], (None, None))
+                    if value is None or (expires and expires < time.time()):
+                        store.pop(command[1], None)
+                        reply = b'$-1\r\n'
+                    else:
+                        reply = b'$%d\r\n%s\r\n' % (len(value), value)
+                elif name == b'SET':
+                    expires = None
+                    if len(command) >= 5 and command[3].upper() == b'EX':
+                        expires = time.time() + int(command[4])
+                    store[command[1]] = (command[2], expires)
+                    reply = b'+OK\r\n'
+                elif name == b'DEL':
+                    reply = b':%d\r\n' % sum(store.pop(key, None) is not None for key in command[1:])
+                elif name == b'FLUSHDB':
+                    store.clear()
+                    reply = b'+OK\r\n'
+                else:
+                    reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+class MockRedisServer(socketserver.ThreadingTCPServer):
+    """This class holds the data of the mock Redis server
+        Args:
+            address (tuple): The host and port to listen on. Use port 0 to pick a free port
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, MockRedisHandler)
+        self.store = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}"
+
+## This function starts the mock Redis server on a background thread and returns it
+##
+def start_mock_redis(host='127.0.0.1', port=0):
+    """This function starts the mock Redis server on a background thread
+        Args:
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 0 which picks a free port.
+        Returns:
+            server: The running MockRedisServer. Call shutdown() when done with it
+    """
+    server = MockRedisServer((host, port))
+    threading.Thread(target=server.serve_forever, name='mock-redis', daemon=True).start()
+    logging.info(f'Mock Redis server listening on {server.url}')
+    return server
+
+def _serve(host, port, options, ready):
+    ## The parent stops the server with terminate() so Ctrl-C is left to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = MockServer((host, port), **options)
+    ready.put(server.url)
+    server.serve_forever()
+
+class MockServerProcess:
+    """This class runs the mock server in a child process so it does not compete with the
+        client being measured for the GIL
+        Args:
+            url (str): The base URL of the mock server
+            process (multiprocessing.Process): The child process running the server
+    """
+    def __init__(self, url, process):
+        self.url = url
+        self.process = process
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join()
+
+## This function starts the mock server in a child process and returns a handle to it
+##
+def start_mock_server_process(host='127.0.0.1', port=0, **options):
+    """This function starts the mock server in a child process
+        Args:
+            host (str, optional): The interface to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 0 which picks a free port.
+            **options: Additional options passed to MockServer
+        Returns:
+            server: A MockServerProcess. Call shutdown() when done with it
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(host, port, options, ready), name='mock-server', daemon=True)
+    process.start()
+    url = ready.get(timeout=30)
+    logging.info(f'Mock server listening on {url}')
+    return MockServerProcess(url, process)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local mock of the Entra ID and Foundry endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    parser.add_argument('--token-lifetime', type=int, default=3599)
+    parser.add_argument('--chat-latency', type=float, default=0.0)
+    parser.add_argument('--connect-latency', type=float, default=0.0)
+    parser.add_argument('--rpm-limit', type=int)
+    parser.add_argument('--tpm-limit', type=int)
+    parser.add_argument('--fault-rate', type=float, default=0.0)
+    parser.add_argument('--stream-delay', type=float, default=0.0)
+    parser.add_argument('--batch-latency', type=float, default=2.0)
+    parser.add_argument('--prefill-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    configure_logging("INFO")
+
+    server = MockServer(
+        (args.host, args.port),
+        token_latency=args.token_latency,
+        token_lifetime=args.token_lifetime,
+        chat_latency=args.chat_latency,
+        connect_latency=args.connect_latency,
+        rpm_limit=args.rpm_limit,
+        tpm_limit=args.tpm_limit,
+        fault_rate=args.fault_rate,
+        stream_delay=args.stream_delay,
+        batch_latency=args.batch_latency,
+        prefill_latency=args.prefill_latency
+    )
+    logging.info(f'Mock server listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
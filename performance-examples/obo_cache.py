@@ -0,0 +1,336 @@
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+import msal
+import requests
+
+from utils import configure_logging, percentile
+
+## This function reads the expiry of a user assertion. The assertion was validated by the API that
+## received it so the signature is not checked here.
+##
+def assertion_expiry(user_assertion):
+    """This function reads the exp claim of a JWT user assertion
+        Args:
+            user_assertion (str): The access token sent by the calling client
+        Returns:
+            float: The expiry as a Unix timestamp or None if the assertion can't be decoded
+    """
+    try:
+        payload = user_assertion.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def obo_cache_key(user_assertion, scopes):
+    """This function builds the cache key of an on-behalf-of token. The assertion is hashed so raw user
+        tokens are not kept as dictionary keys.
+        Args:
+            user_assertion (str): The access token sent by the calling client
+            scopes (list): The scopes of the downstream token
+        Returns:
+            str: The cache key
+    """
+    return hashlib.sha256(f"{user_assertion}\n{' '.join(sorted(scopes))}".encode('utf-8')).hexdigest()
+
+## MSAL stores every on-behalf-of result in the application's token cache and never evicts them. The
+## OboTokenCache is the cache here, so the pooled applications discard what MSAL would store.
+##
+class _DiscardingTokenCache(msal.TokenCache):
+    def add(self, event, **kwargs):
+        pass
+
+## This class keeps a fixed number of ConfidentialClientApplication instances so the authority metadata
+## is read once per instance and concurrent exchanges don't contend for a single application's locks
+##
+class ConfidentialClientPool:
+    """This class is a pool of reusable ConfidentialClientApplication instances
+        Args:
+            client_id (str): The client id of the middle-tier app registration
+            client_credential (str): The client secret of the middle-tier app registration
+            authority (str): The authority such as https://login.microsoftonline.com/TENANT_ID
+            size (int, optional): The number of applications in the pool. Defaults to 4.
+            **app_options: Additional options passed to ConfidentialClientApplication such as http_client
+    """
+    def __init__(self, client_id, client_credential, authority, size=4, **app_options):
+        self.client_id = client_id
+        self.client_credential = client_credential
+        self.authority = authority
+        self.size = size
+        self.app_options = app_options
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create(self):
+        return msal.ConfidentialClientApplication(
+            client_id=self.client_id,
+            client_credential=self.client_credential,
+            authority=self.authority,
+            token_cache=_DiscardingTokenCache(),
+            **self.app_options
+        )
+
+    @contextmanager
+    def acquire(self):
+        """This function lends an application from the pool, creating one if the pool is not full yet
+            Yields:
+                ConfidentialClientApplication: The application
+        """
+        try:
+            app = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    app = self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                app = self._idle.get()
+        try:
+            yield app
+        finally:
+            self._idle.put(app)
+
+## This class exchanges user assertions for downstream tokens with the on-behalf-of flow and caches the
+## results. Entries expire with whichever of the downstream token and the user assertion expires first.
+##
+class OboTokenCache:
+    """This class caches on-behalf-of tokens keyed by a hash of the user assertion and scopes
+        Args:
+            pool (ConfidentialClientPool): The applications used for the exchanges
+            max_entries (int, optional): The most tokens kept. The least recently used are evicted first. Defaults to 10000.
+            expiry_margin (float, optional): Seconds before expiry at which a token is no longer handed out. Defaults to 60.
+    """
+    def __init__(self, pool, max_entries=10000, expiry_margin=60):
+        self.pool = pool
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._exchange_latencies = []
+        self._counts = {"hits": 0, "misses": 0, "exchanges": 0, "failures": 0, "evictions": 0}
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] - self.expiry_margin <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _store(self, key, token, expires_on):
+        with self._lock:
+            self._entries[key] = (token, expires_on)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def _exchange(self, user_assertion, scopes):
+        with self.pool.acquire() as app:
+            start = time.perf_counter()
+            result = app.acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=scopes)
+            self._exchange_latencies.append(time.perf_counter() - start)
+        if len(self._exchange_latencies) > 1000:
+            del self._exchange_latencies[:500]
+        if "access_token" not in result:
+            self._counts['failures'] += 1
+            logging.error(f"Error was: {result.get('error')}")
+            logging.error(f"Error description was: {result.get('error_description')}")
+            logging.error(f"Error correlation_id was: {result.get('correlation_id')}")
+            raise Exception('Failed to obtain on-behalf-of token')
+        self._counts['exchanges'] += 1
+        expires_on = time.time() + int(result['expires_in'])
+        assertion_expires_on = assertion_expiry(user_assertion)
+        if assertion_expires_on is not None:
+            expires_on = min(expires_on, assertion_expires_on)
+        return result['access_token'], expires_on
+
+    def get_token(self, user_assertion, scopes):
+        """This function returns a downstream token for a user, exchanging the assertion only when no valid token is cached
+            Args:
+                user_assertion (str): The access token sent by the calling client
+                scopes (list): The scopes of the downstream token
+            Returns:
+                str: The downstream access token
+        """
+        key = obo_cache_key(user_assertion, scopes)
+        token = self._lookup(key)
+        if token is not None:
+            self._counts['hits'] += 1
+            return token
+
+        ## One exchange per user and scope at a time. Other requests for the same user wait for it.
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                token = self._lookup(key)
+                if token is not None:
+                    self._counts['hits'] += 1
+                    return token
+                self._counts['misses'] += 1
+                token, expires_on = self._exchange(user_assertion, scopes)
+                self._store(key, token, expires_on)
+                return token
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    def token_provider(self, user_assertion, scope):
+        """This function returns a token provider for one user that can be passed to the OpenAI client as api_key
+            Args:
+                user_assertion (str): The access token sent by the calling client
+                scope (str): The scope of the downstream token
+            Returns:
+                token_provider: A function that returns the downstream access token
+        """
+        return lambda: self.get_token(user_assertion, [scope])
+
+    def metrics(self):
+        """This function returns the cache counters and the exchange latency
+            Returns:
+                dict: The counters, the number of cached tokens and the exchange latency percentiles in milliseconds
+        """
+        latencies = self._exchange_latencies
+        return {
+            **self._counts,
+            "entries": len(self._entries),
+            "exchange_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "exchange_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+        }
+
+## This requests Session sends requests for a fake https authority to the plain-http mock server.
+## MSAL only accepts https authorities so this is how it is pointed at a local Entra ID stand-in.
+##
+class LoopbackSession(requests.Session):
+    """This class rewrites requests for one host to a local server
+        Args:
+            host (str): The host to rewrite such as login.mock.local
+            target (str): The base URL of the local server such as http://127.0.0.1:8080
+    """
+    def __init__(self, host, target):
+        super().__init__()
+        self.host = host
+        self.target = urlsplit(target)
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname == self.host:
+            url = urlunsplit((self.target.scheme, self.target.netloc, parts.path, parts.query, parts.fragment))
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'Host': self.host}
+        return super().request(method, url, *args, **kwargs)
+
+def fake_user_assertion(user, lifetime):
+    """This function builds an unsigned JWT that stands in for the access token a client sends
+        Args:
+            user (str): The user the token belongs to
+            lifetime (float): Seconds until the token expires
+        Returns:
+            str: The JWT
+    """
+    encode = lambda value: base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).rstrip(b'=').decode('ascii')
+    return '.'.join([
+        encode({"alg": "none", "typ": "JWT"}),
+        encode({"oid": user, "exp": int(time.time() + lifetime)}),
+        'mock-signature'
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-request on-behalf-of exchanges with the OBO token cache against a fake Entra ID')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--max-entries', type=int, default=400, help='Smaller than --users so eviction is exercised')
+    parser.add_argument('--exchange-latency', type=float, default=0.05, help='Seconds the fake Entra ID takes to answer')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+    server = start_mock_server_process(token_latency=args.exchange_latency)
+    authority_host = 'login.mock.local'
+    authority = f"https://{authority_host}/mock-tenant"
+    scopes = ["https://cognitiveservices.azure.com/.default"]
+
+    ## A few users send most of the requests the way they do in a real service
+    assertions = [fake_user_assertion(f"user-{i}", lifetime=3600) for i in range(args.users)]
+    weights = [1 / (rank + 1) for rank in range(args.users)]
+    traffic = random.Random(7).choices(assertions, weights=weights, k=args.requests)
+
+    def per_request(user_assertion):
+        ## What the sample does: a new confidential client and an exchange for every request
+        app = msal.ConfidentialClientApplication(
+            client_id='mock-client-id',
+            client_credential='mock-client-secret',
+            authority=authority,
+            http_client=LoopbackSession(authority_host, server.url),
+            instance_discovery=False
+        )
+        result = app.acquire_token_on_behalf_of(user_assertion=user_assertion, scopes=scopes)
+        return result['access_token']
+
+    pool = ConfidentialClientPool(
+        'mock-client-id',
+        'mock-client-secret',
+        authority,
+        size=args.concurrency,
+        http_client=LoopbackSession(authority_host, server.url),
+        instance_discovery=False
+    )
+    cache = OboTokenCache(pool, max_entries=args.max_entries)
+
+    try:
+        for name, exchange in (('per request', per_request), ('obo cache', lambda a: cache.get_token(a, scopes))):
+            latencies = []
+
+            def handle(user_assertion):
+                start = time.perf_counter()
+                exchange(user_assertion)
+                latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(handle, traffic))
+            result = {
+                "mode": name,
+                "requests": args.requests,
+                "users": args.users,
+                "elapsed_s": round(time.perf_counter() - start, 3),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+            }
+            if name == 'obo cache':
+                result['cache'] = cache.metrics()
+            print(json.dumps(result))
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+from messages import Message, system, to_dicts, user
+from settings import ConfigurationError, get_settings, mock_settings
+from token_counter import get_counter
+from utils import configure_logging, percentile
+
+## Azure OpenAI caches prompts of 1024 tokens or more by prefix. A request is served the longest
+## cached prefix that matches its own, counted as the first 1024 tokens and then in steps of 128,
+## and the tokens served from the cache are reported in usage.prompt_tokens_details.cached_tokens.
+## A prompt only hits the cache when everything before the part that changes is byte for byte the
+## same, so static content has to come first and anything per request has to come last.
+##
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+def cache_boundary(tokens):
+    """This function returns the smallest cacheable prefix length at or above a token count
+        Args:
+            tokens (int): The number of tokens of a prefix
+        Returns:
+            int: The token count of the next cache boundary
+    """
+    if tokens <= CACHE_MIN_TOKENS:
+        return CACHE_MIN_TOKENS
+    return CACHE_MIN_TOKENS + -(-(tokens - CACHE_MIN_TOKENS) // CACHE_INCREMENT) * CACHE_INCREMENT
+
+## This class assembles prompts with a stable prefix. The system prompt and the static messages,
+## such as few-shot examples and reference documents, are built once as shared Message objects and
+## always sent first in the order given. Only the last user message is formatted per request.
+##
+class PromptTemplate:
+    """This class builds the messages of a chat completion with the static content first
+        Args:
+            name (str): The name of the template used to report cache hits
+            system_prompt (str): The system prompt. It must not contain anything that changes between requests.
+            examples (list, optional): Static messages sent after the system prompt, as Message objects or dicts
+            user_template (str, optional): The user message, formatted with the values of each request. Defaults to '{input}'.
+            align (bool, optional): Pad the static prefix up to the next cache boundary when it is at most max_padding tokens away. Defaults to False.
+            max_padding (int, optional): The most tokens of padding added. Defaults to 127.
+            count_tokens (callable, optional): A function that counts the tokens of a list of message dicts. Defaults to the token counter of the model.
+            model (str, optional): The model whose tokenizer counts the tokens when count_tokens isn't given. Defaults to gpt-4.1.
+    """
+    def __init__(self, name, system_prompt, examples=(), user_template='{input}', align=False, max_padding=CACHE_INCREMENT - 1, count_tokens=None, model='gpt-4.1'):
+        self.name = name
+        self.user_template = user_template
+        ## Alignment is only as good as the count, so the model's tokenizer is used rather than an estimate
+        self.count_tokens = count_tokens or get_counter(model).count_messages
+        examples = [message if isinstance(message, Message) else Message.from_dict(message) for message in examples]
+        self.padding = 0
+        if align:
+            system_prompt = self._pad(system_prompt, examples, max_padding)
+        self.static = [system(system_prompt), *examples]
+        self.static_tokens = self.count_tokens(to_dicts(self.static))
+
+    def _pad(self, system_prompt, examples, max_padding):
+        ## Static tokens past the last cache boundary are never served from the cache. Padding the end of
+        ## the system prompt moves the end of the static prefix onto a boundary so all of it is cached,
+        ## at the cost of sending the padding on every request.
+        tokens = self.count_tokens(to_dicts([Message('system', system_prompt), *examples]))
+        target = cache_boundary(tokens)
+        if target == tokens or target - tokens > max_padding:
+            return system_prompt
+        padded = system_prompt + '\n'
+        while self.count_tokens(to_dicts([Message('system', padded), *examples])) < target:
+            padded += ' .'
+        self.padding = self.count_tokens(to_dicts([Message('system', padded), *examples])) - tokens
+        return padded
+
+    def build(self, **values):
+        """This function builds the messages of one request
+            Args:
+                **values: The values of the placeholders of the user template
+            Returns:
+                list: The shared static messages followed by the user message
+        """
+        return [*self.static, user(self.user_template.format(**values))]
+
+## These functions read the prompt token counts from the usage of an OpenAI SDK response, a
+## response_parser ChatCompletion or a decoded JSON body
+##
+def _field(value, name):
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+def prompt_tokens(usage):
+    return _field(usage, 'prompt_tokens') or 0
+
+def cached_tokens(usage):
+    """This function returns the prompt tokens served from the prompt cache
+        Args:
+            usage (object): The usage of a chat completion as an object or a dict
+        Returns:
+            int: The cached prompt tokens, or 0 when the response doesn't report them
+    """
+    cached = _field(usage, 'cached_tokens')
+    if cached is None:
+        cached = _field(_field(usage, 'prompt_tokens_details'), 'cached_tokens')
+    return cached or 0
+
+## This class counts prompt cache hits per template. It is safe to share between threads.
+##
+class CacheStats:
+    """This class records the prompt tokens and cached tokens of each request by template"""
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def record(self, template, usage, latency=None):
+        """This function records the usage of one request
+            Args:
+                template (str): The name of the template the prompt was built with
+                usage (object): The usage of the response as an object or a dict
+                latency (float, optional): The latency of the request in seconds
+        """
+        prompt, cached = prompt_tokens(usage), cached_tokens(usage)
+        with self._lock:
+            stats = self._templates.setdefault(template, {"requests": 0, "cacheable": 0, "hits": 0, "prompt_tokens": 0, "cached_tokens": 0, "latencies": []})
+            stats["requests"] += 1
+            stats["cacheable"] += prompt >= CACHE_MIN_TOKENS
+            stats["hits"] += cached > 0
+            stats["prompt_tokens"] += prompt
+            stats["cached_tokens"] += cached
+            if latency is not None:
+                stats["latencies"].append(latency)
+
+    def summary(self):
+        """This function returns the cache hit ratios of each template
+            Returns:
+                list: One dict per template with the request and token hit ratios
+        """
+        with self._lock:
+            templates = {name: dict(stats, latencies=list(stats["latencies"])) for name, stats in self._templates.items()}
+        results = []
+        for name, stats in templates.items():
+            result = {
+                "template": name,
+                "requests": stats["requests"],
+                "cacheable_requests": stats["cacheable"],
+                "request_hit_ratio": round(stats["hits"] / stats["requests"], 3),
+                "prompt_tokens": stats["prompt_tokens"],
+                "cached_tokens": stats["cached_tokens"],
+                "token_hit_ratio": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0
+            }
+            if stats["latencies"]:
+                result["p50_ms"] = round(percentile(stats["latencies"], 50) * 1000, 3)
+                result["p99_ms"] = round(percentile(stats["latencies"], 99) * 1000, 3)
+            results.append(result)
+        return results
+
+## The demo sends the same requests laid out three ways. The first puts the date and the customer
+## at the top of the system prompt as many prompts do, which changes the prefix on every request.
+## The second moves them into the user message after the static content, and the third also
+## aligns the static prefix to a cache boundary.
+##
+INSTRUCTIONS = "You are a helpful assistant that provides interesting facts. Answer in two sentences and name a source."
+
+def _reference(words):
+    return "Reference notes:\n" + ' '.join(f"fact{i}" for i in range(words))
+
+EXAMPLES = [
+    {"role": "user", "content": "Tell me an interesting fact about octopuses"},
+    {"role": "assistant", "content": "Octopuses have three hearts and blue blood. Source: Smithsonian Ocean."},
+    {"role": "user", "content": "Tell me an interesting fact about honey"},
+    {"role": "assistant", "content": "Edible honey has been found in ancient Egyptian tombs. Source: National Geographic."}
+]
+
+class DynamicFirstTemplate:
+    """This class builds the same messages as the demo templates with the per-request values at the start of the system prompt"""
+    def __init__(self, name, reference):
+        self.name = name
+        self.reference = reference
+
+    def build(self, customer, today, input):
+        return [
+            Message('system', f"Today is {today}. You are talking to {customer}. {INSTRUCTIONS}\n{self.reference}"),
+            *(Message.from_dict(m) for m in EXAMPLES),
+            user(input)
+        ]
+
+def run_template(client, model, template, requests_count, stats, max_tokens=100):
+    """This function sends requests built with a template and records their cache hits
+        Args:
+            client (OpenAI): The OpenAI client
+            model (str): The deployment name
+            template (PromptTemplate): The template
+            requests_count (int): The number of requests
+            stats (CacheStats): Records the usage of each response
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+    """
+    for i in range(requests_count):
+        messages = template.build(
+            customer=f"customer {i % 25}",
+            today=time.strftime('%Y-%m-%d %H:%M:%S'),
+            input=f"Tell me an interesting fact about topic {i}"
+        )
+        start = time.perf_counter()
+        response = client.chat.completions.create(model=model, messages=to_dicts(messages), max_tokens=max_tokens)
+        stats.record(template.name, response.usage, time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare prompt layouts by their prompt cache hit ratio')
+    parser.add_argument('--requests', type=int, default=100, help='The number of requests per layout')
+    parser.add_argument('--reference-words', type=int, default=1050, help='The size of the static reference notes in the system prompt')
+    parser.add_argument('--mock', action='store_true', help='Run against the local mock server')
+    parser.add_argument('--prefill-latency', type=float, default=0.05, help='Mock seconds per 1000 uncached prompt tokens')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, DEPLOYMENT_NAME and the variables of AUTH_MODE
+    server = None
+    count_tokens = None
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process(prefill_latency=args.prefill_latency)
+        settings = mock_settings(server.url)
+        ## The mock counts the words of the message contents as tokens
+        count_tokens = lambda messages: sum(len(m['content'].split()) for m in messages)
+    else:
+        try:
+            settings = get_settings()
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+    profile = settings.profile()
+
+    reference = _reference(args.reference_words)
+    user_template = "Today is {today}. You are talking to {customer}.\n{input}"
+    templates = [
+        DynamicFirstTemplate('dynamic-first', reference),
+        PromptTemplate('static-first', f"{INSTRUCTIONS}\n{reference}", EXAMPLES, user_template, count_tokens=count_tokens, model=profile.model_name),
+        PromptTemplate('aligned', f"{INSTRUCTIONS}\n{reference}", EXAMPLES, user_template, align=True, count_tokens=count_tokens, model=profile.model_name)
+    ]
+    for template in templates[1:]:
+        logging.info(f"{template.name}: {template.static_tokens} static tokens with {template.padding} tokens of padding")
+
+    try:
+        from openai import OpenAI
+        if profile.auth_mode == 'api-key':
+            api_key = profile.api_key
+        else:
+            from cli import get_token_provider
+            api_key = get_token_provider(profile.auth_mode, settings)
+        stats = CacheStats()
+        with OpenAI(base_url=profile.base_url, api_key=api_key, max_retries=settings.max_retries) as client:
+            for template in templates:
+                run_template(client, profile.deployment, template, args.requests, stats)
+        for template, result in zip(templates, stats.summary()):
+            result["static_tokens"] = getattr(template, 'static_tokens', None)
+            result["padding_tokens"] = getattr(template, 'padding', 0)
+            print(json.dumps(result))
+    except Exception:
+        logging.error('Failed chat completion: ', exc_info=True)
+        sys.exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from retry_policy import retry_after_seconds
+from utils import configure_logging
+
+## These classes pace chat completions on the client so fanned out requests stay inside a
+## deployment's requests per minute (RPM) and tokens per minute (TPM) quota instead of
+## burning capacity on 429 responses and retries
+##
+class TokenBucket:
+    """This class is a token bucket that refills continuously
+        Args:
+            per_minute (int): The quota per minute
+            burst_seconds (float, optional): The number of seconds of quota the bucket can hold. Defaults to 10.
+    """
+    def __init__(self, per_minute, burst_seconds=10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        """This function returns how long to wait until the bucket holds the amount"""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+## This function estimates the prompt tokens of a chat completion without a tokenizer
+##
+def estimate_prompt_tokens(messages):
+    """This function estimates the prompt tokens of a chat completion without a tokenizer
+        Args:
+            messages (list): The chat messages as dicts with role and content
+        Returns:
+            int: The estimated number of prompt tokens
+    """
+    ## Roughly four characters per token plus the per-message framing tokens of the chat format
+    return sum(len(str(m.get('content') or '')) // 4 + 4 for m in messages) + 3
+
+class Reservation:
+    """This class records the tokens reserved for a request so they can be corrected afterwards
+        Args:
+            limiter (DeploymentRateLimiter): The limiter the reservation was taken from
+            prompt_tokens (int): The estimated prompt tokens
+            tokens (int): The number of tokens reserved
+    """
+    __slots__ = ('limiter', 'prompt_tokens', 'tokens')
+
+    def __init__(self, limiter, prompt_tokens, tokens):
+        self.limiter = limiter
+        self.prompt_tokens = prompt_tokens
+        self.tokens = tokens
+
+class DeploymentRateLimiter:
+    """This class paces requests to a single deployment with a requests bucket and a tokens bucket.
+        It can be shared by threads and asyncio tasks.
+        Args:
+            rpm (int): The requests per minute quota of the deployment
+            tpm (int): The tokens per minute quota of the deployment
+            burst_seconds (float, optional): The number of seconds of quota that can be spent in a burst. Defaults to 10.
+            token_estimator (callable, optional): Estimates the prompt tokens of a list of messages. Defaults to estimate_prompt_tokens.
+    """
+    def __init__(self, rpm, tpm, burst_seconds=10.0, token_estimator=estimate_prompt_tokens):
+        self.requests = TokenBucket(rpm, burst_seconds)
+        self.tokens = TokenBucket(tpm, burst_seconds)
+        self.token_estimator = token_estimator
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def _try_reserve(self, tokens):
+        ## The lock is only held for arithmetic so it is safe to take from the event loop thread
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            wait = max(self.requests.seconds_until(1), self.tokens.seconds_until(tokens))
+            if wait == 0.0:
+                self.requests.take(1)
+                self.tokens.take(tokens)
+            return wait
+
+    def _reservation(self, messages, max_tokens):
+        ## Azure OpenAI charges the prompt size plus max_tokens against the quota when the request arrives
+        prompt_tokens = self.token_estimator(messages)
+        return Reservation(self, prompt_tokens, prompt_tokens + (max_tokens or 16))
+
+    def acquire(self, messages, max_tokens):
+        """This function blocks the calling thread until the request fits in the quota
+            Args:
+                messages (list): The chat messages
+                max_tokens (int): The max_tokens of the request
+            Returns:
+                Reservation: The reservation to pass to complete()
+        """
+        reservation = self._reservation(messages, max_tokens)
+        while True:
+            wait = self._try_reserve(reservation.tokens)
+            if wait == 0.0:
+                return reservation
+            time.sleep(wait)
+
+    async def acquire_async(self, messages, max_tokens):
+        """This function waits without blocking the event loop until the request fits in the quota
+            Args:
+                messages (list): The chat messages
+                max_tokens (int): The max_tokens of the request
+            Returns:
+                Reservation: The reservation to pass to complete()
+        """
+        reservation = self._reservation(messages, max_tokens)
+        while True:
+            wait = self._try_reserve(reservation.tokens)
+            if wait == 0.0:
+                return reservation
+            await asyncio.sleep(wait)
+
+    def complete(self, reservation, usage=None, headers=None):
+        """This function corrects the budget once the response is received
+            Args:
+                reservation (Reservation): The reservation returned by acquire()
+                usage (dict, optional): The usage field of the response
+                headers (mapping, optional): The response headers
+        """
+        with self._lock:
+            ## Replace the local prompt estimate with the real prompt size. Unused max_tokens
+            ## are not given back because the service charged them when the request arrived.
+            if usage and usage.get('prompt_tokens') is not None:
+                error = usage['prompt_tokens'] - reservation.prompt_tokens
+                if error > 0:
+                    self.tokens.take(error)
+                elif error < 0:
+                    self.tokens.give_back(-error)
+
+            ## The service's view of the remaining quota wins over the local estimate
+            if headers:
+                self._apply_header(headers, 'x-ratelimit-remaining-requests', self.requests)
+                self._apply_header(headers, 'x-ratelimit-remaining-tokens', self.tokens)
+
+    def _apply_header(self, headers, name, bucket):
+        value = headers.get(name)
+        if value is None:
+            return
+        try:
+            remaining = float(value)
+        except ValueError:
+            return
+        bucket.refill(time.monotonic())
+        bucket.level = min(bucket.level, remaining)
+
+    def throttled(self, retry_after):
+        """This function pauses the deployment after a 429 response
+            Args:
+                retry_after (float): The number of seconds the service asked to wait
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+class RateLimiter:
+    """This class holds a DeploymentRateLimiter for each deployment. It can be shared by threads and asyncio tasks.
+        Args:
+            quotas (dict, optional): Maps a deployment name to a tuple of (rpm, tpm)
+            burst_seconds (float, optional): The number of seconds of quota that can be spent in a burst. Defaults to 10.
+            token_estimator (callable, optional): Estimates the prompt tokens of a list of messages. Defaults to estimate_prompt_tokens.
+    """
+    def __init__(self, quotas=None, burst_seconds=10.0, token_estimator=estimate_prompt_tokens):
+        self.burst_seconds = burst_seconds
+        self.token_estimator = token_estimator
+        self._limiters = {}
+        self._lock = threading.Lock()
+        for deployment, (rpm, tpm) in (quotas or {}).items():
+            self.configure(deployment, rpm, tpm)
+
+    def configure(self, deployment, rpm, tpm, token_estimator=None):
+        """This function sets the quota of a deployment
+            Args:
+                deployment (str): The deployment name
+                rpm (int): The requests per minute quota
+                tpm (int): The tokens per minute quota
+                token_estimator (callable, optional): Estimates the prompt tokens of a list of messages, such as the
+                    count_messages of the deployment's token counter. Defaults to the limiter's token_estimator.
+        """
+        with self._lock:
+            self._limiters[deployment] = DeploymentRateLimiter(rpm, tpm, self.burst_seconds, token_estimator=token_estimator or self.token_estimator)
+
+    def for_deployment(self, deployment):
+        """This function returns the limiter of a deployment
+            Args:
+                deployment (str): The deployment name
+            Returns:
+                DeploymentRateLimiter: The limiter of the deployment
+        """
+        try:
+            return self._limiters[deployment]
+        except KeyError:
+            raise KeyError(f'No quota configured for deployment {deployment}') from None
+
+## These functions wrap client.chat.completions.create with the limiter. The raw response
+## is used so the x-ratelimit-remaining headers can be read.
+##
+def create_chat_completion(client, limiter, model, messages, max_tokens=100, **params):
+    """This function performs a rate limited chat completion with an OpenAI or AzureOpenAI client
+        Args:
+            client (OpenAI): An OpenAI or AzureOpenAI client
+            limiter (RateLimiter): The rate limiter
+            model (str): The deployment name
+            messages (list): The chat messages
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+            **params: Additional parameters passed to create()
+        Returns:
+            ChatCompletion: The chat completion
+    """
+    import openai
+
+    deployment_limiter = limiter.for_deployment(model)
+    reservation = deployment_limiter.acquire(messages, max_tokens)
+    try:
+        raw = client.chat.completions.with_raw_response.create(model=model, messages=messages, max_tokens=max_tokens, **params)
+    except openai.RateLimitError as e:
+        deployment_limiter.throttled(retry_after_seconds(e.response.headers))
+        raise
+    response = raw.parse()
+    deployment_limiter.complete(reservation, usage=response.usage.model_dump() if response.usage else None, headers=raw.headers)
+    return response
+
+async def acreate_chat_completion(client, limiter, model, messages, max_tokens=100, **params):
+    """This function performs a rate limited chat completion with an AsyncOpenAI or AsyncAzureOpenAI client
+        Args:
+            client (AsyncOpenAI): An AsyncOpenAI or AsyncAzureOpenAI client
+            limiter (RateLimiter): The rate limiter
+            model (str): The deployment name
+            messages (list): The chat messages
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+            **params: Additional parameters passed to create()
+        Returns:
+            ChatCompletion: The chat completion
+    """
+    import openai
+
+    deployment_limiter = limiter.for_deployment(model)
+    reservation = await deployment_limiter.acquire_async(messages, max_tokens)
+    try:
+        raw = await client.chat.completions.with_raw_response.create(model=model, messages=messages, max_tokens=max_tokens, **params)
+    except openai.RateLimitError as e:
+        deployment_limiter.throttled(retry_after_seconds(e.response.headers))
+        raise
+    response = raw.parse()
+    deployment_limiter.complete(reservation, usage=response.usage.model_dump() if response.usage else None, headers=raw.headers)
+    return response
+
+async def _fan_out(url, limiter, requests_count, concurrency):
+    import openai
+
+    client = openai.AsyncOpenAI(base_url=f"{url}/openai/v1", api_key='mock-key', max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+    throttled = 0
+
+    async def one(i):
+        nonlocal throttled
+        messages = [{"role": "user", "content": f"Tell me an interesting fact about the number {i}"}]
+        async with semaphore:
+            try:
+                if limiter:
+                    await acreate_chat_completion(client, limiter, 'gpt-4.1', messages)
+                else:
+                    await client.chat.completions.create(model='gpt-4.1', messages=messages, max_tokens=100)
+            except openai.RateLimitError:
+                throttled += 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(i) for i in range(requests_count)))
+    finally:
+        await client.close()
+    return throttled, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare fanned out requests with and without the rate limiter')
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rpm', type=int, default=3000)
+    parser.add_argument('--tpm', type=int, default=300000)
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    from mock_server import start_mock_server_process
+
+    for limited in (False, True):
+        ## A fresh mock server for each run so both start with a full quota
+        server = start_mock_server_process(chat_latency=0.02, rpm_limit=args.rpm, tpm_limit=args.tpm)
+        try:
+            limiter = RateLimiter({'gpt-4.1': (args.rpm, args.tpm)}) if limited else None
+            throttled, elapsed = asyncio.run(_fan_out(server.url, limiter, args.requests, args.concurrency))
+        finally:
+            server.shutdown()
+        print(json.dumps({
+            "rate_limited": limited,
+            "requests": args.requests,
+            "throttled_429": throttled,
+            "succeeded": args.requests - throttled,
+            "elapsed_s": round(elapsed, 3)
+        }))
+
+if __name__ == "__main__":
+    main()
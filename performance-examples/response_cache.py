@@ -0,0 +1,479 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from utils import configure_logging
+
+## numpy is optional. When it is installed the semantic index compares a prompt with every vector of its
+## scope in one matrix product, otherwise it falls back to a pure Python dot product.
+##
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+## This exception is raised by a cache backend when the store rejects a command
+##
+class CacheBackendError(Exception):
+    """This exception is raised when the store of a cache backend returns an error"""
+
+## This function builds the cache key of a chat completion from a canonical form of the request
+## so the same request always hashes the same regardless of dict ordering or whitespace
+##
+def cache_key(model, messages, params):
+    """This function builds the cache key of a chat completion
+        Args:
+            model (str): The deployment name
+            messages (list): The chat messages
+            params (dict): The sampling parameters such as max_tokens and temperature
+        Returns:
+            str: A SHA-256 hex digest of the canonical request
+    """
+    canonical = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+## These classes are the storage backends of the response cache. Each stores a JSON string by key
+## and expires it after a time to live.
+##
+class MemoryCacheBackend:
+    """This class is an in-process LRU cache with a time to live
+        Args:
+            max_entries (int, optional): The most responses to keep. Defaults to 10000.
+            ttl (float, optional): Seconds a response is kept. Defaults to 3600.
+    """
+    def __init__(self, max_entries=10000, ttl=3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SQLiteCacheBackend:
+    """This class stores responses in a SQLite file that survives restarts and can be shared by processes
+        Args:
+            path (str): The path of the SQLite file
+            ttl (float, optional): Seconds a response is kept. Defaults to 3600.
+            purge_interval (float, optional): Seconds between deletes of expired responses, which run on set. Defaults to 60.
+    """
+    def __init__(self, path, ttl=3600.0, purge_interval=60.0):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._purge_lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS responses (cache_key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at)')
+        conn.commit()
+
+    def _connection(self):
+        ## SQLite connections can't be shared across threads so each thread opens its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM responses WHERE cache_key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO responses (cache_key, value, expires_at) VALUES (?, ?, ?)',
+            (key, value, now + self.ttl)
+        )
+        ## Expired rows are never read again, so they are deleted now and then instead of letting the file grow.
+        ## One thread of the process does it at a time.
+        if now >= self._next_purge and self._purge_lock.acquire(blocking=False):
+            try:
+                self._next_purge = now + self.purge_interval
+                conn.execute('DELETE FROM responses WHERE expires_at <= ?', (now,))
+            finally:
+                self._purge_lock.release()
+        conn.commit()
+
+class RedisCacheBackend:
+    """This class stores responses in a Redis-protocol store shared by every instance of the app.
+        It speaks just enough RESP for GET and SET so it has no client library dependency.
+        Args:
+            host (str, optional): The host of the store. Defaults to 127.0.0.1.
+            port (int, optional): The port of the store. Defaults to 6379.
+            ttl (float, optional): Seconds a response is kept. Defaults to 3600.
+            prefix (str, optional): Prefix added to every key. Defaults to chat:.
+    """
+    def __init__(self, host='127.0.0.1', port=6379, ttl=3600.0, prefix='chat:'):
+        self.address = (host, port)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address, timeout=5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def _command(self, *args):
+        sock, reader = self._connection()
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        try:
+            sock.sendall(b''.join(parts))
+            line = reader.readline()
+            if not line:
+                raise ConnectionError('Connection closed by the store')
+            if line.startswith(b'$'):
+                length = int(line[1:])
+                return None if length < 0 else reader.read(length + 2)[:-2]
+        except OSError:
+            ## The connection may be half way through a reply, so it is closed rather than reused
+            self._local.conn = None
+            reader.close()
+            sock.close()
+            raise
+        if line.startswith(b'-'):
+            raise CacheBackendError(f'Redis error: {line[1:].strip().decode()}')
+        return line[1:].strip()
+
+    def get(self, key):
+        value = self._command('GET', self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self._command('SET', self.prefix + key, value, 'EX', self.ttl)
+
+## This class holds the vectors of one scope of the semantic index. With numpy they are stacked into
+## a matrix that is rebuilt on the first search after a change.
+##
+class _ScopeVectors:
+    __slots__ = ('vectors', 'keys', 'matrix')
+
+    def __init__(self):
+        self.vectors = {}
+        self.keys = None
+        self.matrix = None
+
+    def snapshot(self):
+        if _numpy is None:
+            return list(self.vectors.items())
+        if self.keys is None:
+            self.keys = list(self.vectors)
+            self.matrix = _numpy.array([self.vectors[key] for key in self.keys], dtype=_numpy.float32)
+        return self.keys, self.matrix
+
+    def changed(self):
+        self.keys = self.matrix = None
+
+## This class finds cached responses for prompts that are worded slightly differently by comparing
+## embeddings of the last turn of the conversation
+##
+class SemanticIndex:
+    """This class is an in-memory nearest neighbour index over embeddings of the last turn
+        Args:
+            embed (callable): A function that returns the embedding vector of a text
+            threshold (float, optional): The smallest cosine similarity counted as a match. Defaults to 0.95.
+            max_entries (int, optional): The most vectors to keep across every scope. Defaults to 2000.
+    """
+    def __init__(self, embed, threshold=0.95, max_entries=2000):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        ## Entries in insertion order for eviction, and the vectors of each scope so a search only
+        ## compares the prompt with conversations it could match
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        if _numpy is not None:
+            vector = _numpy.asarray(vector, dtype=_numpy.float32)
+            return vector / (_numpy.linalg.norm(vector) or 1.0)
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def search(self, scope, text):
+        """This function returns the cache key of the most similar conversation
+            Args:
+                scope (str): Only entries with the same scope match, such as the model, parameters and earlier turns
+                text (str): The text of the last turn
+            Returns:
+                tuple: The cache key or None and the embedding of the text
+        """
+        vector = self._normalize(self.embed(text))
+        with self._lock:
+            vectors = self._scopes.get(scope)
+            if vectors is None:
+                return None, vector
+            snapshot = vectors.snapshot()
+        if _numpy is not None:
+            keys, matrix = snapshot
+            scores = matrix @ vector
+            best = int(scores.argmax())
+            return (keys[best] if scores[best] >= self.threshold else None), vector
+        best_key, best_score = None, self.threshold
+        for key, entry_vector in snapshot:
+            score = sum(a * b for a, b in zip(vector, entry_vector))
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key, vector
+
+    def add(self, key, scope, vector):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None and previous != scope:
+                self._remove(key, previous)
+            self._entries[key] = scope
+            vectors = self._scopes.setdefault(scope, _ScopeVectors())
+            vectors.vectors[key] = vector
+            vectors.changed()
+            while len(self._entries) > self.max_entries:
+                oldest, oldest_scope = self._entries.popitem(last=False)
+                self._remove(oldest, oldest_scope)
+
+    def _remove(self, key, scope):
+        vectors = self._scopes[scope]
+        del vectors.vectors[key]
+        if vectors.vectors:
+            vectors.changed()
+        else:
+            del self._scopes[scope]
+
+## This class caches chat completion responses in front of any SDK
+##
+class ResponseCache:
+    """This class caches chat completion responses
+        Args:
+            backend (object, optional): The storage backend. Defaults to a MemoryCacheBackend.
+            max_temperature (float, optional): Requests with a higher temperature bypass the cache because their output is not repeatable. Defaults to 0.
+            semantic_index (SemanticIndex, optional): Enables similarity lookups for near-duplicate prompts. Defaults to None.
+    """
+    def __init__(self, backend=None, max_temperature=0.0, semantic_index=None):
+        self.backend = backend or MemoryCacheBackend()
+        self.max_temperature = max_temperature
+        self.semantic_index = semantic_index
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.errors = 0
+        self._metrics_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._metrics_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    ## A cache that is down must not take the app down with it, so backend errors are logged and
+    ## counted and the lookup is treated as a miss, or the response is returned without being stored
+    def _get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logging.warning(f'Response cache lookup failed: {e}')
+            self._count('errors')
+            return None
+
+    def _set(self, key, value):
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logging.warning(f'Response cache store failed: {e}')
+            self._count('errors')
+
+    def cacheable(self, params):
+        """This function decides whether a request can be served from the cache
+            Args:
+                params (dict): The sampling parameters
+            Returns:
+                bool: True if the request is deterministic enough to cache
+        """
+        ## The service default temperature is 1 so requests that don't set it, or send null, are not cached
+        temperature = params.get('temperature')
+        if (1.0 if temperature is None else temperature) > self.max_temperature:
+            return False
+        if params.get('stream') or params.get('n') not in (None, 1):
+            return False
+        return True
+
+    def get_or_create(self, model, messages, params, create):
+        """This function returns a cached response or calls create and caches its result
+            Args:
+                model (str): The deployment name
+                messages (list): The chat messages
+                params (dict): The sampling parameters
+                create (callable): A function that performs the request and returns a JSON serializable dict
+            Returns:
+                dict: The response
+        """
+        if not self.cacheable(params):
+            self._count('bypasses')
+            return create()
+
+        key = cache_key(model, messages, params)
+        cached = self._get(key)
+        if cached is not None:
+            self._count('hits')
+            return json.loads(cached)
+
+        vector = None
+        if self.semantic_index is not None and messages:
+            ## Only the last turn is compared by meaning. Everything before it must match exactly
+            ## so a shared system prompt can't make unrelated questions look alike.
+            scope = cache_key(model, messages[:-1], params)
+            similar_key, vector = self.semantic_index.search(scope, str(messages[-1]['content']))
+            if similar_key is not None:
+                cached = self._get(similar_key)
+                if cached is not None:
+                    self._count('semantic_hits')
+                    return json.loads(cached)
+
+        self._count('misses')
+        response = create()
+        self._set(key, json.dumps(response, separators=(',', ':')))
+        if vector is not None:
+            self.semantic_index.add(key, scope, vector)
+        return response
+
+    def metrics(self):
+        """This function returns the hit and miss counts of the cache"""
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "errors": self.errors,
+            "hit_ratio": round((self.hits + self.semantic_hits) / lookups, 4) if lookups else 0.0
+        }
+
+## This function performs a chat completion with an OpenAI or AzureOpenAI client through the cache
+##
+def cached_chat_completion(client, cache, model, messages, **params):
+    """This function performs a chat completion through the response cache
+        Args:
+            client (OpenAI): An OpenAI or AzureOpenAI client
+            cache (ResponseCache): The response cache
+            model (str): The deployment name
+            messages (list): The chat messages
+            **params: Additional parameters such as max_tokens and temperature
+        Returns:
+            ChatCompletion: The chat completion
+    """
+    from openai.types.chat import ChatCompletion
+
+    data = cache.get_or_create(
+        model, messages, params,
+        lambda: client.chat.completions.create(model=model, messages=messages, **params).model_dump(mode='json')
+    )
+    return ChatCompletion.model_validate(data)
+
+## This function builds an embedding function for the semantic index from an OpenAI client
+##
+def openai_embedder(client, model):
+    """This function builds an embedding function from an OpenAI client
+        Args:
+            client (OpenAI): An OpenAI or AzureOpenAI client
+            model (str): The embeddings deployment name
+        Returns:
+            callable: A function that returns the embedding vector of a text
+    """
+    def embed(text):
+        return client.embeddings.create(model=model, input=text).data[0].embedding
+    return embed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the response cache against the local mock server')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--distinct', type=int, default=30, help='The number of distinct prompts in the workload')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    import os
+    import tempfile
+    from openai import OpenAI
+    from mock_server import start_mock_redis, start_mock_server_process
+
+    server = start_mock_server_process(chat_latency=0.05)
+    redis = start_mock_redis()
+    temp_dir = tempfile.mkdtemp()
+    client = OpenAI(base_url=f"{server.url}/openai/v1", api_key='mock-key')
+    try:
+        caches = {
+            'none': None,
+            'memory': ResponseCache(MemoryCacheBackend()),
+            'sqlite': ResponseCache(SQLiteCacheBackend(os.path.join(temp_dir, 'responses.db'))),
+            'redis': ResponseCache(RedisCacheBackend(*redis.server_address[:2])),
+            'memory+semantic': ResponseCache(
+                MemoryCacheBackend(),
+                semantic_index=SemanticIndex(openai_embedder(client, 'text-embedding-3-small'))
+            )
+        }
+        for name, cache in caches.items():
+            start = time.perf_counter()
+            for i in range(args.requests):
+                ## Every other request adds punctuation so only a semantic lookup can match it
+                prompt = f"Tell me an interesting fact about topic {i % args.distinct}" + ('!' if (i // args.distinct) % 2 else '')
+                messages = [
+                    {"role": "system", "content": "You are a helpful assistant that provides interesting facts."},
+                    {"role": "user", "content": prompt}
+                ]
+                if cache is None:
+                    client.chat.completions.create(model='gpt-4.1', messages=messages, max_tokens=100, temperature=0)
+                else:
+                    cached_chat_completion(client, cache, 'gpt-4.1', messages, max_tokens=100, temperature=0)
+            elapsed = time.perf_counter() - start
+            print(json.dumps({
+                "cache": name,
+                "requests": args.requests,
+                "elapsed_s": round(elapsed, 3),
+                **(cache.metrics() if cache else {})
+            }))
+    finally:
+        client.close()
+        redis.shutdown()
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+from utils import configure_logging, percentile
+
+## This module decodes chat completion responses straight from the bytes of the response body into
+## small objects with __slots__. orjson is used when it is installed and parses bytes without first
+## decoding them to a str. Streamed responses are split into server-sent events as the bytes arrive
+## and each event is decoded from a memoryview of the buffer instead of a copy of the line.
+##
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+def loads(data):
+    """This function decodes JSON with orjson when it is installed and the json module otherwise
+        Args:
+            data (bytes | bytearray | memoryview | str): The JSON document
+        Returns:
+            object: The decoded document
+    """
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+def dumps(value):
+    """This function encodes JSON to compact UTF-8 bytes with orjson when it is installed and the json module otherwise
+        Args:
+            value (object): The value to encode
+        Returns:
+            bytes: The JSON document
+    """
+    if _orjson is not None:
+        return _orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+## The response objects keep only the fields the samples read. __slots__ drops the per-instance
+## __dict__, so a decoded completion is a few small objects rather than a tree of dicts.
+##
+class Usage:
+    __slots__ = ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens')
+
+    def __init__(self, prompt_tokens=0, completion_tokens=0, total_tokens=0, cached_tokens=0):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = total_tokens
+        self.cached_tokens = cached_tokens
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return None
+        ## Prompt tokens served from the prompt cache are reported under prompt_tokens_details
+        details = data.get('prompt_tokens_details') or {}
+        return cls(data.get('prompt_tokens') or 0, data.get('completion_tokens') or 0, data.get('total_tokens') or 0, details.get('cached_tokens') or 0)
+
+class Choice:
+    __slots__ = ('index', 'role', 'content', 'finish_reason')
+
+    def __init__(self, index, role, content, finish_reason):
+        self.index = index
+        self.role = role
+        self.content = content
+        self.finish_reason = finish_reason
+
+    @classmethod
+    def from_dict(cls, data, key='message'):
+        ## Completions carry a message and streamed chunks carry a delta with the same fields
+        message = data.get(key) or {}
+        return cls(data.get('index', 0), message.get('role'), message.get('content'), data.get('finish_reason'))
+
+class ChatCompletion:
+    """This class holds a decoded chat completion or streamed chat completion chunk
+        Args:
+            id (str): The completion id
+            model (str): The model that answered
+            choices (list): The choices as Choice objects
+            usage (Usage): The token usage, or None when the response has none
+    """
+    __slots__ = ('id', 'model', 'choices', 'usage')
+
+    def __init__(self, id, model, choices, usage):
+        self.id = id
+        self.model = model
+        self.choices = choices
+        self.usage = usage
+
+    @classmethod
+    def from_dict(cls, data, key='message'):
+        return cls(
+            data.get('id'),
+            data.get('model'),
+            [Choice.from_dict(choice, key) for choice in data.get('choices') or ()],
+            Usage.from_dict(data.get('usage'))
+        )
+
+    @property
+    def content(self):
+        """The content of the first choice, or None when there are no choices"""
+        return self.choices[0].content if self.choices else None
+
+## This function decodes the body of a chat completion
+##
+def decode_completion(body):
+    """This function decodes the body of a chat completion into a ChatCompletion
+        Args:
+            body (bytes): The response body
+        Returns:
+            ChatCompletion: The decoded completion
+    """
+    return ChatCompletion.from_dict(loads(body))
+
+## This function reads a chat completion from a requests Response. Response.text and Response.json()
+## decode the body to a str first, and guess its charset when the Content-Type has none.
+##
+def read_completion(response):
+    """This function decodes the body of a requests Response into a ChatCompletion
+        Args:
+            response (requests.Response): The response of a chat completion
+        Returns:
+            ChatCompletion: The decoded completion
+    """
+    response.raise_for_status()
+    return decode_completion(response.content)
+
+## This class splits server-sent events out of the bytes of a response body as they arrive. Events
+## are found in a bytearray buffer and the data of single-line events, which is what Azure OpenAI
+## sends, is decoded from a memoryview without copying it out of the buffer.
+##
+class SSEDecoder:
+    """This class decodes the data events of a server-sent event stream incrementally"""
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data = []
+        self.done = False
+
+    def feed(self, chunk):
+        """This function adds bytes of the stream and returns the events they complete
+            Args:
+                chunk (bytes): The next bytes of the response body
+            Returns:
+                list: The decoded JSON payload of each data event completed by the chunk
+        """
+        if self.done:
+            return []
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        start = 0
+        view = memoryview(buffer)
+        try:
+            while True:
+                end = buffer.find(b'\n', start)
+                if end == -1:
+                    break
+                line_end = end - 1 if end > start and buffer[end - 1] == 13 else end
+                if line_end == start:
+                    ## A blank line ends an event
+                    if self._dispatch(events):
+                        break
+                elif buffer.startswith(b'data:', start):
+                    offset = start + 5
+                    if offset < line_end and buffer[offset] == 32:
+                        offset += 1
+                    self._data.append(view[offset:line_end])
+                start = end + 1
+            ## The lines of an unfinished event can't keep views of a buffer that is about to change
+            self._data = [bytes(data) for data in self._data]
+        finally:
+            ## The consumed lines are dropped even when an event fails to decode, so the next feed
+            ## doesn't parse them again
+            view.release()
+            del buffer[:start]
+        return events
+
+    def _dispatch(self, events):
+        data = self._data
+        self._data = []
+        if not data:
+            return False
+        payload = data[0] if len(data) == 1 else b'\n'.join(data)
+        if payload == b'[DONE]':
+            self.done = True
+            return True
+        try:
+            events.append(loads(payload))
+        finally:
+            ## The views are released even when the payload fails to decode so the buffer can be trimmed
+            for line in data:
+                if isinstance(line, memoryview):
+                    line.release()
+        return False
+
+    def close(self):
+        """This function ends the stream and returns the last event when it wasn't followed by a blank line
+            Returns:
+                list: The decoded JSON payload of the last data event, if any
+        """
+        events = []
+        if self.done:
+            return events
+        if self._buffer:
+            events += self.feed(b'\n')
+        if not self.done:
+            self._dispatch(events)
+        return events
+
+def iter_sse(chunks):
+    """This function decodes the data events of a server-sent event stream
+        Args:
+            chunks (iterable): The bytes of the response body, in chunks of any size
+        Yields:
+            dict: The decoded JSON payload of each data event until the [DONE] event
+    """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+        if decoder.done:
+            return
+    yield from decoder.close()
+
+def iter_chunks(response, chunk_size=None):
+    """This function decodes a streamed chat completion from a requests Response
+        Args:
+            response (requests.Response): A response to a request sent with stream=True
+            chunk_size (int, optional): The read size. Defaults to None which yields the bytes as they arrive.
+        Yields:
+            ChatCompletion: Each streamed chunk, with the delta of each choice in its content
+    """
+    response.raise_for_status()
+    for event in iter_sse(response.iter_content(chunk_size=chunk_size)):
+        yield ChatCompletion.from_dict(event, 'delta')
+
+## The microbenchmark decodes the same bodies with the approach of the REST samples, the standard
+## library from bytes and this module, and measures the memory held by a batch of decoded results
+##
+def _completion_body(words):
+    content = ' '.join(f"word{i}" for i in range(words))
+    return json.dumps({
+        "id": "chatcmpl-benchmark",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4.1",
+        "prompt_filter_results": [{"prompt_index": 0, "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}}}],
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}}
+        }],
+        "usage": {"prompt_tokens": 20, "completion_tokens": words, "total_tokens": 20 + words}
+    }).encode('utf-8')
+
+def _stream_body(words):
+    events = []
+    for i in range(words):
+        payload = {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4.1",
+            "choices": [{"index": 0, "delta": {"content": f" word{i}"}, "finish_reason": None}]
+        }
+        events.append(f"data: {json.dumps(payload)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return ''.join(events).encode('utf-8')
+
+def _split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+def _time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return percentile(timings, 50)
+
+def _retained_bytes(function, count):
+    tracemalloc.start()
+    try:
+        kept = [function() for _ in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size // count
+
+def run_microbenchmark(words, repeat):
+    """This function compares the ways of decoding a chat completion of a given length
+        Args:
+            words (int): The number of words in the completion
+            repeat (int): The number of timed runs
+        Returns:
+            list: One result per approach
+    """
+    from streaming import parse_sse
+
+    body = _completion_body(words)
+    stream = _stream_body(words)
+    chunks = _split(stream, 8192)
+    lines = stream.split(b'\n')
+    loops = max(1, 200000 // (words + 50))
+
+    fast = 'orjson' if _orjson is not None else 'json'
+    cases = [
+        ('completion', 'json.loads(response.text)', 'json', lambda: json.loads(body.decode('utf-8'))['choices'][0]['message']['content'], lambda: json.loads(body.decode('utf-8'))),
+        ('completion', 'json.loads(bytes)', 'json', lambda: json.loads(body)['choices'][0]['message']['content'], lambda: json.loads(body)),
+        ('completion', 'decode_completion', fast, lambda: decode_completion(body).content, lambda: decode_completion(body)),
+        ('stream', 'parse_sse(iter_lines())', 'json', lambda: ''.join(e['choices'][0]['delta']['content'] for e in parse_sse(lines)), None),
+        ('stream', 'iter_sse(iter_content())', fast, lambda: ''.join(e['choices'][0]['delta']['content'] for e in iter_sse(chunks)), None)
+    ]
+    results = []
+    for kind, name, library, decode, keep in cases:
+        seconds = _time(lambda: [decode() for _ in range(loops)], repeat) / loops
+        results.append({
+            "body": kind,
+            "parser": name,
+            "json_library": library,
+            "words": words,
+            "body_bytes": len(body if kind == 'completion' else stream),
+            "us_per_body": round(seconds * 1e6, 2),
+            "mb_per_s": round(len(body if kind == 'completion' else stream) / seconds / 1e6, 1),
+            "retained_bytes": _retained_bytes(keep, 200) if keep else None
+        })
+    return results
+
+## The end-to-end run sends the same requests to the mock server and decodes them both ways
+##
+def run_end_to_end(url, requests_count, stream):
+    from http_client import create_session
+    from streaming import parse_sse
+
+    session = create_session()
+    body = {"model": "gpt-4.1", "messages": [{"role": "user", "content": "Tell me an interesting fact"}], "max_tokens": 4000}
+    headers = {'api-key': 'mock-key'}
+    target = f"{url}/openai/v1/chat/completions"
+
+    def text_json():
+        if stream:
+            with session.post(target, headers=headers, json={**body, "stream": True}, stream=True) as response:
+                return ''.join(e['choices'][0]['delta'].get('content') or '' for e in parse_sse(response.iter_lines()) if e['choices'])
+        return json.loads(session.post(target, headers=headers, json=body).text)['choices'][0]['message']['content']
+
+    def parsed():
+        if stream:
+            with session.post(target, headers=headers, json={**body, "stream": True}, stream=True) as response:
+                return ''.join(chunk.content or '' for chunk in iter_chunks(response))
+        return read_completion(session.post(target, headers=headers, json=body)).content
+
+    results = []
+    try:
+        for name, run in (('json.loads(response.text)' if not stream else 'parse_sse(iter_lines())', text_json), ('response_parser', parsed)):
+            run()
+            latencies = []
+            cpu = time.process_time()
+            for _ in range(requests_count):
+                start = time.perf_counter()
+                run()
+                latencies.append(time.perf_counter() - start)
+            results.append({
+                "body": 'stream' if stream else 'completion',
+                "parser": name,
+                "requests": requests_count,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                "client_cpu_ms_per_request": round((time.process_time() - cpu) / requests_count * 1000, 3)
+            })
+    finally:
+        session.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare decoding chat completions from bytes into slotted objects with json.loads(response.text)')
+    parser.add_argument('--words', type=int, nargs='+', default=[50, 1000, 4000], help='The lengths of the completions decoded by the microbenchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200, help='The number of requests of the end-to-end run')
+    parser.add_argument('--mock', action='store_true', help='Also decode responses of the local mock server end to end')
+    args = parser.parse_args()
+
+    configure_logging("ERROR")
+
+    if _orjson is None:
+        logging.warning('orjson is not installed so the json module is used')
+
+    for words in args.words:
+        for result in run_microbenchmark(words, args.repeat):
+            print(json.dumps(result))
+
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process(completion_text=' '.join(f"word{i}" for i in range(max(args.words))))
+        try:
+            for stream in (False, True):
+                for result in run_end_to_end(server.url, args.requests, stream):
+                    print(json.dumps(result))
+        except Exception:
+            logging.error('Failed end-to-end run: ', exc_info=True)
+            sys.exit(1)
+        finally:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
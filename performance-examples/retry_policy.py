@@ -0,0 +1,262 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+
+from utils import configure_logging
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+## This exception is raised when a request is refused because the endpoint's circuit breaker is open
+##
+class CircuitOpenError(Exception):
+    """This exception is raised when a request is refused because the endpoint's circuit breaker is open"""
+
+## This function reads the wait time from the retry-after-ms or retry-after header of a 429 or 503 response
+##
+def retry_after_seconds(headers, default=1.0):
+    """This function reads the wait time from the retry-after-ms or retry-after header
+        Args:
+            headers (mapping): The response headers
+            default (float, optional): The wait time when neither header is present. Defaults to 1.
+        Returns:
+            float: The number of seconds to wait
+    """
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return default
+
+## This class limits retries to a share of successful requests so a degraded endpoint can't
+## multiply the load sent to it
+##
+class RetryBudget:
+    """This class allows retries up to a ratio of successful requests plus a small fixed allowance
+        Args:
+            ratio (float, optional): The retries allowed per successful request. Defaults to 0.2.
+            min_per_second (float, optional): The retries always allowed per second. Defaults to 1.
+            max_balance (float, optional): The most retries that can be saved up. Defaults to 100.
+    """
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_balance=100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._balance = max_balance
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_success(self):
+        with self._lock:
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def try_spend(self):
+        """This function spends one retry from the budget
+            Returns:
+                bool: True if the retry is allowed
+        """
+        with self._lock:
+            self._refill()
+            if self._balance >= 1.0:
+                self._balance -= 1.0
+                return True
+            return False
+
+## This class stops sending requests to an endpoint that keeps failing and lets a single
+## trial request through once the endpoint has had time to recover
+##
+class CircuitBreaker:
+    """This class is a circuit breaker for one endpoint
+        Args:
+            failure_threshold (int, optional): Consecutive failures that open the circuit. Defaults to 5.
+            reset_timeout (float, optional): Seconds the circuit stays open before a trial request. Defaults to 30.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """This function checks whether a request may be sent
+            Returns:
+                bool: True if the request may be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                ## Only the caller that moves the circuit to half-open sends the trial request
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning('Circuit opened after repeated failures')
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+## This class decides whether and when a failed request is retried
+##
+class RetryPolicy:
+    """This class retries throttled and failed requests with exponential backoff and decorrelated jitter,
+        honors Retry-After, spends from a shared retry budget and keeps a circuit breaker per endpoint
+        Args:
+            max_attempts (int, optional): The most attempts per request including the first. Defaults to 5.
+            base_delay (float, optional): The smallest backoff in seconds. Defaults to 0.5.
+            max_delay (float, optional): The largest backoff in seconds. Defaults to 30.
+            budget (RetryBudget, optional): The retry budget. Defaults to a new RetryBudget.
+            failure_threshold (int, optional): Consecutive failures that open an endpoint's circuit. Defaults to 5.
+            reset_timeout (float, optional): Seconds an endpoint's circuit stays open. Defaults to 30.
+            retry_exceptions (tuple, optional): Exceptions raised by send that are retried. Defaults to OSError which covers requests connection errors.
+    """
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, budget=None, failure_threshold=5, reset_timeout=30.0, retry_exceptions=(OSError,)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_exceptions = retry_exceptions
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        """This function returns the circuit breaker of an endpoint
+            Args:
+                endpoint (str): The endpoint
+            Returns:
+                CircuitBreaker: The circuit breaker of the endpoint
+        """
+        with self._breakers_lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[endpoint]
+
+    def next_delay(self, previous_delay):
+        """This function returns the next backoff using decorrelated jitter
+            Args:
+                previous_delay (float): The previous backoff or 0 for the first retry
+            Returns:
+                float: The number of seconds to wait
+        """
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous_delay) * 3))
+
+    def call(self, endpoint, send):
+        """This function sends a request and retries it when the response is retryable
+            Args:
+                endpoint (str): The endpoint used to select the circuit breaker
+                send (callable): A function that sends the request and returns a requests or httpx Response
+            Returns:
+                response: The last response received
+        """
+        breaker = self.breaker(endpoint)
+        delay = 0.0
+        for attempt in range(1, self.max_attempts + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f'Circuit for {endpoint} is open')
+            try:
+                response = send()
+            except self.retry_exceptions as e:
+                breaker.record_failure()
+                response, error = None, e
+            except BaseException:
+                ## Any other exception still ends the attempt. Without a result a half-open circuit would wait
+                ## for its trial request forever and refuse every later request.
+                breaker.record_failure()
+                raise
+            else:
+                error = None
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    breaker.record_success()
+                    self.budget.record_success()
+                    return response
+
+                ## A 429 means the endpoint is healthy but busy so it does not count against the circuit
+                if response.status_code == 429:
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+
+            if attempt == self.max_attempts or not self.budget.try_spend():
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.next_delay(delay)
+            if response is not None:
+                delay = max(delay, retry_after_seconds(response.headers, default=0.0))
+            logging.info(f'Attempt {attempt} to {endpoint} failed with {error or response.status_code}. Retrying in {delay:.2f}s')
+            time.sleep(delay)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare requests with and without the retry policy against a fault-injecting mock')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--fault-rate', type=float, default=0.2)
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    from http_client import FoundryHttpClient
+    from mock_server import start_mock_server
+
+    messages = [{"role": "user", "content": "Tell me an interesting fact"}]
+    for name, fault_rate, policy in (
+        ('no retries', args.fault_rate, None),
+        ('retry policy', args.fault_rate, RetryPolicy(base_delay=0.01, max_delay=0.5)),
+        ('retry policy with endpoint down', 1.0, RetryPolicy(base_delay=0.01, max_delay=0.5))
+    ):
+        server = start_mock_server(fault_rate=fault_rate)
+        succeeded = refused = 0
+        start = time.perf_counter()
+        try:
+            with FoundryHttpClient(endpoint=server.url, api_key='mock-key', retry_policy=policy) as client:
+                for _ in range(args.requests):
+                    try:
+                        client.chat_completion(messages, model='gpt-4.1', max_tokens=100)
+                        succeeded += 1
+                    except CircuitOpenError:
+                        refused += 1
+                    except Exception:
+                        pass
+        finally:
+            server.shutdown()
+        print(json.dumps({
+            "mode": name,
+            "fault_rate": fault_rate,
+            "requests": args.requests,
+            "succeeded": succeeded,
+            "refused_by_circuit": refused,
+            "attempts_sent": server.counts.get('chat', 0),
+            "elapsed_s": round(time.perf_counter() - start, 3)
+        }))
+
+if __name__ == "__main__":
+    main()
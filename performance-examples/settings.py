@@ -0,0 +1,462 @@
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+from dataclasses import dataclass, field, replace
+from urllib.parse import urlsplit
+
+## This module loads the configuration of the performance examples once into a frozen settings object
+## instead of each script calling load_dotenv and os.getenv wherever a value is needed. Every value is
+## validated up front, so a typo or a missing variable stops the process with one clear message instead
+## of surfacing as 401 or 404 responses that get retried. Only the standard library is imported so the
+## unified CLI stays light at start-up.
+##
+AUTH_MODES = ('api-key', 'managed-identity', 'service-principal', 'obo', 'default')
+CREDENTIAL_KINDS = ('auto', 'workload-identity', 'client-secret', 'managed-identity')
+DEFAULT_API_VERSION = '2024-10-21'
+API_VERSION_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}(-preview)?$')
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+## The variables of a profile. With FOUNDRY_PROFILES set, each can be given per profile by prefixing it
+## with the profile name and two underscores, such as EASTUS__FOUNDRY_ENDPOINT, and falls back to the
+## unprefixed variable so profiles only repeat what differs between regions.
+##
+PROFILE_VARIABLES = (
+    'FOUNDRY_ENDPOINT',
+    'DEPLOYMENT_NAME',
+    'BATCH_DEPLOYMENT_NAME',
+    'MODEL_NAME',
+    'OPENAI_API_VERSION',
+    'FOUNDRY_API_KEY',
+    'AUTH_MODE',
+    'WEIGHT',
+    'RPM_LIMIT',
+    'TPM_LIMIT'
+)
+GLOBAL_VARIABLES = (
+    'FOUNDRY_PROFILES',
+    'FOUNDRY_PROFILE',
+    'FOUNDRY_BACKENDS',
+    'AZURE_TENANT_ID',
+    'AZURE_CLIENT_ID',
+    'AZURE_CLIENT_SECRET',
+    'AZURE_AUTHORITY_HOST',
+    'AZURE_FEDERATED_TOKEN_FILE',
+    'AZURE_CREDENTIAL_KIND',
+    'INITIAL_SCOPE',
+    'MANAGED_IDENTITY_CLIENT_ID',
+    'TOKEN_CACHE_PATH',
+    'TOKEN_REFRESH_MARGIN',
+    'CREDENTIAL_STATE_PATH',
+    'POOL_SIZE',
+    'CONCURRENCY',
+    'MAX_RETRIES',
+    'REQUEST_TIMEOUT',
+    'GATEWAY_API_KEY'
+)
+KNOWN_VARIABLES = PROFILE_VARIABLES + GLOBAL_VARIABLES
+
+## Values copied unchanged from .env-sample
+##
+PLACEHOLDERS = ('FOUNDRY_RESOURCE_NAME', 'FOUNDRY_RESOURCE_EASTUS', 'FOUNDRY_RESOURCE_WESTUS', 'YOUR_')
+
+class ConfigurationError(ValueError):
+    """This exception is raised when the configuration is invalid and lists every problem found
+        Args:
+            errors (list): The problems found
+    """
+    def __init__(self, errors):
+        super().__init__('Invalid configuration:\n' + '\n'.join(f'  - {error}' for error in errors))
+        self.errors = errors
+
+@dataclass(frozen=True)
+class Profile:
+    """This class is the endpoint, deployment and authentication of one region or resource
+        Args:
+            name (str): The profile name
+            endpoint (str): The Foundry endpoint without a trailing slash
+            deployment (str): The deployment name
+            api_version (str): The API version used by the legacy API, Azure AI Inference and LangChain
+            auth_mode (str): One of api-key, managed-identity, service-principal, obo or default
+            api_key (str, optional): The API key when auth_mode is api-key
+            batch_deployment (str, optional): The global batch deployment name
+            weight (float, optional): The relative capacity of the profile for the load balancer. Defaults to 1.
+            rpm_limit (int, optional): The requests per minute quota of the deployment
+            tpm_limit (int, optional): The tokens per minute quota of the deployment
+            model (str, optional): The model behind the deployment when its name differs from the model name
+    """
+    name: str
+    endpoint: str
+    deployment: str
+    api_version: str = DEFAULT_API_VERSION
+    auth_mode: str = 'default'
+    api_key: str = field(default=None, repr=False)
+    batch_deployment: str = None
+    weight: float = 1.0
+    rpm_limit: int = None
+    tpm_limit: int = None
+    model: str = None
+
+    @property
+    def model_name(self):
+        """The model behind the deployment, which picks the tokenizer and context window"""
+        return self.model or self.deployment or self.batch_deployment
+
+    @property
+    def base_url(self):
+        """The base URL of the OpenAI v1 API"""
+        return f"{self.endpoint}/openai/v1"
+
+@dataclass(frozen=True)
+class Identity:
+    """This class holds the Entra ID settings shared by every profile
+        Args:
+            tenant_id (str, optional): The tenant of the service principal
+            client_id (str, optional): The client id of the service principal
+            client_secret (str, optional): The client secret of the service principal
+            managed_identity_client_id (str, optional): The client id of a user-assigned managed identity
+            authority_host (str, optional): The Entra ID authority host
+            initial_scope (str, optional): The scope of the user assertion in the OBO flow. Defaults to the client id.
+            credential_kind (str, optional): The credential the credential selector builds. Defaults to auto.
+            federated_token_file (str, optional): The token file of workload identity
+    """
+    tenant_id: str = None
+    client_id: str = None
+    client_secret: str = field(default=None, repr=False)
+    managed_identity_client_id: str = None
+    authority_host: str = 'https://login.microsoftonline.com'
+    initial_scope: str = None
+    credential_kind: str = 'auto'
+    federated_token_file: str = None
+
+@dataclass(frozen=True)
+class Settings:
+    """This class is the validated configuration of the examples
+        Args:
+            profiles (tuple): The Profile objects in the order they were declared
+            default_profile (str): The name of the profile returned by profile()
+            backends (tuple, optional): The Profile objects the load balancer spreads requests over. Defaults to the profiles.
+            identity (Identity): The Entra ID settings
+            pool_size (int, optional): The connections kept alive per host. Defaults to 10.
+            concurrency (int, optional): The requests in flight. Defaults to 16.
+            max_retries (int, optional): The retries of the SDK clients. Defaults to 2.
+            request_timeout (float, optional): The request timeout in seconds. Defaults to 60.
+            token_cache_path (str, optional): The SQLite file shared by processes for cached tokens
+            token_refresh_margin (int, optional): Seconds before expiry at which tokens are refreshed. Defaults to 300.
+            credential_state_path (str, optional): The file where the credential selector remembers what worked
+            gateway_api_key (str, optional): The key clients of the local gateway must send. Defaults to None which accepts any client.
+    """
+    profiles: tuple
+    default_profile: str
+    backends: tuple = ()
+    identity: Identity = Identity()
+    pool_size: int = 10
+    concurrency: int = 16
+    max_retries: int = 2
+    request_timeout: float = 60.0
+    token_cache_path: str = None
+    token_refresh_margin: int = 300
+    credential_state_path: str = None
+    gateway_api_key: str = field(default=None, repr=False)
+
+    def profile(self, name=None):
+        """This function returns a profile by name
+            Args:
+                name (str, optional): The profile name. Defaults to the default profile.
+            Returns:
+                Profile: The profile
+        """
+        name = name or self.default_profile
+        for profile in self.profiles:
+            if profile.name == name:
+                return profile
+        raise ConfigurationError([f"Unknown profile '{name}'. The profiles are {', '.join(p.name for p in self.profiles)}"])
+
+    def rate_limits(self):
+        """This function returns the quotas of the profiles in the form RateLimiter takes
+            Returns:
+                dict: The (rpm, tpm) tuple of each deployment that has both limits set
+        """
+        return {p.deployment: (p.rpm_limit, p.tpm_limit) for p in self.profiles + self.backends if p.rpm_limit and p.tpm_limit}
+
+## The reader below collects every problem instead of stopping at the first one so a broken .env file
+## is fixed in one pass
+##
+class _Reader:
+    def __init__(self, environ):
+        self.environ = environ
+        self.errors = []
+
+    def get(self, name, default=None):
+        value = self.environ.get(name)
+        if value is None or value.strip() == '':
+            return default
+        value = value.strip()
+        if value == name or any(placeholder in value for placeholder in PLACEHOLDERS):
+            self.errors.append(f'{name} still has the placeholder value from .env-sample')
+        return value
+
+    def number(self, name, default, kind=int, minimum=1):
+        value = self.get(name)
+        if value is None:
+            return default
+        try:
+            number = kind(value)
+        except ValueError:
+            self.errors.append(f"{name} must be {'an integer' if kind is int else 'a number'}, got '{value}'")
+            return default
+        if number < minimum:
+            self.errors.append(f'{name} must be at least {minimum}, got {value}')
+        return number
+
+    def profile_value(self, profile, name, default=None):
+        ## The prefixed variable of a named profile wins over the shared one
+        if profile is not None:
+            value = self.get(f'{profile.upper()}__{name}')
+            if value is not None:
+                return value
+        return self.get(name, default)
+
+    def profile_number(self, profile, name, default, kind=int, minimum=1):
+        if profile is not None and (self.environ.get(f'{profile.upper()}__{name}') or '').strip():
+            return self.number(f'{profile.upper()}__{name}', default, kind, minimum)
+        return self.number(name, default, kind, minimum)
+
+def _check_endpoint(name, endpoint, errors, variable='FOUNDRY_ENDPOINT'):
+    if endpoint is None:
+        errors.append(f'{name} is not set. Set {variable}.')
+        return None
+    parts = urlsplit(endpoint)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        errors.append(f"{name} must be a URL such as https://RESOURCE.services.ai.azure.com, got '{endpoint}'")
+    elif parts.scheme == 'http' and parts.hostname not in LOCAL_HOSTS:
+        ## Only the local mock server is reached over http. Bearer tokens and keys must not be sent in the clear.
+        errors.append(f"{name} must use https, got '{endpoint}'")
+    elif parts.path.rstrip('/'):
+        errors.append(f"{name} must be the resource URL without a path, got '{endpoint}'. The examples add /openai/v1 themselves.")
+    return endpoint.rstrip('/')
+
+def _read_profile(reader, name, label, prefix=None, entry=None):
+    ## A profile is read from prefixed variables, from the unprefixed ones or from a FOUNDRY_BACKENDS entry
+    errors = []
+    if entry is None:
+        endpoint = reader.profile_value(prefix, 'FOUNDRY_ENDPOINT')
+        deployment = reader.profile_value(prefix, 'DEPLOYMENT_NAME')
+        model = reader.profile_value(prefix, 'MODEL_NAME')
+        api_key = reader.profile_value(prefix, 'FOUNDRY_API_KEY')
+        auth_mode = reader.profile_value(prefix, 'AUTH_MODE', 'api-key' if api_key else 'default')
+        weight = reader.profile_number(prefix, 'WEIGHT', 1.0, kind=float, minimum=0.001)
+    else:
+        endpoint = entry.get('endpoint')
+        deployment = entry.get('deployment')
+        model = entry.get('model')
+        api_key = entry.get('api_key')
+        auth_mode = entry.get('auth_mode')
+        weight = entry.get('weight', 1.0)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight <= 0:
+            errors.append(f"{label} weight must be a positive number, got {weight!r}")
+        ## The values are used as strings from here on, so anything else is reported and dropped
+        for key in ('endpoint', 'deployment', 'model', 'api_key', 'auth_mode'):
+            value = entry.get(key)
+            if value is not None and not isinstance(value, str):
+                errors.append(f"{label} {key} must be a string, got {value!r}")
+        endpoint, deployment, model, api_key, auth_mode = (
+            value if isinstance(value, str) else None for value in (endpoint, deployment, model, api_key, auth_mode)
+        )
+        ## Backends without an API key authenticate with a managed identity as the load balancer always has
+        auth_mode = auth_mode or ('api-key' if api_key else 'managed-identity')
+
+    endpoint = _check_endpoint(f'{label} endpoint', endpoint, errors, variable=f'{prefix.upper()}__FOUNDRY_ENDPOINT' if prefix else 'FOUNDRY_ENDPOINT')
+    batch_deployment = reader.profile_value(prefix, 'BATCH_DEPLOYMENT_NAME')
+    if deployment is None and batch_deployment is None:
+        errors.append(f'{label} has no deployment. Set DEPLOYMENT_NAME or BATCH_DEPLOYMENT_NAME.')
+
+    api_version = reader.profile_value(prefix, 'OPENAI_API_VERSION', DEFAULT_API_VERSION)
+    if not API_VERSION_PATTERN.match(api_version):
+        errors.append(f"{label} OPENAI_API_VERSION must look like 2024-10-21 or 2025-04-01-preview, got '{api_version}'")
+
+    if auth_mode not in AUTH_MODES:
+        errors.append(f"{label} AUTH_MODE must be one of {', '.join(AUTH_MODES)}, got '{auth_mode}'")
+    elif auth_mode == 'api-key' and not api_key:
+        errors.append(f'{label} uses api-key authentication but FOUNDRY_API_KEY is not set')
+
+    reader.errors.extend(errors)
+    return Profile(
+        name=name,
+        endpoint=endpoint,
+        deployment=deployment,
+        api_version=api_version,
+        auth_mode=auth_mode,
+        api_key=api_key,
+        batch_deployment=batch_deployment,
+        weight=weight,
+        rpm_limit=reader.profile_number(prefix, 'RPM_LIMIT', None),
+        tpm_limit=reader.profile_number(prefix, 'TPM_LIMIT', None),
+        model=model
+    )
+
+def _check_unknown(environ, names, profile_names, errors):
+    ## A misspelt variable is otherwise ignored silently and its default is used in its place
+    known = set(KNOWN_VARIABLES)
+    known.update(f'{p.upper()}__{v}' for p in profile_names for v in PROFILE_VARIABLES)
+    for name in sorted(names):
+        if name in known:
+            continue
+        profile, _, variable = name.rpartition('__')
+        if profile and variable in PROFILE_VARIABLES:
+            errors.append(f"{name} is for profile '{profile.lower()}' which is not listed in FOUNDRY_PROFILES")
+            continue
+        import difflib
+        match = difflib.get_close_matches(name, known, n=1, cutoff=0.85)
+        if match:
+            errors.append(f'Unknown variable {name}. Did you mean {match[0]}?')
+
+def load_settings(environ=None, dotenv_path='.env', overrides=None):
+    """This function loads and validates the settings
+        Args:
+            environ (dict, optional): The variables to read. Defaults to the process environment after loading the .env file.
+            dotenv_path (str, optional): The .env file to load into the process environment. Defaults to '.env'. None skips it.
+            overrides (dict, optional): Variables that replace those of the environment, such as command line options
+        Returns:
+            Settings: The validated settings
+        Raises:
+            ConfigurationError: When a variable is missing, misspelt or invalid
+    """
+    checked = set()
+    if environ is None:
+        if dotenv_path and os.path.exists(dotenv_path):
+            ## The .env file is still loaded into the process environment because azure-identity
+            ## and the credential selector read AZURE_* variables from there
+            from dotenv import dotenv_values, load_dotenv
+            load_dotenv(dotenv_path)
+            checked.update(dotenv_values(dotenv_path))
+        environ = os.environ
+    else:
+        checked.update(environ)
+    ## A snapshot, so later changes to the environment don't change the settings
+    environ = {**environ, **(overrides or {})}
+    checked.update(overrides or {})
+    reader = _Reader(environ)
+
+    profile_names = [p.strip().lower() for p in (reader.get('FOUNDRY_PROFILES') or '').split(',') if p.strip()]
+    profiles = []
+    for name in profile_names:
+        if not re.match(r'^[a-z][a-z0-9_]*$', name):
+            reader.errors.append(f"Profile name '{name}' must start with a letter and only contain letters, digits and underscores")
+        profiles.append(_read_profile(reader, name, f"Profile '{name}'", prefix=name))
+
+    ## The load balancer's list of backends, each with endpoint, deployment and optionally api_key and weight.
+    ## Named profiles take its place when both are set.
+    backends = []
+    value = reader.get('FOUNDRY_BACKENDS')
+    if value is not None and not profile_names:
+        try:
+            entries = json.loads(value)
+            if not isinstance(entries, list) or not entries or not all(isinstance(entry, dict) for entry in entries):
+                raise ValueError('expected a non-empty list of objects')
+        except ValueError as e:
+            reader.errors.append(f'FOUNDRY_BACKENDS must be a JSON list of objects: {e}')
+            entries = []
+        for i, entry in enumerate(entries):
+            backends.append(_read_profile(reader, f'backend{i}', f'FOUNDRY_BACKENDS[{i}]', entry=entry))
+
+    if not profile_names:
+        ## A configuration with only FOUNDRY_BACKENDS runs the single-endpoint examples against the first backend
+        if backends and reader.get('FOUNDRY_ENDPOINT') is None:
+            profiles = list(backends)
+        else:
+            profiles = [_read_profile(reader, 'default', "Profile 'default'")]
+        profile_names = [p.name for p in profiles]
+
+    default_profile = (reader.get('FOUNDRY_PROFILE') or (profile_names[0] if profile_names else 'default')).lower()
+    if profile_names and default_profile not in profile_names:
+        reader.errors.append(f"FOUNDRY_PROFILE is '{default_profile}' but the profiles are {', '.join(profile_names)}")
+
+    identity = Identity(
+        tenant_id=reader.get('AZURE_TENANT_ID'),
+        client_id=reader.get('AZURE_CLIENT_ID'),
+        client_secret=reader.get('AZURE_CLIENT_SECRET'),
+        managed_identity_client_id=reader.get('MANAGED_IDENTITY_CLIENT_ID'),
+        authority_host=reader.get('AZURE_AUTHORITY_HOST', 'https://login.microsoftonline.com').rstrip('/'),
+        initial_scope=reader.get('INITIAL_SCOPE'),
+        credential_kind=reader.get('AZURE_CREDENTIAL_KIND', 'auto'),
+        federated_token_file=reader.get('AZURE_FEDERATED_TOKEN_FILE')
+    )
+    for profile in profiles:
+        if profile.auth_mode in ('service-principal', 'obo'):
+            missing = [n for n, v in (('AZURE_TENANT_ID', identity.tenant_id), ('AZURE_CLIENT_ID', identity.client_id), ('AZURE_CLIENT_SECRET', identity.client_secret)) if not v]
+            if missing:
+                reader.errors.append(f"Profile '{profile.name}' uses {profile.auth_mode} authentication but {', '.join(missing)} {'is' if len(missing) == 1 else 'are'} not set")
+    _check_endpoint('AZURE_AUTHORITY_HOST', identity.authority_host, reader.errors)
+    if identity.credential_kind not in CREDENTIAL_KINDS:
+        reader.errors.append(f"AZURE_CREDENTIAL_KIND must be one of {', '.join(CREDENTIAL_KINDS)}, got '{identity.credential_kind}'")
+
+    settings = Settings(
+        profiles=tuple(profiles),
+        backends=tuple(backends or profiles),
+        default_profile=default_profile,
+        identity=identity,
+        pool_size=reader.number('POOL_SIZE', 10),
+        concurrency=reader.number('CONCURRENCY', 16),
+        max_retries=reader.number('MAX_RETRIES', 2, minimum=0),
+        request_timeout=reader.number('REQUEST_TIMEOUT', 60.0, kind=float, minimum=0.1),
+        token_cache_path=reader.get('TOKEN_CACHE_PATH'),
+        token_refresh_margin=reader.number('TOKEN_REFRESH_MARGIN', 300, minimum=0),
+        credential_state_path=reader.get('CREDENTIAL_STATE_PATH'),
+        gateway_api_key=reader.get('GATEWAY_API_KEY')
+    )
+    _check_unknown(environ, checked, profile_names, reader.errors)
+    if reader.errors:
+        ## A shared variable read by several profiles is reported once
+        raise ConfigurationError(list(dict.fromkeys(reader.errors)))
+    return settings
+
+## The process-wide settings, loaded on first use
+##
+_settings = None
+_settings_lock = threading.Lock()
+
+def get_settings(dotenv_path='.env'):
+    """This function returns the process-wide settings, loading them on first use
+        Args:
+            dotenv_path (str, optional): The .env file to load on first use. Defaults to '.env'. None skips it.
+        Returns:
+            Settings: The validated settings
+        Raises:
+            ConfigurationError: When a variable is missing, misspelt or invalid
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings(dotenv_path=dotenv_path)
+    return _settings
+
+def mock_settings(server_url, deployment='gpt-4.1', **overrides):
+    """This function returns settings that point every profile at the local mock server
+        Args:
+            server_url (str): The URL of the mock server
+            deployment (str, optional): The deployment name. Defaults to 'gpt-4.1'.
+            **overrides: Settings fields to replace, such as concurrency
+        Returns:
+            Settings: The settings
+    """
+    profile = Profile(name='default', endpoint=server_url, deployment=deployment, auth_mode='api-key', api_key='mock-key', batch_deployment=f'{deployment}-batch')
+    return replace(Settings(profiles=(profile,), default_profile='default', backends=(profile,)), **overrides)
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate the configuration and print the settings without secrets')
+    parser.add_argument('--dotenv', default='.env', help='The .env file to load')
+    args = parser.parse_args()
+
+    try:
+        settings = load_settings(dotenv_path=args.dotenv)
+    except ConfigurationError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(settings)
+
+if __name__ == "__main__":
+    main()
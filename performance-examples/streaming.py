@@ -0,0 +1,247 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from messages import to_inference, to_langchain
+from settings import ConfigurationError, get_settings, mock_settings
+from utils import configure_logging, percentile
+
+## These functions turn the streaming APIs of each SDK into plain iterators of text deltas so
+## TimedStream can measure them the same way. Each iterator sends its request on first use.
+##
+def openai_deltas(client, model, messages, **params):
+    """This function streams a chat completion with an OpenAI or AzureOpenAI client
+        Args:
+            client (OpenAI): An OpenAI or AzureOpenAI client
+            model (str): The deployment name
+            messages (list): The chat messages
+            **params: Additional parameters such as max_tokens
+        Yields:
+            str: The text deltas of the assistant message
+    """
+    for chunk in client.chat.completions.create(model=model, messages=messages, stream=True, **params):
+        ## Azure OpenAI sends a first chunk with content filter results and no choices
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def inference_deltas(client, messages, **params):
+    """This function streams a chat completion with the Azure AI Inference ChatCompletionsClient
+        Args:
+            client (ChatCompletionsClient): The chat completions client
+            messages (list): The chat messages as SystemMessage and UserMessage objects
+            **params: Additional parameters such as max_tokens and model
+        Yields:
+            str: The text deltas of the assistant message
+    """
+    response = client.complete(stream=True, messages=messages, **params)
+    try:
+        for update in response:
+            if update.choices and update.choices[0].delta.content:
+                yield update.choices[0].delta.content
+    finally:
+        response.close()
+
+def langchain_deltas(llm, messages, **params):
+    """This function streams a chat completion with AzureChatOpenAI.stream
+        Args:
+            llm (AzureChatOpenAI): The LangChain chat model
+            messages (list): The chat messages as SystemMessage and HumanMessage objects
+            **params: Additional parameters such as max_tokens
+        Yields:
+            str: The text deltas of the assistant message
+    """
+    for chunk in llm.stream(messages, **params):
+        if chunk.content:
+            yield chunk.content
+
+## This function parses server-sent events from the lines of a response body
+##
+def parse_sse(lines):
+    """This function parses server-sent events from the lines of a response body
+        Args:
+            lines (iterable): The lines of the response body as bytes or str
+        Yields:
+            dict: The decoded JSON payload of each data event until the [DONE] event
+    """
+    data = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line:
+            ## A blank line ends an event
+            if data:
+                payload = '\n'.join(data)
+                data = []
+                if payload == '[DONE]':
+                    return
+                yield json.loads(payload)
+            continue
+        if line.startswith('data:'):
+            data.append(line[5:].lstrip())
+    if data and '\n'.join(data) != '[DONE]':
+        yield json.loads('\n'.join(data))
+
+def rest_deltas(session, url, headers, body):
+    """This function streams a chat completion over the REST API
+        Args:
+            session (requests.Session): The session used to send the request
+            url (str): The URL of the chat completions operation
+            headers (dict): The request headers
+            body (dict): The JSON body of the request
+        Yields:
+            str: The text deltas of the assistant message
+    """
+    from response_parser import iter_sse
+
+    with session.post(url, headers=headers, json={**body, "stream": True}, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        ## The events are split out of the bytes as they arrive instead of line by line
+        for event in iter_sse(response.iter_content(chunk_size=None)):
+            choices = event.get('choices')
+            if choices and choices[0].get('delta', {}).get('content'):
+                yield choices[0]['delta']['content']
+
+## This class wraps a stream of text deltas and records time to first token, the latency
+## between tokens and the total time of the request
+##
+class TimedStream:
+    """This class wraps a stream of text deltas and records its latency
+        Args:
+            deltas (iterator): An iterator of text deltas. The clock starts when iteration starts.
+    """
+    def __init__(self, deltas):
+        self._deltas = deltas
+        self.start = None
+        self.first_token = None
+        self.end = None
+        self.chunk_times = []
+        self.chunks = []
+
+    def __iter__(self):
+        self.start = time.perf_counter()
+        for delta in self._deltas:
+            now = time.perf_counter()
+            if self.first_token is None:
+                self.first_token = now
+            self.chunk_times.append(now)
+            self.chunks.append(delta)
+            yield delta
+        self.end = time.perf_counter()
+
+    @property
+    def text(self):
+        return ''.join(self.chunks)
+
+    def metrics(self):
+        """This function returns the latency of the stream
+            Returns:
+                dict: Time to first token, inter-token latency and total time in milliseconds
+        """
+        gaps = [b - a for a, b in zip(self.chunk_times, self.chunk_times[1:])]
+        return {
+            "ttft_ms": round((self.first_token - self.start) * 1000, 3) if self.first_token else None,
+            "inter_token_mean_ms": round(sum(gaps) / len(gaps) * 1000, 3) if gaps else None,
+            "inter_token_p50_ms": round(percentile(gaps, 50) * 1000, 3) if gaps else None,
+            "inter_token_p99_ms": round(percentile(gaps, 99) * 1000, 3) if gaps else None,
+            "total_ms": round((self.end - self.start) * 1000, 3) if self.end else None,
+            "chunks": len(self.chunks)
+        }
+
+## This function builds the stream of text deltas for one of the SDKs
+##
+def create_stream(sdk, endpoint, deployment, api_version, api_key, messages, max_tokens=100):
+    """This function builds the stream of text deltas for one of the SDKs
+        Args:
+            sdk (str): One of openai, openai-legacy, inference, langchain or rest
+            endpoint (str): The Foundry or Azure OpenAI endpoint
+            deployment (str): The deployment name
+            api_version (str): The API version used by the legacy API, Azure AI Inference and LangChain
+            api_key (str): The API key
+            messages (list): The chat messages as dicts with role and content
+            max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 100.
+        Returns:
+            iterator: The text deltas
+    """
+    if sdk == 'openai':
+        from openai import OpenAI
+        client = OpenAI(base_url=f"{endpoint}/openai/v1", api_key=api_key)
+        return openai_deltas(client, deployment, messages, max_tokens=max_tokens)
+    if sdk == 'openai-legacy':
+        from openai import AzureOpenAI
+        client = AzureOpenAI(api_version=api_version, azure_endpoint=endpoint, api_key=api_key)
+        return openai_deltas(client, deployment, messages, max_tokens=max_tokens)
+    if sdk == 'inference':
+        from azure.ai.inference import ChatCompletionsClient
+        from azure.core.credentials import AzureKeyCredential
+        client = ChatCompletionsClient(
+            endpoint=f"{endpoint}/openai/deployments/{deployment}",
+            credential=AzureKeyCredential(api_key),
+            api_version=api_version
+        )
+        return inference_deltas(client, to_inference(messages), max_tokens=max_tokens, model=deployment)
+    if sdk == 'langchain':
+        from langchain_openai import AzureChatOpenAI
+        llm = AzureChatOpenAI(azure_endpoint=endpoint, azure_deployment=deployment, api_version=api_version, api_key=api_key)
+        return langchain_deltas(llm, to_langchain(messages), max_tokens=max_tokens)
+    if sdk == 'rest':
+        from http_client import create_session
+        return rest_deltas(
+            create_session(),
+            f"{endpoint}/openai/v1/chat/completions",
+            {'api-key': api_key},
+            {"model": deployment, "messages": messages, "max_tokens": max_tokens}
+        )
+    raise ValueError(f'Unknown SDK: {sdk}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream a chat completion and report time to first token')
+    parser.add_argument('--sdk', nargs='+', default=['openai'], choices=['openai', 'openai-legacy', 'inference', 'langchain', 'rest'])
+    parser.add_argument('--mock', action='store_true', help='Run against the local mock server')
+    args = parser.parse_args()
+
+    ## Setup logging
+    ##
+    configure_logging("ERROR")
+
+    ## Load and validate the settings from the environment and the .env file.
+    ## The variables loaded include FOUNDRY_ENDPOINT, FOUNDRY_API_KEY, DEPLOYMENT_NAME and OPENAI_API_VERSION
+    server = None
+    if args.mock:
+        from mock_server import start_mock_server_process
+        server = start_mock_server_process(chat_latency=0.2, stream_delay=0.03)
+        profile = mock_settings(server.url).profile()
+    else:
+        try:
+            profile = get_settings().profile()
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that provides interesting facts."
+        },
+        {
+            "role": "user",
+            "content": "Tell me an interesting fact"
+        }
+    ]
+    try:
+        for sdk in args.sdk:
+            stream = TimedStream(create_stream(sdk, profile.endpoint, profile.deployment, profile.api_version, profile.api_key, messages))
+            for delta in stream:
+                print(delta, end='', flush=True)
+            print()
+            print(json.dumps({"sdk": sdk, **stream.metrics()}))
+    except Exception:
+        logging.error('Failed chat completion: ', exc_info=True)
+        sys.exit(1)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import json
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from settings import ConfigurationError, get_settings, load_settings
+from utils import configure_logging
+
+## This class caches access tokens in memory and optionally in a SQLite file shared by every
+## worker process on the host. Tokens are refreshed proactively before they expire and only
+## one thread or process fetches a new token at a time.
+##
+class TokenCache:
+    """This class caches access tokens in memory with an optional SQLite store shared across processes
+        Args:
+            path (str, optional): Path to a SQLite file used to share tokens across processes. Defaults to None which keeps tokens in memory only.
+            refresh_margin (int, optional): Seconds before expiry at which a token is refreshed. Defaults to 300.
+    """
+    def __init__(self, path=None, refresh_margin=300):
+        self._path = path
+        self._refresh_margin = refresh_margin
+        self._memory = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        if path:
+            self._create_store()
+
+    def _create_store(self):
+        conn = sqlite3.connect(self._path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                'cache_key TEXT PRIMARY KEY, access_token TEXT NOT NULL, expires_on REAL NOT NULL)'
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        ## The store holds bearer tokens so it must only be readable by the current user
+        os.chmod(self._path, 0o600)
+
+    def _lock_for(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _is_fresh(self, entry):
+        return entry is not None and entry[1] - self._refresh_margin > time.time()
+
+    def _is_valid(self, entry):
+        return entry is not None and entry[1] > time.time()
+
+    def get_token(self, key, fetch_token):
+        """This function returns a cached token or fetches a new one if the cached token is close to expiry
+            Args:
+                key (str): The cache key identifying the client and scopes
+                fetch_token (callable): A function that returns a tuple of (access_token, expires_on)
+            Returns:
+                str: An access token
+        """
+        entry = self._memory.get(key)
+        if self._is_fresh(entry):
+            return entry[0]
+
+        lock = self._lock_for(key)
+
+        ## If the token is still valid and another thread is already refreshing it
+        ## hand out the current token instead of waiting on the refresh
+        if self._is_valid(entry):
+            if not lock.acquire(blocking=False):
+                return entry[0]
+        else:
+            lock.acquire()
+
+        try:
+            ## Another thread may have refreshed the token while this one waited on the lock
+            entry = self._memory.get(key)
+            if self._is_fresh(entry):
+                return entry[0]
+            entry = self._load_or_fetch(key, fetch_token)
+            self._memory[key] = entry
+            return entry[0]
+        finally:
+            lock.release()
+
+    def _load_or_fetch(self, key, fetch_token):
+        if not self._path:
+            return self._fetch(fetch_token)
+
+        ## BEGIN IMMEDIATE takes the database write lock so only one process on the
+        ## host refreshes a given token while the others wait and then read it
+        conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT access_token, expires_on FROM tokens WHERE cache_key = ?', (key,)
+            ).fetchone()
+            if self._is_fresh(row):
+                conn.execute('COMMIT')
+                return tuple(row)
+            entry = self._fetch(fetch_token)
+            conn.execute(
+                'INSERT OR REPLACE INTO tokens (cache_key, access_token, expires_on) VALUES (?, ?, ?)',
+                (key, entry[0], entry[1])
+            )
+            conn.execute('COMMIT')
+            return entry
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _fetch(self, fetch_token):
+        start = time.perf_counter()
+        access_token, expires_on = fetch_token()
+        logging.info(f'Fetched a new access token in {time.perf_counter() - start:.3f}s')
+        return (access_token, float(expires_on))
+
+    def clear(self):
+        """This function removes all tokens held in memory"""
+        self._memory.clear()
+
+## This function builds a token fetcher that uses MSAL to request a token with the client credentials flow.
+## The ConfidentialClientApplication is built once and reused for every refresh.
+##
+def msal_token_fetcher(client_id, client_credential, tenant_name, scopes, authority_host='https://login.microsoftonline.com'):
+    """This function builds a token fetcher that uses MSAL and the client credentials flow
+        Args:
+            client_id (str): The client id of the service principal
+            client_credential (str): The client secret of the service principal
+            tenant_name (str): The tenant id of the Entra ID tenant
+            scopes (list): The scopes for which the access token is requested
+            authority_host (str, optional): The Entra ID authority host. Defaults to https://login.microsoftonline.com.
+        Returns:
+            fetch_token: A function that returns a tuple of (access_token, expires_on)
+    """
+    from msal import ConfidentialClientApplication
+
+    app = ConfidentialClientApplication(
+        client_id=client_id,
+        client_credential=client_credential,
+        authority=f"{authority_host}/{tenant_name}"
+    )
+
+    def fetch_token():
+        result = app.acquire_token_for_client(scopes=scopes)
+        if "access_token" not in result:
+            logging.error(f"Error was: {result.get('error')}")
+            logging.error(f"Error description was: {result.get('error_description')}")
+            logging.error(f"Error correlation_id was: {result.get('correlation_id')}")
+            raise Exception('Failed to obtain access token')
+        return result['access_token'], time.time() + int(result['expires_in'])
+
+    return fetch_token
+
+## This function builds a token fetcher that posts the client credentials grant directly to a token endpoint.
+## It has no dependencies outside of the standard library and can be pointed at the mock server.
+##
+def http_token_fetcher(client_id, client_credential, tenant_name, scopes, authority_host='https://login.microsoftonline.com'):
+    """This function builds a token fetcher that posts the client credentials grant to the token endpoint
+        Args:
+            client_id (str): The client id of the service principal
+            client_credential (str): The client secret of the service principal
+            tenant_name (str): The tenant id of the Entra ID tenant
+            scopes (list): The scopes for which the access token is requested
+            authority_host (str, optional): The Entra ID authority host. Defaults to https://login.microsoftonline.com.
+        Returns:
+            fetch_token: A function that returns a tuple of (access_token, expires_on)
+    """
+    url = f"{authority_host}/{tenant_name}/oauth2/v2.0/token"
+    data = urllib.parse.urlencode({
+        'grant_type': 'client_credentials',
+        'client_id': client_id,
+        'client_secret': client_credential,
+        'scope': ' '.join(scopes)
+    }).encode('utf-8')
+
+    def fetch_token():
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST'), timeout=30) as response:
+            result = json.loads(response.read())
+        return result['access_token'], time.time() + int(result['expires_in'])
+
+    return fetch_token
+
+## The process-wide cache used by authenticate_with_service_principal. Set TOKEN_CACHE_PATH
+## to share tokens between worker processes on the same host.
+##
+_default_cache = None
+_default_cache_lock = threading.Lock()
+_fetchers = {}
+
+def get_default_cache(settings=None):
+    """This function returns the process-wide token cache, creating it on first use
+        Args:
+            settings (Settings, optional): The settings that give the cache path and refresh margin on first use. Defaults to get_settings().
+        Returns:
+            TokenCache: The process-wide token cache
+    """
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                settings = settings or get_settings()
+                _default_cache = TokenCache(path=settings.token_cache_path, refresh_margin=settings.token_refresh_margin)
+    return _default_cache
+
+## This function obtains an access token from Entra ID using a service principal with a client id and client secret
+## and serves repeated calls from the token cache
+##
+def authenticate_with_service_principal(client_id, client_credential, tenant_name, scopes, cache=None, fetcher_factory=msal_token_fetcher, authority_host='https://login.microsoftonline.com'):
+    """This function obtains an access token from Entra ID using a service principal with a client id and client secret
+        Args:
+            client_id (str): The client id of the service principal
+            client_credential (str): The client secret of the service principal
+            tenant_name (str): The tenant id of the Entra ID tenant
+            scopes (list): The scopes for which the access token is requested
+            cache (TokenCache, optional): The token cache to use. Defaults to the process-wide cache.
+            fetcher_factory (callable, optional): Builds the token fetcher. Defaults to msal_token_fetcher.
+            authority_host (str, optional): The Entra ID authority host. Defaults to https://login.microsoftonline.com.
+        Returns:
+            token: An access token that can be used to authenticate requests to Azure OpenAI
+        Raises:
+            Exception: The error of the token request when no cached token can be used. It is left to the
+                caller because a long-running process should survive a failed refresh.
+    """
+    cache = cache or get_default_cache()
+    key = f"{authority_host}|{tenant_name}|{client_id}|{' '.join(sorted(scopes))}"
+    with _default_cache_lock:
+        fetch_token = _fetchers.get(key)
+        if fetch_token is None:
+            fetch_token = fetcher_factory(client_id, client_credential, tenant_name, scopes, authority_host=authority_host)
+            _fetchers[key] = fetch_token
+    return cache.get_token(key, fetch_token)
+
+def main():
+    ## Setup logging
+    ##
+    configure_logging("INFO")
+
+    ## Start the mock Entra ID endpoint and request a token from many threads at once.
+    ## Only one request should reach the token endpoint.
+    ##
+    from mock_server import start_mock_server
+    server = start_mock_server(token_latency=0.2)
+    try:
+        ## Load and validate the settings from the environment and the .env file with the endpoint pointed
+        ## at the mock server. The variables loaded optionally include TOKEN_CACHE_PATH and TOKEN_REFRESH_MARGIN
+        try:
+            get_default_cache(load_settings(overrides={'FOUNDRY_ENDPOINT': server.url, 'DEPLOYMENT_NAME': 'gpt-4.1', 'AUTH_MODE': 'default'}))
+        except ConfigurationError as e:
+            logging.error(e)
+            sys.exit(1)
+
+        def worker(_):
+            return authenticate_with_service_principal(
+                client_id='mock-client-id',
+                client_credential='mock-client-secret',
+                tenant_name='mock-tenant',
+                scopes=["https://ai.azure.com/.default"],
+                fetcher_factory=http_token_fetcher,
+                authority_host=server.url
+            )
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                tokens = set(pool.map(worker, range(1000)))
+        except Exception:
+            logging.error('Failed to obtain access token: ', exc_info=True)
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+
+        print(f"Requests for a token: 1000")
+        print(f"Distinct tokens returned: {len(tokens)}")
+        print(f"Calls to the token endpoint: {server.counts.get('token', 0)}")
+        print(f"Elapsed: {elapsed:.3f}s")
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
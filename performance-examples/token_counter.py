@@ -0,0 +1,389 @@
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from utils import configure_logging
+
+## This module counts prompt tokens locally with the tiktoken encoding of the model behind a deployment,
+## so requests can be sized and paced before they are sent. Deployment names often match the model
+## name. When they don't, set MODEL_NAME. tiktoken downloads each encoding on first use and caches it in
+## TIKTOKEN_CACHE_DIR. When it isn't installed or can't download, tokens are estimated from words and
+## punctuation.
+##
+MODEL_ENCODINGS = (
+    ('gpt-4o', 'o200k_base'),
+    ('gpt-4.1', 'o200k_base'),
+    ('gpt-4.5', 'o200k_base'),
+    ('gpt-5', 'o200k_base'),
+    ('o1', 'o200k_base'),
+    ('o3', 'o200k_base'),
+    ('o4', 'o200k_base'),
+    ('gpt-4', 'cl100k_base'),
+    ('gpt-35', 'cl100k_base'),
+    ('gpt-3.5', 'cl100k_base'),
+    ('text-embedding', 'cl100k_base')
+)
+DEFAULT_ENCODING = 'o200k_base'
+
+## The context window and the largest completion of each model family
+##
+MODEL_LIMITS = (
+    ('gpt-4.1', 1047576, 32768),
+    ('gpt-4o', 128000, 16384),
+    ('gpt-4.5', 128000, 16384),
+    ('gpt-4-turbo', 128000, 4096),
+    ('gpt-4-32k', 32768, 4096),
+    ('gpt-4', 8192, 4096),
+    ('gpt-5', 400000, 128000),
+    ('o1', 200000, 100000),
+    ('o3', 200000, 100000),
+    ('o4', 200000, 100000),
+    ('gpt-35', 16385, 4096),
+    ('gpt-3.5', 16385, 4096)
+)
+DEFAULT_LIMITS = (128000, 16384)
+
+## Every message is wrapped in a few tokens of chat format and the reply is primed with a few more
+##
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_TOKENS = 3
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def _lookup(table, model, default):
+    model = (model or '').lower()
+    for prefix, *value in table:
+        if model.startswith(prefix):
+            return value
+    return default
+
+def encoding_name_for(model):
+    """This function returns the name of the tiktoken encoding of a model
+        Args:
+            model (str): The model name, such as gpt-4.1 or gpt-4o-mini
+        Returns:
+            str: The encoding name. Unknown models use o200k_base.
+    """
+    return _lookup(MODEL_ENCODINGS, model, [DEFAULT_ENCODING])[0]
+
+def model_limits(model):
+    """This function returns the context window and largest completion of a model
+        Args:
+            model (str): The model name
+        Returns:
+            tuple: The context window and the maximum completion tokens
+    """
+    return tuple(_lookup(MODEL_LIMITS, model, DEFAULT_LIMITS))
+
+@lru_cache(maxsize=None)
+def load_encoding(name):
+    """This function loads a tiktoken encoding once per process
+        Args:
+            name (str): The encoding name
+        Returns:
+            Encoding: The encoding, or None when tiktoken isn't installed or can't download it
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.warning(f"Can't load the {name} tokenizer so tokens will be estimated: {e!r}")
+        return None
+
+class TokenBudgetError(ValueError):
+    """This exception is raised when a prompt leaves no room for a completion"""
+
+## This class counts the tokens of messages for one model. The counts of recent segments such as system
+## prompts and templates are kept in a bounded LRU, so a segment sent with every request is only
+## encoded once. It is safe to share between threads.
+##
+class TokenCounter:
+    """This class counts prompt tokens and sizes max_tokens for a model
+        Args:
+            model (str, optional): The model name. Defaults to gpt-4.1.
+            cache_size (int, optional): The number of segment counts kept. Defaults to 4096.
+    """
+    def __init__(self, model='gpt-4.1', cache_size=4096):
+        self.model = model
+        self.encoding_name = encoding_name_for(model)
+        self.encoding = load_encoding(self.encoding_name)
+        self.context_window, self.max_output = model_limits(model)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        return f"tiktoken {self.encoding_name}" if self.encoding is not None else 'estimate'
+
+    def encode_length(self, text):
+        """This function counts the tokens of a text without the cache"""
+        if self.encoding is not None:
+            ## Special tokens in user content are counted as plain text, as the service does
+            return len(self.encoding.encode_ordinary(text))
+        return len(_TOKEN_PATTERN.findall(text))
+
+    def count(self, text):
+        """This function counts the tokens of a text, reusing the count of a recent identical text
+            Args:
+                text (str): The text
+            Returns:
+                int: The number of tokens
+        """
+        with self._lock:
+            tokens = self._cache.get(text)
+            if tokens is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        tokens = self.encode_length(text)
+        self._remember(text, tokens)
+        return tokens
+
+    def _remember(self, text, tokens):
+        with self._lock:
+            self._cache[text] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count_messages(self, messages):
+        """This function counts the prompt tokens of a chat completion
+            Args:
+                messages (list): The chat messages as Message objects or dicts with role and content
+            Returns:
+                int: The number of prompt tokens including the chat format
+        """
+        tokens = REPLY_TOKENS
+        for message in messages:
+            tokens += TOKENS_PER_MESSAGE
+            for text in _segments(message):
+                tokens += self.count(text)
+            if _get(message, 'name'):
+                tokens += TOKENS_PER_NAME
+        return tokens
+
+    def count_batch(self, conversations, num_threads=8):
+        """This function counts the prompt tokens of many chat completions at once. Each distinct segment
+            is encoded once for the whole batch, and with tiktoken the segments are encoded together on
+            native threads that don't hold the GIL.
+            Args:
+                conversations (list): The messages of each chat completion
+                num_threads (int, optional): The threads tiktoken encodes with. Defaults to 8.
+            Returns:
+                list: The number of prompt tokens of each chat completion
+        """
+        occurrences = {}
+        for messages in conversations:
+            for message in messages:
+                for text in _segments(message):
+                    occurrences[text] = occurrences.get(text, 0) + 1
+
+        lengths = {}
+        with self._lock:
+            for text in occurrences:
+                tokens = self._cache.get(text)
+                if tokens is not None:
+                    self._cache.move_to_end(text)
+                    lengths[text] = tokens
+        missing = [text for text in occurrences if text not in lengths]
+        if self.encoding is not None:
+            lengths.update(zip(missing, map(len, self.encoding.encode_ordinary_batch(missing, num_threads=num_threads))))
+        else:
+            lengths.update((text, self.encode_length(text)) for text in missing)
+        ## Segments that repeat within the batch, such as system prompts and templates, are kept for later batches
+        for text in missing:
+            if occurrences[text] > 1:
+                self._remember(text, lengths[text])
+        with self._lock:
+            self.hits += sum(occurrences.values()) - len(missing)
+            self.misses += len(missing)
+
+        totals = []
+        for messages in conversations:
+            tokens = REPLY_TOKENS
+            for message in messages:
+                tokens += TOKENS_PER_MESSAGE
+                for text in _segments(message):
+                    tokens += lengths[text]
+                if _get(message, 'name'):
+                    tokens += TOKENS_PER_NAME
+            totals.append(tokens)
+        return totals
+
+    def budget_max_tokens(self, prompt_tokens, requested=None, tpm_limit=None):
+        """This function sizes max_tokens so the prompt and completion fit the context window and the TPM quota.
+            Azure OpenAI charges prompt tokens plus max_tokens against the quota when the request arrives,
+            so an oversized max_tokens throttles requests that would have fit.
+            Args:
+                prompt_tokens (int): The prompt tokens of the request
+                requested (int, optional): The max_tokens the caller asked for. Defaults to the largest completion of the model.
+                tpm_limit (int, optional): The tokens per minute quota of the deployment
+            Returns:
+                int: The max_tokens to send
+            Raises:
+                TokenBudgetError: When requested is less than 1 or the prompt leaves no room for a completion
+        """
+        if requested is not None and requested < 1:
+            raise TokenBudgetError(f"max_tokens must be at least 1, got {requested}")
+        available = self.context_window - prompt_tokens
+        if tpm_limit:
+            available = min(available, tpm_limit - prompt_tokens)
+        if available <= 0:
+            limit = 'context window' if prompt_tokens >= self.context_window else 'tokens per minute quota'
+            raise TokenBudgetError(f"The prompt has {prompt_tokens} tokens, which leaves no room in the {limit} of {self.model}")
+        return min(available, self.max_output, requested if requested is not None else self.max_output)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0, "cached_segments": len(self._cache)}
+
+def _get(message, name):
+    return message.get(name) if isinstance(message, dict) else getattr(message, name, None)
+
+def _segments(message):
+    ## The role and the text of the content are counted. Content can be a string or a list of parts.
+    yield _get(message, 'role') or ''
+    content = _get(message, 'content')
+    if isinstance(content, str):
+        yield content
+    elif content:
+        for part in content:
+            if isinstance(part, dict) and part.get('type') == 'text':
+                yield part.get('text') or ''
+    name = _get(message, 'name')
+    if name:
+        yield name
+
+@lru_cache(maxsize=None)
+def get_counter(model):
+    """This function returns the shared TokenCounter of a model
+        Args:
+            model (str): The model name. Use Profile.model_name for the model behind a deployment.
+        Returns:
+            TokenCounter: The counter
+    """
+    return TokenCounter(model)
+
+## The benchmark counts the prompts of many conversations that share a system prompt and a few templates
+## the way batch jobs do. Each conversation is counted message by message without a cache, with the
+## cache and in batches. The messages are generated in chunks outside the timed sections.
+##
+WORDS = ('the', 'order', 'shipped', 'customer', 'refund', 'delayed', 'invoice', 'account', 'password',
+         'reset', 'warehouse', 'delivery', 'weekend', 'tracking', 'number', 'replacement', 'damaged',
+         'subscription', 'renewal', 'discount', 'billing', 'address', 'changed', 'urgent', 'thanks')
+
+def generate_conversations(count, start, system_prompt, templates, rng):
+    conversations = []
+    for i in range(start, start + count):
+        template = templates[i % len(templates)]
+        ticket = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+        conversations.append([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": template},
+            {"role": "user", "content": f"Ticket {i}: {ticket}"}
+        ])
+    return conversations
+
+def run_benchmark(model, messages_count, chunk_size, num_threads):
+    """This function compares counting without a cache, with the cache and in batches
+        Args:
+            model (str): The model name
+            messages_count (int): The number of messages counted by each approach
+            chunk_size (int): The number of conversations generated and counted at a time
+            num_threads (int): The threads used by count_batch
+        Returns:
+            list: One result per approach
+    """
+    rng = random.Random(0)
+    system_prompt = "You are a support assistant. " + ' '.join(rng.choice(WORDS) for _ in range(400))
+    templates = [f"Template {n}: classify the ticket below, extract the order number and draft a reply. " + ' '.join(rng.choice(WORDS) for _ in range(80)) for n in range(8)]
+    conversations_count = max(1, messages_count // 3)
+
+    uncached = TokenCounter(model, cache_size=0)
+    cached = TokenCounter(model)
+    batched = TokenCounter(model)
+    approaches = (
+        ('per message', lambda chunk: [uncached.count_messages(c) for c in chunk], uncached),
+        ('memoized', lambda chunk: [cached.count_messages(c) for c in chunk], cached),
+        ('batch', lambda chunk: batched.count_batch(chunk, num_threads=num_threads), batched)
+    )
+    elapsed = {name: 0.0 for name, _, _ in approaches}
+    tokens = {name: 0 for name, _, _ in approaches}
+    for start in range(0, conversations_count, chunk_size):
+        chunk = generate_conversations(min(chunk_size, conversations_count - start), start, system_prompt, templates, rng)
+        for name, count, _ in approaches:
+            begin = time.perf_counter()
+            counts = count(chunk)
+            elapsed[name] += time.perf_counter() - begin
+            tokens[name] += sum(counts)
+
+    results = []
+    for name, _, counter in approaches:
+        results.append({
+            "approach": name,
+            "tokenizer": counter.tokenizer,
+            "messages": conversations_count * 3,
+            "messages_per_s": round(conversations_count * 3 / elapsed[name]),
+            "tokens_per_s": round(tokens[name] / elapsed[name]),
+            "elapsed_s": round(elapsed[name], 3),
+            **({"cache_hit_ratio": counter.stats()["hit_ratio"]} if counter is not uncached else {})
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Count prompt tokens locally and size max_tokens to the context window and TPM quota')
+    parser.add_argument('--model', help='The model whose tokenizer is used. Defaults to MODEL_NAME or DEPLOYMENT_NAME')
+    parser.add_argument('--messages', type=int, default=1000000, help='The number of messages counted by each approach')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='The conversations counted per batch')
+    parser.add_argument('--threads', type=int, default=8, help='The threads tiktoken encodes batches with')
+    parser.add_argument('--prompt', help='Count this prompt and size its max_tokens instead of running the benchmark')
+    parser.add_argument('--max-tokens', type=int, help='The max_tokens requested for --prompt')
+    parser.add_argument('--tpm-limit', type=int, help='The tokens per minute quota used for --prompt. Defaults to TPM_LIMIT')
+    args = parser.parse_args()
+
+    configure_logging("WARNING")
+
+    model = args.model
+    tpm_limit = args.tpm_limit
+    if not model or (args.prompt and not tpm_limit):
+        ## The model and quota come from the settings when they aren't given on the command line
+        from settings import ConfigurationError, get_settings
+        try:
+            profile = get_settings().profile()
+        except ConfigurationError as e:
+            if not model:
+                logging.error(e)
+                sys.exit(1)
+        else:
+            model = model or profile.model_name
+            tpm_limit = tpm_limit or profile.tpm_limit
+
+    if args.prompt:
+        counter = get_counter(model)
+        prompt_tokens = counter.count_messages([{"role": "user", "content": args.prompt}])
+        try:
+            max_tokens = counter.budget_max_tokens(prompt_tokens, args.max_tokens, tpm_limit)
+        except TokenBudgetError as e:
+            logging.error(e)
+            sys.exit(1)
+        print(json.dumps({"model": model, "tokenizer": counter.tokenizer, "prompt_tokens": prompt_tokens, "max_tokens": max_tokens,
+                          "context_window": counter.context_window, "tpm_limit": tpm_limit}))
+        return
+
+    for result in run_benchmark(model, args.messages, args.chunk_size, args.threads):
+        print(json.dumps({"model": model, **result}))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import logging
+import sys
+
+## This is my shitty canned logging function
+##
+def configure_logging(level="ERROR"):
+    """This function sets up logging
+        Args:
+            level (str, optional): The logging level as a string. Defaults to "ERROR".
+    """
+    try:
+        ## Convert the level string to uppercase so it matches what the logging library expects
+        logging_level = getattr(logging, level.upper(), None)
+
+        ## Validate that the level is a valid logging level
+        if not isinstance(logging_level, int):
+            raise ValueError(f'Invalid log level: {level}')
+
+        ## Setup a logging format
+        logging.basicConfig(
+            level=logging_level,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            handlers=[logging.StreamHandler(sys.stdout)]
+        )
+    except Exception as e:
+        print(f"Failed to set up logging: {e}", file=sys.stderr)
+        sys.exit(1)
+
+## This function returns a percentile of a list of measurements using the nearest-rank method
+##
+def percentile(values, pct):
+    """This function returns a percentile of a list of measurements using the nearest-rank method
+        Args:
+            values (list): The measurements
+            pct (float): The percentile between 0 and 100
+        Returns:
+            float: The measurement at the requested percentile
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
@@ -1,10 +1,20 @@
 import logging
 import sys
 import os
-import json
+import random
+import time
 import requests
 from dotenv import load_dotenv
 
+## orjson decodes the response body straight from bytes. The json module is used when it isn't installed.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+## Status codes that are worth retrying because the service is throttling or briefly unavailable
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
 ## This is my shitty canned logging function
 ##
 def configure_logging(level="ERROR"):
@@ -30,6 +40,46 @@ def configure_logging(level="ERROR"):
         print(f"Failed to set up logging: {e}", file=sys.stderr)
         sys.exit(1)
    
+## This function sends a chat completion and retries throttled and failed requests using exponential
+## backoff with jitter, waiting at least as long as the Retry-After headers ask. The response is
+## returned as a plain dict on purpose so the sample stays a single file. The performance examples
+## decode it into slotted objects with response_parser.read_completion instead.
+##
+def post_with_retries(url, headers, body, max_attempts=5, base_delay=1.0, max_delay=30.0):
+    """This function sends a chat completion and retries throttled and failed requests
+        Args:
+            url (str): The URL of the chat completions operation
+            headers (dict): The request headers
+            body (dict): The JSON body of the request
+            max_attempts (int, optional): The most attempts including the first. Defaults to 5.
+            base_delay (float, optional): The smallest backoff in seconds. Defaults to 1.
+            max_delay (float, optional): The largest backoff in seconds. Defaults to 30.
+        Returns:
+            dict: The decoded chat completion response
+    """
+    delay = 0.0
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = requests.post(url=url, headers=headers, json=body, timeout=60)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_attempts:
+                raise
+            response = None
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == max_attempts:
+                response.raise_for_status()
+                return json_loads(response.content)
+
+        ## Decorrelated jitter keeps many clients from retrying in lockstep
+        delay = min(max_delay, random.uniform(base_delay, max(base_delay, delay) * 3))
+        if response is not None:
+            if response.headers.get('retry-after-ms'):
+                delay = max(delay, float(response.headers['retry-after-ms']) / 1000)
+            elif response.headers.get('retry-after', '').isdigit():
+                delay = max(delay, float(response.headers['retry-after']))
+        logging.warning(f"Attempt {attempt} failed with {response.status_code if response is not None else 'a connection error'}. Retrying in {delay:.1f}s")
+        time.sleep(delay)
+
 def main():
 
     ## Setup logging
@@ -49,10 +99,10 @@ def main():
             'Content-Type': 'application/json',
             'api-key': os.getenv("FOUNDRY_API_KEY")
         }
-        response = requests.post(
+        response = post_with_retries(
             url = f"{os.getenv('FOUNDRY_ENDPOINT')}/openai/v1/chat/completions",
             headers = headers,
-            json = {
+            body = {
                 "model": os.getenv('DEPLOYMENT_NAME'),
                 "messages": [
                     {
@@ -63,9 +113,10 @@ def main():
                 "max_tokens": 100
             },
         )
-        print(json.loads(response.text)['choices'][0]['message']['content'])
-    except:
+        print(response['choices'][0]['message']['content'])
+    except Exception:
         logging.error('Failed to inference: ', exc_info=True)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
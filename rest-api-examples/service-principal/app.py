@@ -1,11 +1,21 @@
 import logging
 import sys
 import os
-import json
+import random
+import time
 import requests
-from msal import ConfidentialClientApplication
+from msal import ConfidentialClientApplication, SerializableTokenCache
 from dotenv import load_dotenv
 
+## orjson decodes the response body straight from bytes. The json module is used when it isn't installed.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+## Status codes that are worth retrying because the service is throttling or briefly unavailable
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
 ## This is my shitty canned logging function
 ##
 def configure_logging(level="ERROR"):
@@ -31,6 +41,35 @@ def configure_logging(level="ERROR"):
         print(f"Failed to set up logging: {e}", file=sys.stderr)
         sys.exit(1)
    
+## This function loads the MSAL token cache from disk so tokens are reused across runs
+##
+def load_token_cache(cache_path):
+    """This function loads the MSAL token cache from disk so tokens are reused across runs
+        Args:
+            cache_path (str): The path of the file used to persist the token cache
+        Returns:
+            cache: A SerializableTokenCache populated with any tokens saved by a previous run
+    """
+    cache = SerializableTokenCache()
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache.deserialize(f.read())
+    return cache
+
+## This function writes the MSAL token cache to disk if it changed
+##
+def save_token_cache(cache, cache_path):
+    """This function writes the MSAL token cache to disk if it changed
+        Args:
+            cache (SerializableTokenCache): The token cache to persist
+            cache_path (str): The path of the file used to persist the token cache
+    """
+    if cache_path and cache.has_state_changed:
+        ## The cache holds bearer tokens so only the current user should be able to read it
+        fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(cache.serialize())
+
 ## This function obtains an access token from Entra ID using a service principal with a client id and client secret
 ##
 def authenticate_with_service_principal(client_id, client_credential, tenant_name, scopes):
@@ -45,13 +84,19 @@ def authenticate_with_service_principal(client_id, client_credential, tenant_nam
     """
     try: 
         logging.info('Attempting to obtain an access token...')
-        
+
+        ## MSAL checks the token cache before calling Entra ID so a token saved by a previous
+        ## run is reused until it is close to expiring
+        cache_path = os.getenv('TOKEN_CACHE_PATH')
+        cache = load_token_cache(cache_path)
         app = ConfidentialClientApplication(
             client_id=client_id,
             client_credential=client_credential,
-            authority=f"https://login.microsoftonline.com/{tenant_name}"
+            authority=f"https://login.microsoftonline.com/{tenant_name}",
+            token_cache=cache
         )
         result = app.acquire_token_for_client(scopes=scopes)
+        save_token_cache(cache, cache_path)
 
         if "access_token" in result:
             logging.info('Access token successfully acquired')
@@ -66,6 +111,46 @@ def authenticate_with_service_principal(client_id, client_credential, tenant_nam
         logging.error('Failed to obtain access token: ', exc_info=True)
         sys.exit(1)
 
+## This function sends a chat completion and retries throttled and failed requests using exponential
+## backoff with jitter, waiting at least as long as the Retry-After headers ask. The response is
+## returned as a plain dict on purpose so the sample stays a single file. The performance examples
+## decode it into slotted objects with response_parser.read_completion instead.
+##
+def post_with_retries(url, headers, body, max_attempts=5, base_delay=1.0, max_delay=30.0):
+    """This function sends a chat completion and retries throttled and failed requests
+        Args:
+            url (str): The URL of the chat completions operation
+            headers (dict): The request headers
+            body (dict): The JSON body of the request
+            max_attempts (int, optional): The most attempts including the first. Defaults to 5.
+            base_delay (float, optional): The smallest backoff in seconds. Defaults to 1.
+            max_delay (float, optional): The largest backoff in seconds. Defaults to 30.
+        Returns:
+            dict: The decoded chat completion response
+    """
+    delay = 0.0
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = requests.post(url=url, headers=headers, json=body, timeout=60)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_attempts:
+                raise
+            response = None
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == max_attempts:
+                response.raise_for_status()
+                return json_loads(response.content)
+
+        ## Decorrelated jitter keeps many clients from retrying in lockstep
+        delay = min(max_delay, random.uniform(base_delay, max(base_delay, delay) * 3))
+        if response is not None:
+            if response.headers.get('retry-after-ms'):
+                delay = max(delay, float(response.headers['retry-after-ms']) / 1000)
+            elif response.headers.get('retry-after', '').isdigit():
+                delay = max(delay, float(response.headers['retry-after']))
+        logging.warning(f"Attempt {attempt} failed with {response.status_code if response is not None else 'a connection error'}. Retrying in {delay:.1f}s")
+        time.sleep(delay)
+
 def main():
 
     ## Setup logging
@@ -74,7 +159,7 @@ def main():
 
     ## Use dotenv library to load environmental variables from .env file.
     ## The variables loaded include AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID
-    ## DEPLOYMENT_NAME, and FOUNDRY_ENDPOINT
+    ## DEPLOYMENT_NAME, FOUNDRY_ENDPOINT, and optionally TOKEN_CACHE_PATH
     try:
         load_dotenv('.env')
     except Exception as e:
@@ -97,10 +182,10 @@ def main():
             'Content-Type': 'application/json',
             'Authorization': 'Bearer ' + token
         }
-        response = requests.post(
+        response = post_with_retries(
             url = f"{os.getenv('FOUNDRY_ENDPOINT')}/openai/v1/chat/completions",
             headers = headers,
-            json = {
+            body = {
                 "messages": [
                     {
                         "role": "user",
@@ -110,9 +195,10 @@ def main():
                 "max_tokens": 100
             },
         )
-        print(json.loads(response.text)['choices'][0]['message']['content'])
-    except:
+        print(response['choices'][0]['message']['content'])
+    except Exception:
         logging.error('Failed to inference: ', exc_info=True)
+        sys.exit(1)
 
 
 if __name__ == "__main__":